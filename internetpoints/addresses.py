@@ -0,0 +1,261 @@
+import logging
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.sql import and_, distinct, func, or_
+
+from internetpoints import models
+from internetpoints.storage import TransactionConflict, chunks
+
+
+logger = logging.getLogger(__name__)
+
+
+# Matching of sender addresses to posters.
+#
+# Messages are attributed to a poster by exact match of Message.from_ and
+# PosterEmail.address, which both queries and indexes handle well. But people
+# write from several forms of the same address (Remram@Example.com,
+# remram+lists@example.com), so every address seen is recorded in the
+# addresses table with a normalized form, without case and plus-addressing.
+# Linking an address to a poster links all its known forms, and the getter
+# links the new forms of a poster's addresses as their messages arrive.
+
+
+def normalize_address(address):
+    """Returns the form shared by the variants of an address.
+
+    That's the address in lower case, without the '+tag' of plus-addressing.
+    """
+    address = address.strip().lower()
+    local, at, domain = address.rpartition('@')
+    if not at:
+        return address
+    local = local.split('+', 1)[0] or local
+    return '%s@%s' % (local, domain)
+
+
+def _record(sqlsession, addresses):
+    """Adds the addresses that are not in the addresses table yet.
+
+    Returns the set of addresses that were added.
+    """
+    new = set(addresses)
+    for chunk in chunks(list(new)):
+        for address, in (sqlsession.query(models.Address.address)
+                                   .filter(models.Address.address.in_(
+                                       chunk))):
+            new.discard(address)
+    if new:
+        try:
+            sqlsession.execute(models.Address.__table__.insert(),
+                               [dict(address=address,
+                                     normalized=normalize_address(address))
+                                for address in new])
+        except IntegrityError:
+            # Another transaction recorded it since we looked
+            raise TransactionConflict("Address recorded concurrently")
+    return new
+
+
+def _unlinked(sqlsession, addresses):
+    """Returns the addresses that aren't linked to a poster.
+    """
+    unlinked = set(addresses)
+    for chunk in chunks(list(unlinked)):
+        for address, in (sqlsession.query(models.PosterEmail.address)
+                                   .filter(models.PosterEmail.address.in_(
+                                       chunk))):
+            unlinked.discard(address)
+    return unlinked
+
+
+def _insert_emails(sqlsession, poster_emails):
+    if poster_emails:
+        try:
+            sqlsession.execute(models.PosterEmail.__table__.insert(),
+                               poster_emails)
+        except IntegrityError:
+            raise TransactionConflict("Address linked concurrently")
+
+
+def _link_variants(sqlsession, addresses):
+    """Links addresses to the poster that has another form of them.
+
+    Addresses whose forms belong to several posters are left alone. Returns
+    the number of addresses linked.
+    """
+    Address = models.Address
+    PosterEmail = models.PosterEmail
+    variants = {}
+    for address in _unlinked(sqlsession, addresses):
+        variants.setdefault(normalize_address(address), []).append(address)
+    posters = {}
+    for chunk in chunks(list(variants)):
+        for normalized, poster_id in (
+                sqlsession.query(Address.normalized, PosterEmail.poster_id)
+                          .join(PosterEmail,
+                                PosterEmail.address == Address.address)
+                          .filter(Address.normalized.in_(chunk))
+                          .distinct()):
+            posters.setdefault(normalized, set()).add(poster_id)
+
+    poster_emails = []
+    for normalized, poster_ids in posters.iteritems():
+        if len(poster_ids) > 1:
+            logger.warning("Forms of %s belong to several posters, not "
+                           "linking %s" % (normalized,
+                                           ', '.join(variants[normalized])))
+            continue
+        poster_id, = poster_ids
+        poster_emails.extend(dict(address=address, poster_id=poster_id)
+                             for address in variants[normalized])
+    _insert_emails(sqlsession, poster_emails)
+    return len(poster_emails)
+
+
+def record_senders(sqlsession, addresses):
+    """Records the sender addresses of new messages.
+
+    New forms of addresses known to belong to a poster are linked to that
+    poster. Returns the number of addresses linked. This doesn't commit.
+    """
+    new = _record(sqlsession, addresses)
+    if not new:
+        return 0
+    return _link_variants(sqlsession, new)
+
+
+def _forms(sqlsession, normalized):
+    """Returns the recorded addresses that have one of these normalized forms.
+    """
+    forms = set()
+    for chunk in chunks(list(normalized)):
+        forms.update(address
+                     for address, in (sqlsession.query(models.Address.address)
+                                                .filter(
+                                                    models.Address.normalized
+                                                    .in_(chunk))))
+    return forms
+
+
+def _link(sqlsession, candidates, poster_id):
+    linked = sorted(_unlinked(sqlsession, candidates))
+    _insert_emails(sqlsession, [dict(address=address, poster_id=poster_id)
+                                for address in linked])
+    return linked
+
+
+def link_addresses(sqlsession, addresses, poster_id):
+    """Links addresses, and all their known forms, to a poster.
+
+    The addresses are recorded even if they never sent anything. Forms that
+    are already linked to a poster are left alone. Returns the sorted list of
+    the addresses linked. This doesn't commit.
+    """
+    _record(sqlsession, addresses)
+    candidates = set(addresses)
+    candidates.update(_forms(sqlsession,
+                             set(normalize_address(address)
+                                 for address in addresses)))
+    return _link(sqlsession, candidates, poster_id)
+
+
+def link_forms(sqlsession, normalized, poster_id):
+    """Links the recorded addresses that have these normalized forms to a
+    poster.
+
+    Unlike link_addresses(), only addresses that were seen are linked, not
+    the normalized forms themselves. Returns the sorted list of the addresses
+    linked. This doesn't commit.
+    """
+    return _link(sqlsession, _forms(sqlsession, normalized), poster_id)
+
+
+def unknown_senders(sqlsession, cursor=None, limit=50):
+    """Gets the senders that aren't linked to a poster, most messages first.
+
+    The forms of an address are counted together. Returns a list of
+    (normalized address, number of messages, number of forms, date of the
+    last message) rows, and the (messages, normalized address) cursor of the
+    next page, or None if this is the last page.
+    """
+    Address = models.Address
+    Message = models.Message
+    PosterEmail = models.PosterEmail
+    messages = func.count(Message.id)
+    query = (sqlsession.query(Address.normalized, messages,
+                              func.count(distinct(Message.from_)),
+                              func.max(Message.date))
+                       .select_from(Message)
+                       .join(Address, Address.address == Message.from_)
+                       .outerjoin(PosterEmail,
+                                  PosterEmail.address == Message.from_)
+                       .filter(PosterEmail.address == None)
+                       .group_by(Address.normalized))
+    if cursor is not None:
+        count, normalized = cursor
+        query = query.having(or_(messages < count,
+                                 and_(messages == count,
+                                      Address.normalized > normalized)))
+    rows = (query.order_by(messages.desc(), Address.normalized)
+                 .limit(limit + 1)).all()
+    if len(rows) > limit:
+        last = rows[limit - 1]
+        return rows[:limit], (last[1], last[0])
+    return rows, None
+
+
+def search_posters(sqlsession, prefix, limit=20):
+    """Finds the posters whose name or an address starts with prefix.
+
+    Both are range scans on an index. The name is matched with its case, the
+    addresses through their normalized form, so without case.
+    """
+    if not prefix:
+        return []
+    Address = models.Address
+    Poster = models.Poster
+    PosterEmail = models.PosterEmail
+    # Any string starting with prefix sorts before this
+    end = prefix + u'\uffff'
+    posters = (sqlsession.query(Poster)
+                         .filter(Poster.name >= prefix)
+                         .filter(Poster.name < end)
+                         .order_by(Poster.name)
+                         .limit(limit)).all()
+    normalized = normalize_address(prefix)
+    posters.extend(sqlsession.query(Poster)
+                             .join(PosterEmail,
+                                   PosterEmail.poster_id == Poster.id)
+                             .join(Address,
+                                   Address.address == PosterEmail.address)
+                             .filter(Address.normalized >= normalized)
+                             .filter(Address.normalized <
+                                     normalized + u'\uffff')
+                             .order_by(Address.normalized)
+                             .limit(limit))
+    found = []
+    seen = set()
+    for poster in posters:
+        if poster.id not in seen:
+            seen.add(poster.id)
+            found.append(poster)
+    return found[:limit]
+
+
+def rebuild_addresses(sqlsession):
+    """Records all the addresses again, and links the forms of the posters'
+    addresses.
+
+    Returns the number of addresses and the number linked. This commits.
+    """
+    sqlsession.query(models.Address).delete(synchronize_session=False)
+    addresses = set(address
+                    for address, in sqlsession.query(
+                        models.PosterEmail.address))
+    addresses.update(address
+                     for address, in sqlsession.query(
+                         models.Message.from_).distinct())
+    _record(sqlsession, addresses)
+    linked = _link_variants(sqlsession, addresses)
+    sqlsession.commit()
+    return len(addresses), linked
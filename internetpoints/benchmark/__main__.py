@@ -0,0 +1,4 @@
+from internetpoints.benchmark.main import main
+
+
+main()
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+
+from datetime import datetime, timedelta
+from email.header import Header
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+import email.utils
+import random
+import time
+
+
+# Words used to build subjects and bodies, per charset; each charset gets
+# words it can encode, so that the getter has to decode them
+_WORDS = {
+    'us-ascii': u"the build fails on my machine with this error when I "
+                u"install the package from source again".split(),
+    'utf-8': u"la compilation échoue sur ma machine avec cette erreur "
+             u"quand j'installe le paquet après la mise à jour "
+             u"ビルド エラー".split(),
+    'iso-8859-1': u"die Übersetzung schlägt auf meinem Rechner fehl mit "
+                  u"diesem Fehler nach dem Löschen".split(),
+    'koi8-r': u"сборка падает на моей машине с этой ошибкой после "
+              u"обновления".split(),
+}
+
+DEFAULT_CHARSETS = tuple(sorted(_WORDS))
+
+
+class Generator(object):
+    """Generates a synthetic mailing-list archive.
+
+    Messages start new threads or reply to earlier messages, down to
+    max_depth replies. Some are HTML, some multipart/alternative with both a
+    plain and an HTML part, and they use a mix of charsets. Everything is
+    derived from the seed, so the same parameters give the same archive.
+    """
+    def __init__(self, messages=1000, max_depth=6, posters=50,
+                 html_ratio=0.2, multipart_ratio=0.2,
+                 charsets=DEFAULT_CHARSETS, body_words=150, new_thread=0.3,
+                 seed=0):
+        self.messages = messages
+        self.max_depth = max_depth
+        self.posters = posters
+        self.html_ratio = html_ratio
+        self.multipart_ratio = multipart_ratio
+        self.charsets = charsets
+        self.body_words = body_words
+        self.new_thread = new_thread
+        self.seed = seed
+
+    def poster(self, number):
+        """Returns the (name, address) of a poster.
+        """
+        return ('Poster %d' % number,
+                'poster%d@lists.example.org' % number)
+
+    def _text(self, rand, charset, count):
+        words = _WORDS[charset]
+        return u' '.join(rand.choice(words) for i in xrange(count))
+
+    def _body(self, rand, charset):
+        paragraphs = []
+        remaining = max(1, int(rand.expovariate(1.0 / self.body_words)))
+        while remaining > 0:
+            count = min(remaining, rand.randint(20, 80))
+            paragraphs.append(self._text(rand, charset, count))
+            remaining -= count
+        return paragraphs
+
+    def _html(self, paragraphs):
+        return u'<html><body>%s</body></html>' % u''.join(
+                u'<p>%s</p>' % p.replace(u'&', u'&amp;')
+                                .replace(u'<', u'&lt;')
+                 for p in paragraphs)
+
+    def __iter__(self):
+        """Yields the raw messages, as strings.
+        """
+        rand = random.Random(self.seed)
+        date = datetime(2014, 1, 1)
+        # (message id, subject, references, depth) of earlier messages
+        earlier = []
+        for number in xrange(self.messages):
+            date += timedelta(seconds=rand.randint(1, 3600))
+            charset = rand.choice(self.charsets)
+            paragraphs = self._body(rand, charset)
+
+            kind = rand.random()
+            if kind < self.multipart_ratio:
+                msg = MIMEMultipart('alternative')
+                msg.attach(MIMEText(u'\n\n'.join(paragraphs).encode(charset),
+                                    'plain', charset))
+                msg.attach(MIMEText(self._html(paragraphs).encode(charset),
+                                    'html', charset))
+            elif kind < self.multipart_ratio + self.html_ratio:
+                msg = MIMEText(self._html(paragraphs).encode(charset),
+                               'html', charset)
+            else:
+                msg = MIMEText(u'\n\n'.join(paragraphs).encode(charset),
+                               'plain', charset)
+
+            msgid = '<%d.%d@lists.example.org>' % (self.seed, number)
+            replyable = [m for m in earlier[-200:] if m[3] < self.max_depth]
+            if not replyable or rand.random() < self.new_thread:
+                subject = self._text(rand, charset, rand.randint(3, 8))
+                references = []
+                depth = 0
+            else:
+                parent = rand.choice(replyable)
+                subject = u'Re: ' + parent[1]
+                references = parent[2] + [parent[0]]
+                depth = parent[3] + 1
+                msg['In-Reply-To'] = parent[0]
+                msg['References'] = ' '.join(references[-10:])
+            earlier.append((msgid, subject.replace(u'Re: ', u''),
+                            references, depth))
+
+            name, address = self.poster(rand.randint(1, self.posters))
+            msg['Message-ID'] = msgid
+            msg['From'] = email.utils.formataddr((name, address))
+            msg['Subject'] = Header(subject, charset)
+            msg['Date'] = email.utils.formatdate(
+                    time.mktime(date.timetuple()))
+            yield msg.as_string()
+
+    def write_mbox(self, fileobj):
+        """Writes the archive as an mbox file, with mboxrd quoting.
+
+        Returns the number of messages written.
+        """
+        count = 0
+        for text in self:
+            fileobj.write('From MAILER-DAEMON Thu Jan  1 00:00:00 2014\n')
+            for line in text.split('\n'):
+                if line.lstrip('>').startswith('From '):
+                    line = '>' + line
+                fileobj.write(line + '\n')
+            fileobj.write('\n')
+            count += 1
+        return count
@@ -0,0 +1,492 @@
+import argparse
+import base64
+from datetime import datetime
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+from sqlalchemy.sql import func
+import sys
+import tempfile
+from timeit import default_timer
+
+from internetpoints import config
+from internetpoints.benchmark.generator import DEFAULT_CHARSETS, Generator
+
+
+logger = logging.getLogger(__name__)
+
+
+# Version of the JSON report; change it if the meaning of the fields changes
+REPORT_FORMAT = 1
+
+
+def _generator(args):
+    return Generator(messages=args.messages, max_depth=args.depth,
+                     posters=args.posters, html_ratio=args.html,
+                     multipart_ratio=args.multipart,
+                     charsets=args.charsets.split(','),
+                     seed=args.seed)
+
+
+def _stats(timings):
+    """Summarizes a list of durations, in milliseconds.
+    """
+    timings = sorted(timings)
+    count = len(timings)
+    return dict(count=count,
+                mean=sum(timings) * 1000.0 / count,
+                median=timings[count // 2] * 1000.0,
+                p95=timings[min(count - 1, int(count * 0.95))] * 1000.0,
+                max=timings[-1] * 1000.0)
+
+
+def bench_getter(messages, batch_size):
+    """Measures parsing alone, then parsing and inserting into the database.
+    """
+    from internetpoints.getter.main import ingest, parse_message
+
+    start = default_timer()
+    for text in messages:
+        parse_message(text)
+    parse = default_timer() - start
+
+    start = default_timer()
+    ingest(enumerate(messages), batch_size)
+    total = default_timer() - start
+
+    return dict(messages=len(messages),
+                batch_size=batch_size,
+                workers=getattr(config, 'GETTER_WORKERS', 0),
+                parse_seconds=parse,
+                parse_per_second=len(messages) / parse,
+                ingest_seconds=total,
+                ingest_per_second=len(messages) / total)
+
+
+def setup_votes(generator, tasks=5, assigned=0.3):
+    """Links the generated posters and assigns tasks on some threads.
+
+    Returns the ids of the threads, largest first.
+    """
+    from internetpoints import models, scoring
+    from internetpoints.storage import Session
+    from internetpoints.summaries import rebuild_thread_summaries
+
+    rand = random.Random(generator.seed)
+    sqlsession = Session()
+    try:
+        poster_ids = []
+        for number in xrange(1, generator.posters + 1):
+            name, address = generator.poster(number)
+            poster = models.Poster(name=name)
+            poster.emails.append(models.PosterEmail(address=address))
+            sqlsession.add(poster)
+            sqlsession.flush()
+            poster_ids.append(poster.id)
+        task_ids = []
+        for number in xrange(tasks):
+            task = models.Task(name='Task %d' % number, reward=number + 1)
+            sqlsession.add(task)
+            sqlsession.flush()
+            task_ids.append(task.id)
+
+        thread_ids = [thread_id for thread_id, count in
+                      sqlsession.query(models.Message.thread_id,
+                                       func.count())
+                                .group_by(models.Message.thread_id)
+                                .order_by(func.count().desc(),
+                                          models.Message.thread_id)]
+        for thread_id in thread_ids:
+            if rand.random() < assigned:
+                scoring.assign_task(sqlsession, thread_id,
+                                    rand.choice(task_ids),
+                                    rand.choice(poster_ids))
+        sqlsession.commit()
+        rebuild_thread_summaries(sqlsession)
+    finally:
+        sqlsession.close()
+    return thread_ids
+
+
+def bench_views(thread_ids, requests):
+    """Measures the latency of the main pages through Flask's test client.
+
+    Cached pages are measured twice: with the cache emptied before each
+    request, and served from the cache.
+    """
+    from internetpoints import cache
+    from internetpoints.web import app
+
+    client = app.test_client()
+    headers = {'Authorization': 'Basic ' +
+                                base64.b64encode('benchmark:' +
+                                                 config.PASSWORD)}
+
+    def measure(urls, clear):
+        timings = []
+        for url in urls:
+            if clear:
+                cache.clear()
+            start = default_timer()
+            response = client.get(url, headers=headers)
+            timings.append(default_timer() - start)
+            if response.status_code != 200:
+                raise RuntimeError("%s returned %d" % (
+                                   url, response.status_code))
+        return _stats(timings)
+
+    results = {}
+    for url in ('/scores', '/vote'):
+        results[url] = dict(cold=measure([url] * requests, True),
+                            cached=measure([url] * requests, False))
+    # The largest threads, and a sample of the others
+    rand = random.Random(0)
+    urls = ['/thread/%d' % thread_id
+            for thread_id in thread_ids[:requests // 2] +
+                             rand.sample(thread_ids,
+                                         min(len(thread_ids),
+                                             requests - requests // 2))]
+    results['/thread/<id>'] = dict(largest=measure(urls[:requests // 2],
+                                                   False),
+                                   sample=measure(urls[requests // 2:],
+                                                  False))
+    return results
+
+
+def _setup_database(args):
+    """Points the configuration at the database to use, and checks it's empty.
+
+    Returns the temporary directory to remove afterwards, if one was created.
+    """
+    directory = None
+    if args.database is None:
+        directory = tempfile.mkdtemp(prefix='internetpoints-benchmark-')
+        args.database = 'sqlite:///' + os.path.join(directory,
+                                                    'database.sqlite3')
+    # This has to happen before internetpoints.storage is imported
+    config.DATABASE_URI = args.database
+    config.DATABASE_READ_URI = None
+    if args.workers is not None:
+        config.GETTER_WORKERS = args.workers
+
+    from internetpoints import models
+    from internetpoints.storage import Session
+
+    sqlsession = Session()
+    try:
+        if sqlsession.query(models.Poster.id).first() is not None or \
+                sqlsession.query(models.Message.id).first() is not None:
+            sys.stderr.write("The benchmark needs an empty database\n")
+            if directory is not None:
+                shutil.rmtree(directory)
+            sys.exit(1)
+    finally:
+        sqlsession.close()
+    return directory
+
+
+def run(args):
+    """Runs all the benchmarks on a new database, and reports as JSON.
+    """
+    directory = _setup_database(args)
+    try:
+        from internetpoints.storage import engine
+
+        generator = _generator(args)
+        messages = list(generator)
+        report = dict(format=REPORT_FORMAT,
+                      date=datetime.utcnow().isoformat(),
+                      python=platform.python_version(),
+                      database=engine.dialect.name,
+                      parameters=dict(messages=args.messages,
+                                      depth=args.depth,
+                                      posters=args.posters,
+                                      html=args.html,
+                                      multipart=args.multipart,
+                                      charsets=args.charsets,
+                                      seed=args.seed,
+                                      requests=args.requests))
+
+        logger.info("Benchmarking the getter with %d messages" % (
+                    len(messages),))
+        report['getter'] = bench_getter(messages, args.batch_size)
+        del messages
+
+        thread_ids = setup_votes(generator)
+        report['getter']['threads'] = len(thread_ids)
+        logger.info("Benchmarking the views, %d threads" % len(thread_ids))
+        report['views'] = bench_views(thread_ids, args.requests)
+    finally:
+        if directory is not None:
+            shutil.rmtree(directory)
+
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    else:
+        with open(args.output, 'w') as fp:
+            json.dump(report, fp, indent=2, sort_keys=True)
+
+
+def _stress_getter(messages, batch_size):
+    """Inserts messages with the getter, one batch at a time.
+    """
+    from internetpoints.getter.main import insert_batch, parse_message
+    from internetpoints.getter.threader import ThreadIndex
+    from internetpoints.storage import engine
+
+    # Don't share the parent's connections
+    engine.dispose()
+    index = ThreadIndex()
+    for i in xrange(0, len(messages), batch_size):
+        insert_batch([parse_message(text)
+                      for text in messages[i:i + batch_size]],
+                     index)
+    return len(messages)
+
+
+def _stress_votes(seed, operations):
+    """Assigns and unassigns tasks and changes rewards, at random.
+
+    Returns the number of operations of each kind that did something.
+    """
+    from sqlalchemy.exc import IntegrityError
+    from internetpoints import models, scoring
+    from internetpoints.storage import Session, engine, transaction
+
+    engine.dispose()
+    rand = random.Random(seed)
+    counts = dict(assign=0, assign_batch=0, unassign=0, reassign=0, reward=0,
+                  conflicts=0)
+    sqlsession = Session()
+    try:
+        poster_ids = [poster_id
+                      for poster_id, in sqlsession.query(models.Poster.id)]
+        task_ids = [task_id for task_id, in sqlsession.query(models.Task.id)]
+        sqlsession.rollback()
+
+        def pick(sqlsession):
+            last, = sqlsession.query(func.max(models.Thread.id)).one()
+            return (rand.randint(1, last or 1), rand.choice(task_ids),
+                    rand.choice(poster_ids))
+
+        def assign(sqlsession):
+            return scoring.assign_task(sqlsession, *pick(sqlsession))
+
+        def assign_batch(sqlsession):
+            results = scoring.assign_tasks(sqlsession,
+                                           [pick(sqlsession)
+                                            for i in xrange(5)])
+            return 'assigned' in results
+
+        def unassign(sqlsession):
+            thread_id, task_id, poster_id = pick(sqlsession)
+            return scoring.unassign_task(sqlsession, thread_id, task_id)
+
+        # Some tasks are unassigned and given to someone else over and over,
+        # so that the other processes see them change hands
+        hot = [(thread_id, task_ids[0]) for thread_id in xrange(1, 4)]
+
+        def unassign_hot(sqlsession):
+            return scoring.unassign_task(sqlsession, *rand.choice(hot))
+
+        def reassign(sqlsession):
+            thread_id, task_id = rand.choice(hot)
+            poster_id = (sqlsession.query(models.TaskAssignation.poster_id)
+                                   .filter(models.TaskAssignation.thread_id ==
+                                           thread_id)
+                                   .filter(models.TaskAssignation.task_id ==
+                                           task_id)).scalar()
+            if poster_id is not None:
+                scoring.unassign_task(sqlsession, thread_id, task_id)
+            others = [other for other in poster_ids if other != poster_id]
+            return scoring.assign_task(sqlsession, thread_id, task_id,
+                                       rand.choice(others))
+
+        def reward(sqlsession):
+            scoring.set_reward(sqlsession, rand.choice(task_ids),
+                               rand.randint(1, 10))
+            return True
+
+        for i in xrange(operations):
+            choice = rand.random()
+            if choice < 0.5:
+                kind, func_ = 'assign', assign
+            elif choice < 0.6:
+                kind, func_ = 'assign_batch', assign_batch
+            elif choice < 0.75:
+                kind, func_ = 'unassign', unassign
+            elif choice < 0.85:
+                kind, func_ = 'unassign', unassign_hot
+            elif choice < 0.95:
+                kind, func_ = 'reassign', reassign
+            else:
+                kind, func_ = 'reward', reward
+            try:
+                if transaction(sqlsession, func_):
+                    counts[kind] += 1
+            except IntegrityError:
+                # The task was already assigned on that thread
+                counts['conflicts'] += 1
+    finally:
+        sqlsession.close()
+    return counts
+
+
+def stress(args):
+    """Runs the getter and task assignations from several processes at once,
+    then checks the scores against the ledger.
+
+    Exits with status 1 if they don't match, or if messages were lost.
+    """
+    import multiprocessing
+
+    directory = _setup_database(args)
+    try:
+        from internetpoints import models, scoring
+        from internetpoints.storage import Session
+
+        generator = _generator(args)
+        messages = list(generator)
+        setup_votes(generator, assigned=0)
+
+        logger.info("Running %d getter and %d voting processes" % (
+                    args.getters, args.voters))
+        start = default_timer()
+        pool = multiprocessing.Pool(args.getters + args.voters)
+        try:
+            batches = [messages[i:i + args.batch_size]
+                       for i in xrange(0, len(messages), args.batch_size)]
+            getters = [pool.apply_async(_stress_getter,
+                                        (sum(batches[n::args.getters], []),
+                                         args.batch_size))
+                       for n in xrange(args.getters)]
+            voters = [pool.apply_async(_stress_votes,
+                                       (args.seed + n, args.operations))
+                      for n in xrange(args.voters)]
+            for result in getters:
+                result.get()
+            counts = {}
+            for result in voters:
+                for kind, count in result.get().iteritems():
+                    counts[kind] = counts.get(kind, 0) + count
+        finally:
+            pool.terminate()
+            pool.join()
+        seconds = default_timer() - start
+
+        sqlsession = Session()
+        try:
+            stored = sqlsession.query(models.Message).count()
+            mismatches = scoring.check_scores(sqlsession)
+            report = dict(seconds=seconds,
+                          messages=len(messages),
+                          stored_messages=stored,
+                          threads=sqlsession.query(models.Thread).count(),
+                          assignations=(sqlsession
+                                        .query(models.TaskAssignation)
+                                        .count()),
+                          operations=counts,
+                          mismatches=[
+                              [poster_id,
+                               month.isoformat() if month else None,
+                               score, expected]
+                              for poster_id, month, score, expected
+                              in mismatches])
+        finally:
+            sqlsession.close()
+    finally:
+        if directory is not None:
+            shutil.rmtree(directory)
+
+    json.dump(report, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+    if mismatches or stored != len(messages):
+        sys.stderr.write("Scores don't match the ledger, or messages were "
+                         "lost\n")
+        sys.exit(1)
+
+
+def generate(args):
+    """Writes a synthetic archive to an mbox file.
+    """
+    if len(args.paths) != 1:
+        sys.stderr.write("generate needs the mbox file to write\n")
+        sys.exit(2)
+    with open(args.paths[0], 'wb') as fp:
+        count = _generator(args).write_mbox(fp)
+    logger.info("Wrote %d messages to %s" % (count, args.paths[0]))
+
+
+COMMANDS = {
+    'generate': generate,
+    'run': run,
+    'stress': stress,
+}
+
+
+def main(args=None):
+    logging.basicConfig(level=logging.INFO)
+    # The getter logs every batch
+    logging.getLogger('internetpoints.getter').setLevel(logging.WARNING)
+
+    parser = argparse.ArgumentParser(prog='internetpoints.benchmark')
+    parser.add_argument('command', nargs='?', default='run',
+                        choices=sorted(COMMANDS),
+                        help="what to do (default: run)")
+    parser.add_argument('paths', nargs='*',
+                        help="mbox file to write (generate)")
+    group = parser.add_argument_group("synthetic archive")
+    group.add_argument('--messages', type=int, default=2000,
+                       help="number of messages (default: %(default)s)")
+    group.add_argument('--depth', type=int, default=6,
+                       help="maximum depth of replies (default: "
+                            "%(default)s)")
+    group.add_argument('--posters', type=int, default=50,
+                       help="number of posters (default: %(default)s)")
+    group.add_argument('--html', type=float, default=0.2,
+                       help="ratio of HTML messages (default: %(default)s)")
+    group.add_argument('--multipart', type=float, default=0.2,
+                       help="ratio of multipart/alternative messages "
+                            "(default: %(default)s)")
+    group.add_argument('--charsets', default=','.join(DEFAULT_CHARSETS),
+                       help="charsets to use, comma-separated (default: "
+                            "%(default)s)")
+    group.add_argument('--seed', type=int, default=0,
+                       help="random seed (default: %(default)s)")
+    group = parser.add_argument_group("benchmark")
+    group.add_argument('--database',
+                       help="database URI to use; it must be empty "
+                            "(default: a temporary SQLite database)")
+    group.add_argument('--batch-size', type=int,
+                       default=getattr(config, 'GETTER_BATCH_SIZE', 500),
+                       help="getter batch size (default: %(default)s)")
+    group.add_argument('--workers', type=int,
+                       help="getter parsing processes (default: "
+                            "GETTER_WORKERS)")
+    group.add_argument('--requests', type=int, default=50,
+                       help="requests per view (default: %(default)s)")
+    group.add_argument('--output',
+                       help="file to write the JSON report to (default: "
+                            "standard output)")
+    group = parser.add_argument_group("stress test")
+    group.add_argument('--getters', type=int, default=2,
+                       help="processes inserting messages (default: "
+                            "%(default)s)")
+    group.add_argument('--voters', type=int, default=4,
+                       help="processes assigning tasks (default: "
+                            "%(default)s)")
+    group.add_argument('--operations', type=int, default=300,
+                       help="assignations, removals and reward changes per "
+                            "voting process (default: %(default)s)")
+    args = parser.parse_args(args)
+
+    for charset in args.charsets.split(','):
+        if charset not in DEFAULT_CHARSETS:
+            parser.error("unknown charset %r, choose from %s" % (
+                         charset, ', '.join(DEFAULT_CHARSETS)))
+
+    COMMANDS[args.command](args)
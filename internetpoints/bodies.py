@@ -0,0 +1,478 @@
+import hashlib
+import json
+import logging
+from sqlalchemy.orm import aliased
+from sqlalchemy.sql import and_, func, or_
+import zlib
+
+from internetpoints import models
+from internetpoints.storage import chunks
+
+
+logger = logging.getLogger(__name__)
+
+
+# Compressed storage of the message bodies.
+#
+# If COMPRESS_MESSAGES is set, the getter stores the bodies in the
+# message_blobs table instead of Message.text, which is left empty. A body is
+# a list of segments: literal text, and quotes of a parent message, i.e. a
+# range of its lines with a quoting prefix, which is where most of the text of
+# a mailing list is. The list is compressed with zlib, and stored under its
+# hash, so identical bodies are only stored once.
+#
+# Quotes are only used if they give back the exact same text, so what is
+# shown is always what was received.
+
+# Quoting styles, as (prefix, empty line); '>' also catches nested quotes
+# written as '>> '
+_STYLES = ((u'> ', u'>'), (u'> ', u'> '), (u'>', u'>'))
+# Shorter quotes are kept as text
+_MIN_QUOTE_LINES = 2
+# Quotes are looked for in the messages given last in the references, which
+# are the closest ancestors
+_MAX_PARENTS = 3
+# A body only quotes messages that are less than this many quotes away from a
+# text stored whole, so that rebuilding a text reads a bounded number of
+# bodies, however deep the thread
+_MAX_QUOTE_DEPTH = 3
+_COMPRESSION_LEVEL = 6
+
+
+def _quote(line, prefix, empty):
+    if line:
+        return prefix + line
+    else:
+        return empty
+
+
+def encode(text, parents):
+    """Splits a text into literal lines and quotes of its parents.
+
+    parents is a dict of message ids to texts. Returns a list of segments,
+    each either a string or a [parent id, start line, end line, prefix, empty
+    line] list.
+    """
+    lines = text.split(u'\n')
+    quotings = []
+    for parent_id, parent_text in sorted(parents.iteritems()):
+        parent_lines = parent_text.split(u'\n')
+        for prefix, empty in _STYLES:
+            quoted = [_quote(line, prefix, empty) for line in parent_lines]
+            positions = {}
+            for i, line in enumerate(quoted):
+                positions.setdefault(line, []).append(i)
+            quotings.append((parent_id, prefix, empty, quoted, positions))
+
+    segments = []
+    literal = []
+    k = 0
+    while k < len(lines):
+        best = None
+        # Don't start quotes on empty lines, they match everywhere
+        if lines[k].startswith(u'>') and len(lines[k]) > 2:
+            for parent_id, prefix, empty, quoted, positions in quotings:
+                for start in positions.get(lines[k], ()):
+                    n = 1
+                    while (k + n < len(lines) and start + n < len(quoted) and
+                           lines[k + n] == quoted[start + n]):
+                        n += 1
+                    if best is None or n > best[0]:
+                        best = n, [parent_id, start, start + n,
+                                   prefix, empty]
+        if best is not None and best[0] >= _MIN_QUOTE_LINES:
+            if literal:
+                segments.append(u'\n'.join(literal))
+                literal = []
+            segments.append(best[1])
+            k += best[0]
+        else:
+            literal.append(lines[k])
+            k += 1
+    if literal:
+        segments.append(u'\n'.join(literal))
+    return segments
+
+
+def join(segments, texts):
+    """Rebuilds a text from its segments, given the texts of its parents.
+    """
+    parts = []
+    for segment in segments:
+        if isinstance(segment, basestring):
+            parts.append(segment)
+        else:
+            parent_id, start, end, prefix, empty = segment
+            parts.extend(_quote(line, prefix, empty)
+                         for line in texts[parent_id].split(u'\n')[start:end])
+    return u'\n'.join(parts)
+
+
+def _blob(segments):
+    data = json.dumps(segments, separators=(',', ':'))
+    return (hashlib.sha1(data).hexdigest(),
+            zlib.compress(data, _COMPRESSION_LEVEL))
+
+
+def _segments(data):
+    return json.loads(zlib.decompress(data))
+
+
+def _parents(segments):
+    return set(segment[0] for segment in segments
+               if not isinstance(segment, basestring))
+
+
+def _order(message_ids, segments, texts):
+    """Returns the messages to rebuild to get these texts, parents first.
+
+    The messages already in texts are left out.
+    """
+    # Depth-first, each message being listed after its parents; visiting
+    # holds the messages whose parents are being listed, i.e. the path from
+    # the message we started from, so that a message quoting itself is
+    # detected
+    order = []
+    done = set()
+    for message_id in message_ids:
+        stack = [(message_id, False)]
+        visiting = set()
+        while stack:
+            current, expanded = stack.pop()
+            if current in texts or current in done:
+                continue
+            if expanded:
+                order.append(current)
+                done.add(current)
+                visiting.discard(current)
+                continue
+            if current in visiting:
+                raise ValueError("Can't rebuild the text of message %r, it "
+                                 "quotes itself" % (current,))
+            visiting.add(current)
+            stack.append((current, True))
+            for parent_id in _parents(segments[current]):
+                if parent_id in texts or parent_id in done:
+                    continue
+                if parent_id not in segments:
+                    raise ValueError("Can't rebuild the text of message %r, "
+                                     "quoted message %r is missing" % (
+                                     current, parent_id))
+                stack.append((parent_id, False))
+    return order
+
+
+def _resolve(message_id, segments, texts):
+    """Rebuilds a text, and those of the parents it quotes first.
+    """
+    for current in _order([message_id], segments, texts):
+        texts[current] = join(segments[current], texts)
+
+
+def _load(sqlsession, message_ids, texts, depths=None):
+    """Reads the bodies of messages, and of the messages they quote.
+
+    The texts stored whole are put in texts, with a depth of 0 in depths if
+    given. Returns the segments of the others.
+    """
+    segments = {}
+    pending = set(message_ids).difference(texts)
+    while pending:
+        loaded = []
+        for chunk in chunks(list(pending)):
+            query = (sqlsession.query(models.Message.id, models.Message.text,
+                                      models.MessageBlob.data)
+                               .outerjoin(models.MessageBody,
+                                          models.MessageBody.message_id ==
+                                          models.Message.id)
+                               .outerjoin(models.MessageBlob,
+                                          models.MessageBlob.hash ==
+                                          models.MessageBody.blob_hash)
+                               .filter(models.Message.id.in_(chunk)))
+            for message_id, text, data in query:
+                if data is None:
+                    texts[message_id] = text
+                    if depths is not None:
+                        depths[message_id] = 0
+                else:
+                    segments[message_id] = _segments(data)
+                    loaded.append(message_id)
+        pending = set(parent_id
+                      for message_id in loaded
+                      for parent_id in _parents(segments[message_id]))
+        pending.difference_update(texts, segments)
+    return segments
+
+
+def _depth(segments, depths):
+    """Number of quotes between a body and a text stored whole.
+    """
+    parents = _parents(segments)
+    if not parents:
+        return 0
+    return 1 + max(depths.get(parent_id, 0) for parent_id in parents)
+
+
+def load_texts(sqlsession, message_ids, texts=None, depths=None):
+    """Gets the full text of messages, however they are stored.
+
+    Returns a dict of message ids to texts. The texts of the quoted messages
+    are loaded as well; pass the same dict as texts to reuse them over several
+    calls. If depths is given, it gets the depth of each text loaded, see
+    _MAX_QUOTE_DEPTH.
+    """
+    if texts is None:
+        texts = {}
+    segments = _load(sqlsession, message_ids, texts, depths)
+    for message_id in _order(list(segments), segments, texts):
+        texts[message_id] = join(segments[message_id], texts)
+        if depths is not None:
+            depths[message_id] = _depth(segments[message_id], depths)
+    return dict((message_id, texts[message_id])
+                for message_id in message_ids
+                if message_id in texts)
+
+
+def _join_lines(segments, lines, count):
+    """Rebuilds the first count lines of a text from its segments.
+
+    lines has the lines of the parents, at least as many as these ones quote.
+    """
+    result = []
+    for segment in segments:
+        if len(result) >= count:
+            break
+        if isinstance(segment, basestring):
+            result.extend(segment.split(u'\n'))
+        else:
+            parent_id, start, end, prefix, empty = segment
+            end = min(end, start + count - len(result))
+            result.extend(_quote(line, prefix, empty)
+                          for line in lines[parent_id][start:end])
+    return result[:count]
+
+
+def _beginnings(message_ids, segments, texts, size):
+    """Rebuilds the first size characters of some texts.
+
+    Only the lines of the quoted texts that are needed are rebuilt.
+    """
+    order = _order([message_id for message_id in message_ids
+                    if message_id in segments],
+                   segments, texts)
+    # size characters are at most size + 1 lines; count, from the messages
+    # down to the ones they quote, how many lines of each are needed
+    needed = dict((message_id, size + 1) for message_id in message_ids)
+    for current in reversed(order):
+        count = needed.get(current, 0)
+        for segment in segments[current]:
+            if count <= 0:
+                break
+            if isinstance(segment, basestring):
+                count -= segment.count(u'\n') + 1
+            else:
+                parent_id, start, end = segment[:3]
+                taken = min(end - start, count)
+                needed[parent_id] = max(needed.get(parent_id, 0),
+                                        start + taken)
+                count -= taken
+    lines = {}
+    for message_id, count in needed.iteritems():
+        if message_id in texts:
+            lines[message_id] = texts[message_id].split(u'\n', count)[:count]
+    for current in order:
+        lines[current] = _join_lines(segments[current], lines,
+                                     needed.get(current, 0))
+    beginnings = {}
+    for message_id in message_ids:
+        if message_id in texts:
+            beginnings[message_id] = texts[message_id][:size]
+        elif message_id in lines:
+            beginnings[message_id] = u'\n'.join(lines[message_id])[:size]
+    return beginnings
+
+
+def load_previews(sqlsession, message_ids, size):
+    """Gets the first size characters of the text of messages.
+
+    Returns a dict of message ids to texts. Unlike load_texts(), the texts are
+    not rebuilt whole.
+    """
+    texts = {}
+    segments = _load(sqlsession, message_ids, texts)
+    return _beginnings(message_ids, segments, texts, size)
+
+
+def _store(sqlsession, records, texts, depths):
+    """Writes the bodies of messages, whose text is already in texts.
+
+    depths has the depth of the texts, and gets that of the new bodies.
+    """
+    blobs = {}
+    rows = []
+    for record in records:
+        text = record['text']
+        parents = dict((parent_id, texts[parent_id])
+                       for parent_id in record['references']
+                       if parent_id in texts and parent_id != record['id'] and
+                       depths.get(parent_id, 0) < _MAX_QUOTE_DEPTH)
+        segments = encode(text, parents)
+        if join(segments, parents) != text:
+            logger.warning("Couldn't split message %r in quotes, storing "
+                           "it whole" % (record['id'],))
+            segments = [text]
+        depths[record['id']] = _depth(segments, depths)
+        digest, data = _blob(segments)
+        blobs[digest] = data
+        rows.append(dict(message_id=record['id'], blob_hash=digest,
+                         length=len(text)))
+
+    digests = list(blobs)
+    for chunk in chunks(digests):
+        for digest, in (sqlsession.query(models.MessageBlob.hash)
+                                  .filter(models.MessageBlob.hash.in_(chunk))):
+            del blobs[digest]
+    if blobs:
+        sqlsession.execute(models.MessageBlob.__table__.insert(),
+                           [dict(hash=digest, data=blob)
+                            for digest, blob in blobs.iteritems()])
+    if rows:
+        sqlsession.execute(models.MessageBody.__table__.insert(), rows)
+    logger.debug("Stored %d bodies, %d new blobs" % (len(rows), len(blobs)))
+
+
+def store_texts(sqlsession, records):
+    """Stores the bodies of new messages compressed.
+
+    records is a list of dicts with id, text and references, whose messages
+    have already been inserted with an empty text. This doesn't commit.
+    """
+    batch_ids = set(record['id'] for record in records)
+    # A message of the batch can only quote those before it, so that two
+    # messages can't quote each other
+    previous = set()
+    trimmed = []
+    for record in records:
+        references = [parent_id
+                      for parent_id in record['references'][-_MAX_PARENTS:]
+                      if parent_id not in batch_ids or parent_id in previous]
+        trimmed.append(dict(record, references=references))
+        previous.add(record['id'])
+    records = trimmed
+    texts = dict((record['id'], record['text']) for record in records)
+    parent_ids = set(parent_id
+                     for record in records
+                     for parent_id in record['references'])
+    # The messages of this batch don't have their body yet
+    depths = {}
+    texts.update(load_texts(sqlsession,
+                            list(parent_ids.difference(texts)),
+                            depths=depths))
+    _store(sqlsession, records, texts, depths)
+
+
+def convert(sqlsession, compress, batch_size=500):
+    """Moves the existing bodies to compressed storage, or back.
+
+    Commits after each batch, so it can be interrupted and run again. Returns
+    the number of messages converted.
+    """
+    Message = models.Message
+    MessageBody = models.MessageBody
+    count = 0
+    last = None
+    while True:
+        query = (sqlsession.query(Message.id, Message.date)
+                           .outerjoin(MessageBody,
+                                      MessageBody.message_id == Message.id)
+                           .order_by(Message.date, Message.id))
+        if compress:
+            query = query.filter(MessageBody.message_id == None)
+        else:
+            query = query.filter(MessageBody.message_id != None)
+        # Paginate on columns we don't change; oldest first, so that the
+        # messages a body quotes are converted before it, and their depth is
+        # known
+        if last is not None:
+            last_date, last_id = last
+            query = query.filter(or_(Message.date > last_date,
+                                     and_(Message.date == last_date,
+                                          Message.id > last_id)))
+        rows = query.limit(batch_size).all()
+        if not rows:
+            break
+        last = rows[-1].date, rows[-1].id
+        message_ids = [message_id for message_id, date in rows]
+
+        if compress:
+            # The order of the references isn't stored, so all of them are
+            # searched for quotes; only older messages are used, so that two
+            # messages can't quote each other
+            Referenced = aliased(Message)
+            references = {}
+            for chunk in chunks(message_ids):
+                for message_id, referenced_id in (
+                        sqlsession.query(
+                            models.MessageReference.message_id,
+                            models.MessageReference.referenced_id)
+                        .join(Message, Message.id ==
+                              models.MessageReference.message_id)
+                        .join(Referenced, Referenced.id ==
+                              models.MessageReference.referenced_id)
+                        .filter(models.MessageReference.message_id.in_(
+                            chunk))
+                        .filter(Referenced.date < Message.date)):
+                    references.setdefault(message_id, []).append(
+                            referenced_id)
+            depths = {}
+            texts = load_texts(
+                    sqlsession,
+                    message_ids +
+                    list(set(referenced_id
+                             for refs in references.itervalues()
+                             for referenced_id in refs)),
+                    depths=depths)
+            records = [dict(id=message_id, text=texts[message_id],
+                            references=references.get(message_id, []))
+                       for message_id in message_ids]
+            _store(sqlsession, records, texts, depths)
+            for chunk in chunks(message_ids):
+                (sqlsession.query(Message)
+                           .filter(Message.id.in_(chunk))
+                           .update(dict(text=u''),
+                                   synchronize_session=False))
+        else:
+            texts = load_texts(sqlsession, message_ids)
+            for message_id in message_ids:
+                (sqlsession.query(Message)
+                           .filter(Message.id == message_id)
+                           .update(dict(text=texts[message_id]),
+                                   synchronize_session=False))
+            for chunk in chunks(message_ids):
+                (sqlsession.query(MessageBody)
+                           .filter(MessageBody.message_id.in_(chunk))
+                           .delete(synchronize_session=False))
+        sqlsession.commit()
+        count += len(message_ids)
+        logger.info("Converted %d messages" % count)
+
+    if not compress:
+        # Remove the blobs that are no longer used
+        used = sqlsession.query(MessageBody.blob_hash)
+        (sqlsession.query(models.MessageBlob)
+                   .filter(~models.MessageBlob.hash.in_(used))
+                   .delete(synchronize_session=False))
+        sqlsession.commit()
+    return count
+
+
+def storage_stats(sqlsession):
+    """Returns (messages stored compressed, their length, size of blobs).
+    """
+    messages, length = sqlsession.query(
+            func.count(models.MessageBody.message_id),
+            func.coalesce(func.sum(models.MessageBody.length), 0)).one()
+    size, = sqlsession.query(
+            func.coalesce(func.sum(func.length(models.MessageBlob.data)),
+                          0)).one()
+    return messages, length, size
@@ -0,0 +1,93 @@
+from collections import OrderedDict
+from datetime import datetime
+import threading
+import time
+
+from internetpoints import config, models
+from internetpoints.storage import ReadSession
+
+
+# Cached pages are tagged with a generation number, stored in the database
+# so that every process sees it. Anything that changes what the pages show
+# calls invalidate() in its transaction, which bumps the generation and
+# makes every cached page stale at once.
+
+_lock = threading.Lock()
+_generation = None
+_generation_read = 0
+_pages = OrderedDict()
+
+
+def invalidate(sqlsession):
+    """Marks all cached pages as stale.
+
+    This doesn't commit; it should be called in the transaction that changes
+    the data.
+    """
+    global _generation_read
+
+    table = models.CacheGeneration.__table__
+    updated = sqlsession.execute(
+            table.update()
+                 .where(table.c.id == 1)
+                 .values(generation=table.c.generation + 1,
+                         changed=datetime.utcnow())).rowcount
+    if not updated:
+        sqlsession.execute(table.insert(),
+                           dict(id=1, generation=1,
+                                changed=datetime.utcnow()))
+    # Read it again next time in this process
+    _generation_read = 0
+
+
+def current_generation():
+    """Returns the current generation and the date it changed (UTC).
+
+    The value is only read from the database every CACHE_TTL seconds.
+    """
+    global _generation, _generation_read
+
+    now = time.time()
+    if now - _generation_read < getattr(config, 'CACHE_TTL', 2):
+        return _generation
+    sqlsession = ReadSession()
+    try:
+        row = (sqlsession.query(models.CacheGeneration.generation,
+                                models.CacheGeneration.changed)
+                         .filter(models.CacheGeneration.id == 1)).first()
+    finally:
+        sqlsession.close()
+    if row is None:
+        row = 0, None
+    _generation, _generation_read = tuple(row), now
+    return _generation
+
+
+def get_page(key, generation):
+    """Gets a cached page, if it is from the given generation.
+    """
+    with _lock:
+        entry = _pages.get(key)
+        if entry is None or entry[0] != generation:
+            return None
+        # Move it to the end, so it gets evicted last
+        del _pages[key]
+        _pages[key] = entry
+        return entry[1]
+
+
+def set_page(key, generation, page):
+    """Caches a page, evicting the least recently used ones if needed.
+    """
+    with _lock:
+        _pages.pop(key, None)
+        _pages[key] = generation, page
+        while len(_pages) > getattr(config, 'CACHE_SIZE', 200):
+            _pages.popitem(last=False)
+
+
+def clear():
+    """Drops all the cached pages of this process.
+    """
+    with _lock:
+        _pages.clear()
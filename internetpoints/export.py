@@ -0,0 +1,406 @@
+from datetime import datetime
+from flask import url_for as _url_for
+import hashlib
+import json
+import logging
+import os
+from sqlalchemy.sql import and_, or_
+import tempfile
+
+from internetpoints import cache, config, models, scoring
+from internetpoints.storage import ReadSession
+from internetpoints.web import app, paginate, thread_context
+
+
+logger = logging.getLogger(__name__)
+
+
+# Static export of the public pages.
+#
+# The leaderboard, the lists of threads and the thread pages are rendered
+# with the application's templates, read-only, and written along with JSON
+# versions to a directory that the web server can serve directly. Files are
+# replaced atomically, so readers never see a partial page.
+#
+# The state of the last export is kept in that directory. A thread page is
+# only rendered again if it got new messages, if its task assignations or
+# their rewards changed, or if posters were renamed or got new addresses.
+
+STATE_FILE = '.export-state.json'
+# Version of the layout and of the state file; change it to make the next
+# export rewrite everything
+_FORMAT = 3
+
+
+class _AtomicFile(object):
+    """A file written under a temporary name.
+
+    commit() renames it to its path, unless the file there already has the
+    same content.
+    """
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        fd, self.temp = tempfile.mkstemp(dir=directory, prefix='.export-')
+        self.fp = os.fdopen(fd, 'wb')
+        self.path = path
+
+    def write(self, data):
+        self.fp.write(data)
+
+    def commit(self):
+        """Returns True if the file was replaced.
+        """
+        self.fp.close()
+        if _same_content(self.temp, self.path):
+            os.remove(self.temp)
+            return False
+        os.chmod(self.temp, 0644)
+        os.rename(self.temp, self.path)
+        return True
+
+    def discard(self):
+        self.fp.close()
+        _remove(self.temp)
+
+
+def _same_content(path, other):
+    try:
+        with open(path, 'rb') as fp, open(other, 'rb') as other_fp:
+            while True:
+                data = fp.read(65536)
+                if data != other_fp.read(65536):
+                    return False
+                if not data:
+                    return True
+    except IOError:
+        return False
+
+
+def _write(path, chunks):
+    """Writes a file atomically, unless it already has this content.
+
+    chunks is a string, or an iterable of strings. Returns True if the file
+    was written.
+    """
+    if isinstance(chunks, str):
+        chunks = [chunks]
+    atomic = _AtomicFile(path)
+    try:
+        for data in chunks:
+            atomic.write(data)
+    except:
+        atomic.discard()
+        raise
+    return atomic.commit()
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _date(date):
+    return date.isoformat() if date is not None else None
+
+
+def _json(obj):
+    return json.dumps(obj, sort_keys=True, separators=(',', ':'))
+
+
+def _thread_fingerprints(sqlsession):
+    Summary = models.ThreadSummary
+    Assignation = models.TaskAssignation
+    keys = {}
+    for thread_id, last_msg, count in (
+            sqlsession.query(Summary.thread_id, Summary.last_msg,
+                             Summary.message_count)):
+        keys[thread_id] = [u'%s|%d' % (_date(last_msg), count)]
+    # The page shows who got each task, its name and its reward
+    for thread_id, task_id, poster_id, date, name, reward in (
+            sqlsession.query(Assignation.thread_id, Assignation.task_id,
+                             Assignation.poster_id, Assignation.date,
+                             models.Task.name, models.Task.reward)
+                      .join(models.Task, models.Task.id ==
+                            Assignation.task_id)
+                      .order_by(Assignation.thread_id, Assignation.task_id)):
+        if thread_id in keys:
+            keys[thread_id].append(u'%d|%d|%s|%s|%d' % (
+                                   task_id, poster_id, _date(date), name,
+                                   reward))
+    return dict((str(thread_id),
+                 hashlib.sha1(u'\n'.join(key).encode('utf-8'))
+                        .hexdigest()[:16])
+                for thread_id, key in keys.iteritems())
+
+
+def _posters_fingerprint(sqlsession):
+    digest = hashlib.sha1()
+    for poster_id, name in (sqlsession.query(models.Poster.id,
+                                             models.Poster.name)
+                                      .order_by(models.Poster.id)):
+        digest.update((u'%d %s\n' % (poster_id, name)).encode('utf-8'))
+    for address, poster_id in (sqlsession.query(models.PosterEmail.address,
+                                                models.PosterEmail.poster_id)
+                                         .order_by(
+                                             models.PosterEmail.address)):
+        digest.update((u'%s %d\n' % (address, poster_id)).encode('utf-8'))
+    return digest.hexdigest()
+
+
+class Exporter(object):
+    """Renders the public pages to a directory.
+    """
+    def __init__(self, directory, sqlsession, prefix='/'):
+        self.directory = directory
+        self.sqlsession = sqlsession
+        self.prefix = prefix
+        self.written = 0
+
+    def url_for(self, endpoint, **values):
+        """Replaces flask.url_for() in the templates, to link static pages.
+
+        Other pages link to the application.
+        """
+        if endpoint == 'scores':
+            page = values.get('period') or values.get('after') or 1
+            return '%sscores/%s.html' % (self.prefix, page)
+        elif endpoint == 'vote':
+            if values.get('unassigned'):
+                directory = 'unassigned'
+            else:
+                directory = 'threads'
+            return '%s%s/%s.html' % (self.prefix, directory,
+                                     values.get('after') or 'index')
+        elif endpoint == 'thread':
+            return '%sthread/%d.html' % (self.prefix, values['thread_id'])
+        return _url_for(endpoint, **values)
+
+    def write(self, name, data):
+        if _write(os.path.join(self.directory, name), data):
+            self.written += 1
+
+    def render(self, template_name, **context):
+        return ''.join(self.stream(template_name, **context))
+
+    def stream(self, template_name, **context):
+        """Renders a template progressively, like web.stream_template().
+        """
+        context.update(readonly=True, url_for=self.url_for)
+        app.update_template_context(context)
+        template = app.jinja_env.get_template(template_name)
+        for data in template.generate(context):
+            yield data.encode('utf-8')
+
+    def export_thread(self, thread_id):
+        """Writes the page of a thread, and its JSON version.
+
+        The messages are read once, as the page is rendered, and not kept:
+        both files are written as they go.
+        """
+        context = thread_context(self.sqlsession, thread_id, None)
+        thread = context['thread']
+        data = _AtomicFile(os.path.join(self.directory,
+                                        'thread/%d.json' % thread_id))
+
+        def messages(rows):
+            for i, (msg, text, length) in enumerate(rows):
+                if i:
+                    data.write(',')
+                data.write(_json(dict(
+                        id=msg.id, subject=msg.subject,
+                        date=_date(msg.date), from_=msg.from_,
+                        poster=(msg.poster_email.poster.name
+                                if msg.poster_email else None),
+                        text=text)))
+                yield msg, text, length
+
+        # Same as _json() on the whole object, keys sorted
+        data.write('{"id":%d,"last_msg":%s,"messages":[' % (
+                   thread.id, _json(_date(thread.last_msg))))
+        context['messages'] = messages(context['messages'])
+        try:
+            self.write('thread/%d.html' % thread_id,
+                       self.stream('thread.html', **context))
+            data.write('],"tasks":%s}' % _json(
+                    [dict(task=assignation.task.name,
+                          reward=assignation.task.reward,
+                          poster=assignation.poster.name,
+                          date=_date(assignation.date))
+                     for assignation in thread.task_assignations]))
+        except:
+            data.discard()
+            raise
+        if data.commit():
+            self.written += 1
+        # Don't keep every thread in the session
+        self.sqlsession.expunge_all()
+
+    def remove_thread(self, thread_id):
+        for extension in ('html', 'json'):
+            _remove(os.path.join(self.directory,
+                                 'thread/%d.%s' % (thread_id, extension)))
+
+    def export_thread_lists(self):
+        """Writes the lists of threads, returns the number of pages.
+
+        Pages are numbered from the oldest threads, so that a new message
+        only changes the pages from the one its thread was on to the newest.
+        The newest page is also written as index.
+        """
+        Summary = models.ThreadSummary
+        page_size = getattr(config, 'PAGE_SIZE', 50)
+        pages = {}
+        for directory, unassigned in (('threads', False),
+                                      ('unassigned', True)):
+            query = self.sqlsession.query(Summary)
+            if unassigned:
+                query = query.filter(Summary.assigned == False)
+            count = max(1, (query.count() + page_size - 1) // page_size)
+            cursor = None
+            for number in xrange(1, count + 1):
+                page = query
+                if cursor is not None:
+                    last_msg, thread_id = cursor
+                    page = page.filter(or_(Summary.last_msg > last_msg,
+                                           and_(Summary.last_msg == last_msg,
+                                                Summary.thread_id >
+                                                thread_id)))
+                threads = (page.order_by(Summary.last_msg, Summary.thread_id)
+                               .limit(page_size)).all()
+                if threads:
+                    cursor = threads[-1].last_msg, threads[-1].thread_id
+                # Newest first, like the application
+                threads.reverse()
+                next_page = str(number - 1) if number > 1 else None
+                html = self.render('vote.html', threads=threads,
+                                   unassigned=unassigned,
+                                   next_page=next_page)
+                self.write('%s/%d.html' % (directory, number), html)
+                data = _json([dict(id=thread.thread_id,
+                                   subject=thread.subject,
+                                   last_msg=_date(thread.last_msg),
+                                   messages=thread.message_count,
+                                   participants=thread.participant_count,
+                                   tasks=thread.tasks)
+                              for thread in threads])
+                self.write('%s/%d.json' % (directory, number), data)
+                if number == count:
+                    self.write('%s/index.html' % directory, html)
+                    self.write('%s/index.json' % directory, data)
+            pages[directory] = count
+        return pages
+
+    def export_scores(self):
+        """Writes the leaderboard, returns the number of pages.
+        """
+        number = 0
+        cursor = None
+        while True:
+            number += 1
+            posters, last = paginate(self.sqlsession.query(models.Poster),
+                                     models.Poster.score, models.Poster.id,
+                                     cursor)
+            next_page = str(number + 1) if last is not None else None
+            page = self.render('scores.html',
+                               scores=[(poster, poster.score)
+                                       for poster in posters],
+                               period=None, next_page=next_page)
+            self.write('scores/%d.html' % number, page)
+            if number == 1:
+                self.write('index.html', page)
+            self.write('scores/%d.json' % number,
+                       _json([dict(id=poster.id, name=poster.name,
+                                   score=poster.score)
+                              for poster in posters]))
+            if last is None:
+                break
+            cursor = last.score, last.id
+
+        now = datetime.utcnow()
+        for period, since in (('month', datetime(now.year, now.month, 1)),
+                              ('year', datetime(now.year, 1, 1))):
+            scores = scoring.leaderboard(self.sqlsession, since=since)
+            self.write('scores/%s.html' % period,
+                       self.render('scores.html', scores=scores,
+                                   period=period, next_page=None))
+            self.write('scores/%s.json' % period,
+                       _json([dict(id=poster.id, name=poster.name,
+                                   score=points)
+                              for poster, points in scores]))
+        return number
+
+    def remove_pages(self, directory, first, last):
+        for number in xrange(first, last + 1):
+            for extension in ('html', 'json'):
+                _remove(os.path.join(self.directory,
+                                     '%s/%d.%s' % (directory, number,
+                                                   extension)))
+
+
+def _read_state(path):
+    try:
+        with open(path) as fp:
+            state = json.load(fp)
+    except (IOError, ValueError):
+        return None
+    if state.get('format') != _FORMAT:
+        return None
+    return state
+
+
+def export(directory):
+    """Exports the public pages to a directory, incrementally.
+
+    Returns the number of files written.
+    """
+    state_path = os.path.join(directory, STATE_FILE)
+    previous = _read_state(state_path)
+    if previous is None:
+        logger.info("No previous export in %s, exporting everything" % (
+                    directory,))
+        previous = dict(generation=None, posters=None, threads={}, pages={})
+
+    generation = cache.current_generation()[0]
+    if generation == previous['generation']:
+        logger.info("Nothing changed since the last export")
+        return 0
+
+    sqlsession = ReadSession()
+    try:
+        exporter = Exporter(directory, sqlsession,
+                            getattr(config, 'EXPORT_URL', '/'))
+        posters = _posters_fingerprint(sqlsession)
+        threads = _thread_fingerprints(sqlsession)
+        if posters != previous['posters']:
+            changed = list(threads)
+        else:
+            changed = [thread_id
+                       for thread_id, fingerprint in threads.iteritems()
+                       if previous['threads'].get(thread_id) != fingerprint]
+        removed = set(previous['threads']).difference(threads)
+        logger.info("Exporting %d threads, removing %d" % (len(changed),
+                                                           len(removed)))
+
+        with app.test_request_context():
+            # Threads first, so that the lists don't link to missing pages
+            for thread_id in sorted(changed, key=int):
+                exporter.export_thread(int(thread_id))
+            pages = exporter.export_thread_lists()
+            pages['scores'] = exporter.export_scores()
+        for thread_id in removed:
+            exporter.remove_thread(int(thread_id))
+        for name, count in pages.iteritems():
+            exporter.remove_pages(name, count + 1,
+                                  previous['pages'].get(name, 0))
+    finally:
+        sqlsession.close()
+
+    _write(state_path, _json(dict(format=_FORMAT, generation=generation,
+                                  posters=posters, threads=threads,
+                                  pages=pages)))
+    logger.info("Wrote %d files" % exporter.written)
+    return exporter.written
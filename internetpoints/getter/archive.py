@@ -0,0 +1,92 @@
+import gzip
+import logging
+import os
+import re
+
+
+logger = logging.getLogger(__name__)
+
+
+_MBOXRD_FROM = re.compile(r'^>+From ')
+# Pipermail obfuscates addresses as "user at example.com"
+_PIPERMAIL_FROM = re.compile(r'^From: (\S+) at (\S+)')
+
+
+def read_mbox(fileobj, pipermail=False):
+    """Reads messages from an mbox file, without loading all of it.
+
+    Yields the text of each message.
+    """
+    lines = []
+    in_headers = False
+    previous_blank = True
+    for line in fileobj:
+        line = line.rstrip('\r\n')
+        if line.startswith('From ') and previous_blank:
+            if lines:
+                yield _join(lines)
+            lines = []
+            in_headers = True
+            previous_blank = False
+            continue
+        previous_blank = not line
+        if in_headers:
+            if not line:
+                in_headers = False
+            elif pipermail:
+                line = _PIPERMAIL_FROM.sub(r'From: \1@\2', line)
+        elif _MBOXRD_FROM.match(line):
+            line = line[1:]
+        lines.append(line)
+    if lines:
+        yield _join(lines)
+
+
+def _join(lines):
+    # Drops the blank line separating the message from the next one
+    if not lines[-1]:
+        lines = lines[:-1]
+    return '\n'.join(lines)
+
+
+def read_maildir(path):
+    """Reads messages from a Maildir directory.
+
+    Yields the text of each message.
+    """
+    for subdir in ('cur', 'new'):
+        directory = os.path.join(path, subdir)
+        if not os.path.isdir(directory):
+            continue
+        for name in sorted(os.listdir(directory)):
+            with open(os.path.join(directory, name), 'rb') as fp:
+                yield fp.read().replace('\r\n', '\n')
+
+
+def read_archive(path):
+    """Reads messages from an archive: mbox, gzip'd mbox or Maildir.
+
+    Files named .txt or .txt.gz are assumed to come from pipermail, as found
+    in Mailman's list archives.
+
+    Yields the text of each message.
+    """
+    if os.path.isdir(path):
+        logger.info("Reading Maildir %s" % path)
+        for msg in read_maildir(path):
+            yield msg
+        return
+
+    pipermail = path.endswith(('.txt', '.txt.gz'))
+    logger.info("Reading %s%s" % ("pipermail archive " if pipermail else
+                                  "mbox ",
+                                  path))
+    if path.endswith('.gz'):
+        fileobj = gzip.open(path, 'rb')
+    else:
+        fileobj = open(path, 'rb')
+    try:
+        for msg in read_mbox(fileobj, pipermail=pipermail):
+            yield msg
+    finally:
+        fileobj.close()
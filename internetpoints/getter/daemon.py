@@ -0,0 +1,286 @@
+import json
+import logging
+import multiprocessing
+import os
+from Queue import Empty, Queue
+import signal
+import tempfile
+import threading
+import time
+
+from internetpoints import config
+from internetpoints.getter import imap
+from internetpoints.getter.fetcher import get_mailboxes, mark_all_seen
+from internetpoints.getter.threader import ThreadIndex
+
+
+logger = logging.getLogger(__name__)
+
+
+# The getter as a long-running process.
+#
+# Each mailbox is watched by its own thread: IMAP mailboxes keep their
+# connection open and wait for new messages with IDLE, POP3 mailboxes are
+# polled every DAEMON_POLL_INTERVAL seconds. The main thread inserts what
+# they download, in batches, and writes a heartbeat file that the 'health'
+# command checks.
+
+
+class Watcher(threading.Thread):
+    """Downloads new messages from a mailbox as they arrive.
+
+    Messages are put in the queue as ((number, uid), text) pairs, like
+    fetch_all() yields them.
+    """
+    def __init__(self, number, mailbox, queue, stop):
+        threading.Thread.__init__(self, name='watch-%s' % mailbox.name)
+        # Don't wait for the watchers if the main thread failed
+        self.daemon = True
+        self.number = number
+        self.mailbox = mailbox
+        self.queue = queue
+        self.stop = stop
+        # Last time we heard from the server
+        self.last_ok = time.time()
+        # Highest IMAP UID queued, which might not be marked seen yet
+        self.last_uid = 0
+        # POP3 UIDs queued but not marked seen yet; the main thread removes
+        # them once they are stored
+        self.queued = set()
+        self.queued_lock = threading.Lock()
+
+    def run(self):
+        delay = 1
+        while not self.stop.is_set():
+            try:
+                if self.mailbox.protocol == 'imap':
+                    self.watch_imap()
+                else:
+                    self.poll_pop3()
+            except Exception:
+                logger.exception("Error with %s, reconnecting in %d "
+                                 "seconds" % (self.mailbox.name, delay))
+                self.stop.wait(delay)
+                delay = min(delay * 2, 300)
+            else:
+                delay = 1
+
+    def _put(self, uid, text):
+        self.queue.put(((self.number, uid), text))
+
+    def stored(self, uid):
+        """Called by the main thread once a message is marked seen.
+        """
+        with self.queued_lock:
+            self.queued.discard(uid)
+
+    def poll_pop3(self):
+        interval = getattr(config, 'DAEMON_POLL_INTERVAL', 60)
+        while not self.stop.is_set():
+            with self.queued_lock:
+                skip = frozenset(self.queued)
+            for uid, text in self.mailbox.get_messages(skip):
+                if uid is not None:
+                    with self.queued_lock:
+                        self.queued.add(uid)
+                self._put(uid, text)
+            self.last_ok = time.time()
+            self.stop.wait(interval)
+
+    def watch_imap(self):
+        server = self.mailbox.connect()
+        try:
+            use_idle = imap.has_idle(server)
+            if not use_idle:
+                logger.warning("%s doesn't support IDLE, polling" % (
+                               self.mailbox.name,))
+            interval = getattr(config, 'DAEMON_POLL_INTERVAL', 60)
+            idle_timeout = getattr(config, 'IMAP_IDLE_TIMEOUT', 600)
+            while not self.stop.is_set():
+                for uid, text in imap.get_new_messages(
+                        server, self.mailbox.name, self.mailbox.folder,
+                        self.last_uid):
+                    self._put(uid, text)
+                    self.last_uid = max(self.last_uid, uid)
+                self.last_ok = time.time()
+                if use_idle:
+                    imap.idle(server, idle_timeout, self.stop)
+                else:
+                    self.stop.wait(interval)
+        finally:
+            try:
+                server.logout()
+            except Exception:
+                pass
+
+
+def _next_batch(queue, size, delay, stop):
+    """Gets a batch of messages from the queue.
+
+    Waits up to a second for a first message, then up to delay seconds for
+    more, so that bursts are inserted together.
+    """
+    try:
+        batch = [queue.get(timeout=1)]
+    except Empty:
+        return []
+    deadline = time.time() + delay
+    while len(batch) < size:
+        timeout = deadline - time.time()
+        if timeout <= 0 or stop.is_set():
+            # Don't wait, but take what's there
+            timeout = None
+        try:
+            if timeout is None:
+                batch.append(queue.get_nowait())
+            else:
+                batch.append(queue.get(timeout=timeout))
+        except Empty:
+            break
+    return batch
+
+
+def _write_heartbeat(path, watchers):
+    """Writes the state of the daemon to the heartbeat file, atomically.
+    """
+    now = time.time()
+    # A watcher that didn't hear from its server for longer than it should
+    # is stuck or can't connect
+    allowed = (max(getattr(config, 'DAEMON_POLL_INTERVAL', 60),
+                   getattr(config, 'IMAP_IDLE_TIMEOUT', 600)) +
+               getattr(config, 'DAEMON_HEALTH_MAX_AGE', 60))
+    mailboxes = dict((watcher.mailbox.name,
+                      dict(last_ok=watcher.last_ok,
+                           healthy=now - watcher.last_ok <= allowed))
+                     for watcher in watchers)
+    state = dict(time=now, pid=os.getpid(), mailboxes=mailboxes,
+                 healthy=all(mailbox['healthy']
+                             for mailbox in mailboxes.itervalues()))
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp = tempfile.mkstemp(dir=directory, prefix='.heartbeat-')
+    try:
+        with os.fdopen(fd, 'w') as fp:
+            json.dump(state, fp)
+        os.rename(temp, path)
+    except:
+        os.remove(temp)
+        raise
+
+
+def check_health(path):
+    """Checks the heartbeat file of a running daemon.
+
+    Returns a list of problems, empty if the daemon is healthy.
+    """
+    try:
+        with open(path) as fp:
+            state = json.load(fp)
+    except (IOError, ValueError) as e:
+        return ["Can't read heartbeat file %s: %s" % (path, e)]
+    problems = []
+    age = time.time() - state['time']
+    if age > getattr(config, 'DAEMON_HEALTH_MAX_AGE', 60):
+        problems.append("Heartbeat is %d seconds old" % age)
+    for name, mailbox in sorted(state['mailboxes'].iteritems()):
+        if not mailbox['healthy']:
+            problems.append("No contact with %s for %d seconds" % (
+                            name, state['time'] - mailbox['last_ok']))
+    return problems
+
+
+def _ignore_signals():
+    # Parsing processes are stopped by the daemon, not by the signals sent
+    # to the whole process group
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+
+def run():
+    """Runs the daemon until SIGTERM or SIGINT.
+
+    On these signals, the watchers stop, the messages already downloaded are
+    inserted, and the daemon exits.
+    """
+    # Imported here to avoid a circular import
+    from internetpoints.getter.main import insert_batch, parse_batches
+
+    mailboxes = get_mailboxes()
+    batch_size = getattr(config, 'GETTER_BATCH_SIZE', 500)
+    delay = getattr(config, 'DAEMON_BATCH_DELAY', 2)
+    heartbeat = getattr(config, 'DAEMON_HEARTBEAT_FILE', None)
+
+    # Started before the threads, since it forks
+    workers = getattr(config, 'GETTER_WORKERS', 0)
+    if workers > 1:
+        pool = multiprocessing.Pool(workers, _ignore_signals)
+    else:
+        pool = None
+
+    stop = threading.Event()
+
+    def shutdown(signum, frame):
+        logger.info("Got signal %d, stopping" % signum)
+        stop.set()
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    queue = Queue(maxsize=batch_size)
+    watchers = [Watcher(number, mailbox, queue, stop)
+                for number, mailbox in enumerate(mailboxes)]
+    for watcher in watchers:
+        watcher.start()
+    logger.info("Watching %d mailboxes" % len(watchers))
+
+    last_heartbeat = 0
+    pending = []
+    retry_delay = 1
+    try:
+        while True:
+            if not pending:
+                pending = _next_batch(queue, batch_size, delay, stop)
+            if pending:
+                try:
+                    for parsed in parse_batches(pending, len(pending),
+                                                pool):
+                        insert_batch([record for uid, record in parsed
+                                      if record is not None],
+                                     ThreadIndex())
+                        keys = [uid for uid, record in parsed]
+                        mark_all_seen(mailboxes, keys)
+                        for number, uid in keys:
+                            watchers[number].stored(uid)
+                except Exception:
+                    if stop.is_set():
+                        # They will be downloaded again next time
+                        logger.exception("Couldn't insert %d messages" % (
+                                         len(pending),))
+                        break
+                    logger.exception("Couldn't insert %d messages, "
+                                     "retrying in %d seconds" % (
+                                     len(pending), retry_delay))
+                    stop.wait(retry_delay)
+                    retry_delay = min(retry_delay * 2, 300)
+                    continue
+                pending = []
+                retry_delay = 1
+
+            if heartbeat and time.time() - last_heartbeat >= 5:
+                _write_heartbeat(heartbeat, watchers)
+                last_heartbeat = time.time()
+
+            if stop.is_set() and queue.empty():
+                break
+    finally:
+        stop.set()
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        for watcher in watchers:
+            watcher.join(imap.IDLE_DONE_TIMEOUT)
+        if heartbeat:
+            try:
+                os.remove(heartbeat)
+            except OSError:
+                pass
+    logger.info("Stopped")
@@ -0,0 +1,135 @@
+import logging
+from Queue import Queue
+import threading
+
+from internetpoints import config
+from internetpoints.getter import imap, pop3
+
+
+logger = logging.getLogger(__name__)
+
+
+class Mailbox(object):
+    """A mailbox to fetch messages from, over POP3 or IMAP.
+    """
+    def __init__(self, protocol, host, use_ssl, port, user, password,
+                 folder='INBOX'):
+        if protocol not in ('pop3', 'imap'):
+            raise ValueError("Unknown mailbox protocol %r" % protocol)
+        self.protocol = protocol
+        self.host = host
+        self.use_ssl = use_ssl
+        self.port = port
+        if callable(user):
+            user = user()
+        self.user = user
+        self.password = password
+        self.folder = folder
+
+    @property
+    def name(self):
+        if self.protocol == 'pop3':
+            return pop3.mailbox_name(self.host, self.port, self.user)
+        else:
+            return imap.mailbox_name(self.host, self.port, self.user,
+                                     self.folder)
+
+    def _password(self):
+        password = self.password
+        if callable(password):
+            password = password()
+        return password
+
+    def connect(self):
+        """Opens a connection to an IMAP mailbox.
+        """
+        return imap.connect(self.host, self.use_ssl, self.port, self.user,
+                            self._password())
+
+    def get_messages(self, skip=()):
+        """Downloads the new messages, yielding (uid, text) pairs.
+
+        For POP3, messages whose UID is in skip are not downloaded.
+        """
+        password = self._password()
+        if self.protocol == 'pop3':
+            return pop3.get_messages(self.host, self.use_ssl, self.port,
+                                     self.user, password, skip)
+        else:
+            return imap.get_messages(self.host, self.use_ssl, self.port,
+                                     self.user, password, self.folder)
+
+    def mark_seen(self, uids):
+        if self.protocol == 'pop3':
+            pop3.mark_seen(self.name, uids)
+        else:
+            imap.mark_seen(self.name, uids)
+
+
+def get_mailboxes():
+    """Returns the mailboxes from the configuration.
+
+    INBOXES is a list of (protocol, host, use_ssl, port, user, password)
+    tuples, with an optional folder for IMAP; if it's not set, the single
+    POP3 mailbox INBOX is used.
+    """
+    inboxes = getattr(config, 'INBOXES', None)
+    if inboxes is None:
+        inboxes = [('pop3',) + tuple(config.INBOX)]
+    return [Mailbox(*inbox) for inbox in inboxes]
+
+
+_DONE = object()
+
+
+def _fetch_mailbox(number, mailbox, semaphore, queue):
+    try:
+        with semaphore:
+            for uid, text in mailbox.get_messages():
+                queue.put(((number, uid), text))
+    except Exception:
+        logger.exception("Error fetching messages from %s" % mailbox.name)
+    finally:
+        queue.put(_DONE)
+
+
+def fetch_all(mailboxes):
+    """Downloads the new messages from all the mailboxes concurrently.
+
+    Each mailbox is read by its own thread, with at most
+    MAX_CONNECTIONS_PER_SERVER connections open to the same server at a time.
+    Messages are yielded as they arrive, as ((number, uid), text) pairs where
+    number is the position of the mailbox in the list; pass the keys to
+    mark_all_seen() once the messages are stored.
+    """
+    max_connections = getattr(config, 'MAX_CONNECTIONS_PER_SERVER', 2)
+    semaphores = {}
+    queue = Queue(maxsize=getattr(config, 'GETTER_BATCH_SIZE', 500))
+    for number, mailbox in enumerate(mailboxes):
+        server = mailbox.host, mailbox.port
+        if server not in semaphores:
+            semaphores[server] = threading.BoundedSemaphore(max_connections)
+        thread = threading.Thread(target=_fetch_mailbox,
+                                  args=(number, mailbox, semaphores[server],
+                                        queue))
+        # Don't wait for the fetchers if the consumer failed
+        thread.daemon = True
+        thread.start()
+
+    running = len(mailboxes)
+    while running:
+        item = queue.get()
+        if item is _DONE:
+            running -= 1
+        else:
+            yield item
+
+
+def mark_all_seen(mailboxes, keys):
+    """Marks messages from fetch_all() as seen in their mailboxes.
+    """
+    uids = {}
+    for number, uid in keys:
+        uids.setdefault(number, []).append(uid)
+    for number, mailbox_uids in uids.iteritems():
+        mailboxes[number].mark_seen(mailbox_uids)
@@ -0,0 +1,179 @@
+from collections import OrderedDict
+import hashlib
+from htmlentitydefs import name2codepoint
+from HTMLParser import HTMLParser, HTMLParseError
+import logging
+import re
+import signal
+import threading
+from timeit import default_timer
+import warnings
+
+from internetpoints import config, metrics
+
+try:
+    import html2text
+except ImportError:
+    html2text = None
+
+
+logger = logging.getLogger(__name__)
+
+
+# Conversion of HTML messages to text.
+#
+# html2text gives the nicest result, but it is slow, so conversions are
+# memoized (lists get the same HTML over and over: newsletters, forwarded
+# messages), and very large or pathological documents are handed to a simple
+# stripper instead. The cache is kept in each process, so each getter worker
+# has its own.
+
+
+class _Stripper(HTMLParser):
+    """Extracts the text of an HTML document, keeping paragraphs apart.
+    """
+    _BLOCKS = set(['address', 'article', 'blockquote', 'br', 'dd', 'div',
+                   'dl', 'dt', 'form', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6',
+                   'hr', 'li', 'ol', 'p', 'pre', 'section', 'table', 'tr',
+                   'ul'])
+    _SKIP = set(['head', 'script', 'style', 'title'])
+
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.parts = []
+        self.skipping = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self._SKIP:
+            self.skipping += 1
+        elif tag in self._BLOCKS:
+            self.parts.append(u'\n')
+            if tag == 'li':
+                self.parts.append(u'* ')
+
+    def handle_endtag(self, tag):
+        if tag in self._SKIP:
+            self.skipping = max(0, self.skipping - 1)
+        elif tag in self._BLOCKS and tag != 'li':
+            self.parts.append(u'\n')
+
+    def handle_data(self, data):
+        if not self.skipping:
+            self.parts.append(data)
+
+    def handle_entityref(self, name):
+        if not self.skipping and name in name2codepoint:
+            self.parts.append(unichr(name2codepoint[name]))
+
+    def handle_charref(self, name):
+        if self.skipping:
+            return
+        try:
+            if name[:1] in 'xX':
+                self.parts.append(unichr(int(name[1:], 16)))
+            else:
+                self.parts.append(unichr(int(name)))
+        except (ValueError, OverflowError):
+            pass
+
+
+_SPACES = re.compile(r'[ \t\r\f\v]+')
+_BLANK_LINES = re.compile(r'\n\s*\n\s*')
+
+
+def strip_tags(html):
+    """Quickly turns HTML into text, without any formatting.
+    """
+    stripper = _Stripper()
+    try:
+        stripper.feed(html)
+        stripper.close()
+    except HTMLParseError:
+        # Keep what we got so far
+        pass
+    text = _SPACES.sub(u' ', u''.join(stripper.parts))
+    text = u'\n'.join(line.strip() for line in text.split(u'\n'))
+    return _BLANK_LINES.sub(u'\n\n', text).strip() + u'\n'
+
+
+class _Timeout(Exception):
+    pass
+
+
+def _alarm(signum, frame):
+    raise _Timeout()
+
+
+def _convert(html):
+    """Converts with html2text, giving up after HTML2TEXT_TIMEOUT seconds.
+
+    The timeout uses SIGALRM, so it's only enforced in the main thread.
+    """
+    timeout = getattr(config, 'HTML2TEXT_TIMEOUT', 5)
+    use_alarm = (timeout and hasattr(signal, 'setitimer') and
+                 isinstance(threading.current_thread(),
+                            threading._MainThread))
+    # A new converter each time, since they keep some state from the
+    # previous document
+    converter = html2text.HTML2Text()
+    if not use_alarm:
+        return converter.handle(html)
+    previous = signal.signal(signal.SIGALRM, _alarm)
+    signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        return converter.handle(html)
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+_cache = OrderedDict()
+_warned = False
+
+
+def html_to_text(html):
+    """Converts an HTML message to text.
+
+    Uses html2text if it's installed and the document is smaller than
+    HTML2TEXT_MAX_SIZE characters, and strip_tags() otherwise. Results are
+    cached by content, HTML_CACHE_SIZE of them.
+    """
+    global _warned
+
+    key = hashlib.sha1(html.encode('utf-8')).digest()
+    text = _cache.get(key)
+    if text is not None:
+        # Move it to the end, so it gets evicted last
+        del _cache[key]
+        _cache[key] = text
+        return text
+
+    start = default_timer()
+    with metrics.getter_stages.stage('html2text'):
+        if html2text is None:
+            if not _warned:
+                warnings.warn("Can't convert HTML to text nicely -- "
+                              "html2text library not found")
+                _warned = True
+            text = strip_tags(html)
+        elif len(html) > getattr(config, 'HTML2TEXT_MAX_SIZE', 200000):
+            logger.info("HTML part is %d characters, stripping tags "
+                        "instead of using html2text" % len(html))
+            text = strip_tags(html)
+        else:
+            try:
+                text = _convert(html)
+            except _Timeout:
+                logger.warning("html2text took too long, stripping tags "
+                               "instead")
+                text = strip_tags(html)
+    duration = default_timer() - start
+    logger.debug("Converted %d characters of HTML in %.3fs" % (
+                 len(html), duration))
+    metrics.observe('internetpoints_getter_html_seconds',
+                    "Time spent converting each HTML part", duration)
+
+    _cache[key] = text
+    while len(_cache) > getattr(config, 'HTML_CACHE_SIZE', 1000):
+        _cache.popitem(last=False)
+    return text
@@ -0,0 +1,188 @@
+from imaplib import IMAP4, IMAP4_SSL
+import logging
+import re
+import select
+import time
+
+from internetpoints import config, models
+from internetpoints.storage import Session
+
+
+logger = logging.getLogger(__name__)
+
+
+_FETCH_UID = re.compile(r'\bUID (\d+)')
+_IDLE_CHANGE = re.compile(r'^\* \d+ (EXISTS|RECENT|EXPUNGE)\b', re.I)
+
+# Seconds to wait for the server to end IDLE
+IDLE_DONE_TIMEOUT = 30
+
+
+def mailbox_name(host, port, user, folder):
+    """Returns the name used to identify a mailbox in the database.
+    """
+    return 'imap:%s@%s:%d/%s' % (user, host, port, folder)
+
+
+def connect(host, use_ssl, port, user, password):
+    logger.info("Connecting to IMAP server %s:%d, using SSL: %s" % (
+                 host, port, "yes" if use_ssl else "no"))
+
+    if use_ssl:
+        server = IMAP4_SSL(host, port)
+    else:
+        server = IMAP4(host, port)
+    server.login(user, password)
+    return server
+
+
+def _last_uid(mailbox, uidvalidity):
+    """Returns the highest UID stored for this mailbox.
+
+    If the UIDVALIDITY of the mailbox changed, the UIDs we stored are
+    meaningless and we start over; the messages we already have will be
+    skipped when inserting.
+    """
+    sqlsession = Session()
+    try:
+        state = (sqlsession.query(models.ImapState)
+                           .filter(models.ImapState.mailbox == mailbox)
+                           .first())
+        if state is None:
+            state = models.ImapState(mailbox=mailbox, uidvalidity=uidvalidity,
+                                     last_uid=0)
+            sqlsession.add(state)
+        elif state.uidvalidity != uidvalidity:
+            logger.warning("UIDVALIDITY of %s changed, fetching everything "
+                           "again" % mailbox)
+            state.uidvalidity = uidvalidity
+            state.last_uid = 0
+        last_uid = state.last_uid
+        sqlsession.commit()
+        return last_uid
+    finally:
+        sqlsession.close()
+
+
+def get_new_messages(server, mailbox, folder, after=0):
+    """Downloads the messages that arrived since last time, in batches.
+
+    Yields (uid, text) pairs. The caller is responsible for calling
+    mark_seen() once the messages have been stored. Messages up to UID after
+    are skipped even if they haven't been marked yet.
+    """
+    server.select(folder, readonly=True)
+    uidvalidity = server.response('UIDVALIDITY')[1][0]
+    last_uid = max(_last_uid(mailbox, uidvalidity), after)
+
+    # Note that n:* always matches the last message, even if its UID is
+    # lower than n
+    uids = server.uid('SEARCH', 'UID', '%d:*' % (last_uid + 1))[1][0]
+    uids = [int(uid) for uid in uids.split() if int(uid) > last_uid]
+    logger.info("%s has %d new messages" % (mailbox, len(uids)))
+
+    fetch_size = getattr(config, 'IMAP_FETCH_SIZE', 50)
+    for i in xrange(0, len(uids), fetch_size):
+        uid_set = ','.join('%d' % uid for uid in uids[i:i + fetch_size])
+        response = server.uid('FETCH', uid_set, '(UID BODY.PEEK[])')[1]
+        for item in response:
+            # Items are (envelope, literal) tuples, followed by the closing
+            # parenthesis as a separate string
+            if not isinstance(item, tuple):
+                continue
+            uid = _FETCH_UID.search(item[0])
+            if uid is None:
+                continue
+            yield int(uid.group(1)), item[1].replace('\r\n', '\n')
+
+
+def has_idle(server):
+    return 'IDLE' in server.capabilities
+
+
+def _readable(server, sock, timeout):
+    """Waits up to timeout seconds for the server to send something.
+    """
+    # The file object and the SSL layer might already hold data that was read
+    # from the socket, select() doesn't see that
+    buffered = getattr(getattr(server, 'file', None), '_rbuf', None)
+    if buffered is not None and buffered.getvalue():
+        return True
+    if hasattr(sock, 'pending') and sock.pending():
+        return True
+    return bool(select.select([sock], [], [], timeout)[0])
+
+
+def idle(server, timeout, stop=None):
+    """Waits for changes in the selected folder, using IDLE (RFC 2177).
+
+    Returns True when the server reports new or removed messages, and False
+    after timeout seconds or when stop (a threading.Event) is set.
+    """
+    tag = server._new_tag()
+    server.send('%s IDLE\r\n' % tag)
+    line = server.readline()
+    if not line.startswith('+'):
+        raise IMAP4.error("IDLE refused: %s" % line.strip())
+
+    sock = getattr(server, 'sslobj', None) or server.socket()
+    deadline = time.time() + timeout
+    changed = False
+    while not changed and time.time() < deadline:
+        if stop is not None and stop.is_set():
+            break
+        # Wake up every second to check stop. Lines are only read once
+        # something arrived: a read timing out in the middle of a line would
+        # lose what it got of it
+        if not _readable(server, sock, 1):
+            continue
+        line = server.readline()
+        if not line:
+            raise IMAP4.abort("Connection closed during IDLE")
+        changed = _IDLE_CHANGE.match(line) is not None
+
+    server.send('DONE\r\n')
+    sock.settimeout(IDLE_DONE_TIMEOUT)
+    try:
+        while True:
+            line = server.readline()
+            if not line:
+                raise IMAP4.abort("Connection closed during IDLE")
+            if line.startswith(tag + ' '):
+                if not line[len(tag) + 1:].upper().startswith('OK'):
+                    raise IMAP4.error("IDLE failed: %s" % line.strip())
+                break
+    finally:
+        sock.settimeout(None)
+    return changed
+
+
+def get_messages(host, use_ssl, port, user, password, folder='INBOX'):
+    """Connects and downloads the new messages from an IMAP folder.
+
+    Yields (uid, text) pairs.
+    """
+    server = connect(host, use_ssl, port, user, password)
+    mailbox = mailbox_name(host, port, user, folder)
+    for uid, text in get_new_messages(server, mailbox, folder):
+        yield uid, text
+    server.logout()
+
+
+def mark_seen(mailbox, uids):
+    """Moves the high-water mark past these messages.
+    """
+    uids = [uid for uid in uids if uid is not None]
+    if not uids:
+        return
+    last_uid = max(uids)
+    sqlsession = Session()
+    try:
+        (sqlsession.query(models.ImapState)
+                   .filter(models.ImapState.mailbox == mailbox)
+                   .filter(models.ImapState.last_uid < last_uid)
+                   .update({models.ImapState.last_uid: last_uid},
+                           synchronize_session=False))
+        sqlsession.commit()
+    finally:
+        sqlsession.close()
@@ -1,40 +1,33 @@
+import argparse
+from collections import OrderedDict
 from datetime import datetime
 from email.header import decode_header
 from email.parser import Parser
 import email.utils
 import logging
-from poplib import POP3, POP3_SSL
+import multiprocessing
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy.orm.exc import NoResultFound
-import warnings
+from sqlalchemy.sql import func, select
+import sys
+from timeit import default_timer
 
-from internetpoints import config, models
-from internetpoints.storage import Session
+from internetpoints import addresses, bodies, cache, config, metrics, models, \
+    scoring, search, stats
+from internetpoints.getter import daemon
+from internetpoints.getter.archive import read_archive
+from internetpoints.getter.fetcher import fetch_all, get_mailboxes, \
+    mark_all_seen
+from internetpoints.getter.htmltext import html_to_text
+from internetpoints.getter.threader import ThreadIndex, merge_threads, \
+    parse_references
+from internetpoints.storage import Session, chunks, transaction
+from internetpoints.summaries import rebuild_thread_summaries, \
+    update_thread_summaries
 
 
 logger = logging.getLogger(__name__)
 
 
-def get_messages(host, use_ssl, port, user, password):
-    logger.info("Connecting to POP3 server %s:%d, using SSL: %s" % (
-                 host, port, "yes" if use_ssl else "no"))
-
-    if use_ssl:
-        server = POP3_SSL(host, port)
-    else:
-        server = POP3(host, port)
-
-    server.user(user)
-    server.pass_(password)
-
-    messages, total = server.stat()
-    logger.info("Server has %d new messages (total %d)" % (messages, total))
-    for i in xrange(messages):
-        yield '\n'.join(server.retr(i+1)[1])
-
-    server.quit()
-
-
 def decode_subject(subject):
     res = []
     for text, charset in decode_header(subject):
@@ -45,114 +38,501 @@ def decode_subject(subject):
     return ' '.join(res)
 
 
-def main():
-    logging.basicConfig(level=logging.INFO)
+def parse_message(msg):
+    """Parses a raw message into a record ready to be inserted.
+
+    Returns a dict with the id, in-reply-to, from, subject, date and text of
+    the message.
+    """
+    # Feed it to Python's standard RFC 2822-based message parser
+    parser = Parser()
+    msg = parser.parsestr(msg)
+
+    # Headers of interest
+    msgid = msg['Message-ID']
+    replyto = msg['In-Reply-To']
+    references = parse_references(msg['References'], replyto)
+    subject = decode_subject(msg['Subject'])
+    from_ = email.utils.parseaddr(msg['From'])[1]
+    date = email.utils.parsedate_tz(msg['Date'])
+    if date:
+        date = datetime.fromtimestamp(email.utils.mktime_tz(date))
 
-    host, use_ssl, port, user, password = config.INBOX
-    if callable(user):
-        user = user()
-    if callable(password):
-        password = password()
-
-    for msg in get_messages(host, use_ssl, port, user, password):
-        # Feed it to Python's standard RFC 2822-based message parser
-        parser = Parser()
-        msg = parser.parsestr(msg)
-
-        # Headers of interest
-        msgid = msg['Message-ID']
-        replyto = msg['In-Reply-To']
-        subject = decode_subject(msg['Subject'])
-        from_ = email.utils.parseaddr(msg['From'])[1]
-        date = email.utils.parsedate_tz(msg['Date'])
-        if date:
-            date = datetime.fromtimestamp(email.utils.mktime_tz(date))
-
-        logger.debug("Parsing message from %r" % (from_,))
-
-        # Find text content
-        if msg.is_multipart():
-            logger.debug("Message is multipart with %d parts" % (
-                        len(msg.get_payload()),))
-            # RFC 2046 says that the last part is preferred
-            text = None
-            is_html = True
-            for part in msg.get_payload():
-                if part.get_content_type() == 'text/plain' or (
-                        part.get_content_type() == 'text/html' and is_html):
-                    charset = part.get_charsets()[0]
-                    text = part.get_payload(decode=True).decode(charset,
-                                                                'replace')
-                    is_html = part.get_content_type() == 'text/html'
-            if text is not None:
-                logger.debug("Found a text part (text/%s)" % (
-                            'html' if is_html else 'plain'),)
-            else:
-                logger.debug("Didn't find a text part")
-            if text is None:
-                text = msg.preamble
-                is_html = False
-                if text:
-                    logger.debug("Using preamble")
+    logger.debug("Parsing message from %r" % (from_,))
+
+    # Find text content
+    if msg.is_multipart():
+        logger.debug("Message is multipart with %d parts" % (
+                    len(msg.get_payload()),))
+        # RFC 2046 says that the last part is preferred
+        text = None
+        is_html = True
+        for part in msg.get_payload():
+            if part.get_content_type() == 'text/plain' or (
+                    part.get_content_type() == 'text/html' and is_html):
+                charset = part.get_charsets()[0] or 'ascii'
+                text = part.get_payload(decode=True).decode(charset,
+                                                            'replace')
+                is_html = part.get_content_type() == 'text/html'
+        if text is not None:
+            logger.debug("Found a text part (text/%s)" % (
+                        'html' if is_html else 'plain'),)
         else:
-            charset = msg.get_charsets()[0]
-            text = msg.get_payload(decode=True).decode(charset,
-                                                        'replace')
-            content_type = msg.get_content_type()
-            is_html = content_type == 'text/html'
-            logger.debug("Message is not multipart (%s)" % (content_type,))
-
-        if not text:
-            logger.warning("Message from %r has no text!" % (from_,))
-            text = "(No text content found)"
-        elif is_html:
-            try:
-                import html2text
-            except ImportError:
-                warnings.warn("Can't convert HTML to text -- html2text "
-                              "library not found")
-            else:
-                logger.debug("Converting HTML with html2text")
-                h = html2text.HTML2Text()
-                text = h.handle(text)
+            logger.debug("Didn't find a text part")
+        if text is None:
+            text = msg.preamble
             is_html = False
+            if text:
+                logger.debug("Using preamble")
+    else:
+        charset = msg.get_charsets()[0] or 'ascii'
+        text = msg.get_payload(decode=True).decode(charset,
+                                                    'replace')
+        content_type = msg.get_content_type()
+        is_html = content_type == 'text/html'
+        logger.debug("Message is not multipart (%s)" % (content_type,))
 
-        # Find thread this message is a part of
-        sqlsession = Session()
-        thread = None
-        if replyto:
-            try:
-                parent_msg = (sqlsession.query(models.Message)
-                                        .filter(models.Message.id == replyto)
-                                        .one())
-            except NoResultFound:
-                pass
-            else:
-                thread = parent_msg.thread
-                logger.debug("Message is part of existing thread %d" % (
-                             thread.id,))
-        if thread is None:
-            thread = models.Thread(last_msg=date)
-            thread_created = True
-            sqlsession.add(thread)
-        else:
-            thread_created = False
-            # FIXME : This should be synchronized somehow
-            # Update last_msg date field
-            if thread.last_msg < date:
-                thread.last_msg = date
-                sqlsession.add(thread)
-
-        # Insert message
-        message = models.Message(id=msgid, thread=thread, date=date,
-                                 from_=from_,
-                                 subject=subject, text=text)
-        sqlsession.add(message)
+    if not text:
+        logger.warning("Message from %r has no text!" % (from_,))
+        text = "(No text content found)"
+    elif is_html:
+        text = html_to_text(text)
+        is_html = False
+
+    return dict(id=msgid, replyto=replyto, references=references,
+                from_=from_, subject=subject, date=date, text=text)
+
+
+def _insert_batch(sqlsession, index, records):
+    """Inserts a batch of messages in the session, without committing.
+
+    The threads are found using the index, which is warmed with bulk queries
+    for the whole batch. New threads and messages are inserted in bulk, and
+    threads that turn out to be the same are merged.
+    """
+    records = [record for record in records if record['id'] is not None]
+    index.warm(sqlsession, records)
+
+    rows = []
+    for record in records:
+        if record['id'] in index.messages:
+            logger.info("Message %r already exists, skipping" % (
+                        record['id'],))
+            continue
+        rows.append((record, index.add(record)))
+
+    # Insert the new threads, to get their ids
+    new_threads = OrderedDict()
+    for record, key in rows:
+        key = index.find(key)
+        if key < 0:
+            thread = new_threads.get(key)
+            if thread is None:
+                new_threads[key] = models.Thread(last_msg=record['date'])
+            elif thread.last_msg < record['date']:
+                thread.last_msg = record['date']
+    sqlsession.add_all(new_threads.values())
+    sqlsession.flush()
+    for key, thread in new_threads.iteritems():
+        index.resolve(key, thread.id)
+    logger.debug("Created %d new threads" % len(new_threads))
+
+    # Merge existing threads that turned out to be the same
+    touched = set()
+    for thread_id, merged_ids in index.pop_merges().iteritems():
+        merge_threads(sqlsession, thread_id, merged_ids)
+        touched.update(merged_ids)
+
+    # Insert messages
+    if rows:
+        compress = getattr(config, 'COMPRESS_MESSAGES', False)
+        sqlsession.execute(
+                models.Message.__table__.insert(),
+                [dict(id=record['id'], thread_id=index.find(key),
+                      date=record['date'], from_=record['from_'],
+                      subject=record['subject'],
+                      text=u'' if compress else record['text'])
+                 for record, key in rows])
+        if compress:
+            bodies.store_texts(sqlsession, [record for record, key in rows])
+        search.index_messages(sqlsession, [record for record, key in rows])
+        references = [dict(message_id=record['id'], referenced_id=ref)
+                      for record, key in rows
+                      for ref in set(record['references'])]
+        if references:
+            sqlsession.execute(models.MessageReference.__table__.insert(),
+                               references)
+    thread_ids = set(index.find(key) for record, key in rows)
+
+    # Update last_msg date field on the existing threads
+    existing = list(thread_ids.difference(thread.id
+                                          for thread
+                                          in new_threads.itervalues()))
+    threads = models.Thread.__table__
+    messages = models.Message.__table__
+    for chunk in chunks(existing):
+        sqlsession.execute(
+                threads.update()
+                       .where(threads.c.id.in_(chunk))
+                       .values(last_msg=select([func.max(messages.c.date)])
+                                        .where(messages.c.thread_id ==
+                                               threads.c.id)
+                                        .as_scalar()))
+
+    touched.update(thread_ids)
+    addresses.record_senders(sqlsession,
+                             set(record['from_'] for record, key in rows))
+    update_thread_summaries(sqlsession, touched)
+    stats.update_stats(sqlsession, [record for record, key in rows], touched)
+    if touched:
+        cache.invalidate(sqlsession)
+    return len(rows)
+
+
+def insert_batch(records, index):
+    """Inserts a batch of parsed messages, committing once.
+
+    If the batch can't be inserted, falls back to inserting the messages one
+    by one so that a single bad message doesn't lose the whole batch.
+    """
+    sqlsession = Session()
+    try:
         try:
-            sqlsession.commit()
+            inserted = transaction(
+                    sqlsession,
+                    lambda sqlsession: _insert_batch(sqlsession, index,
+                                                     records),
+                    on_retry=index.reset)
         except IntegrityError:
-            sqlsession.rollback()
-            logger.info("Got IntegrityError inserting message, skipping")
+            index.reset()
+            logger.warning("Got IntegrityError inserting batch of %d "
+                           "messages, inserting them one by one" %
+                           len(records))
+            inserted = 0
+            for record in records:
+                try:
+                    inserted += transaction(
+                            sqlsession,
+                            lambda sqlsession: _insert_batch(sqlsession, index,
+                                                             [record]),
+                            on_retry=index.reset)
+                except IntegrityError:
+                    index.reset()
+                    logger.info("Got IntegrityError inserting message, "
+                                "skipping")
+        logger.info("Inserted %d messages" % inserted)
+    finally:
+        sqlsession.close()
+
+
+def _parse_pair(pair):
+    uid, msg = pair
+    try:
+        return uid, parse_message(msg)
+    except Exception:
+        logger.exception("Couldn't parse message, skipping")
+        return uid, None
+
+
+def _batches(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def parse_batches(messages, batch_size, pool=None):
+    """Parses (uid, text) pairs, yielding lists of (uid, record) pairs.
+
+    If a multiprocessing pool is given, the messages are parsed by its
+    workers; the next batch is parsed while the current one is being handled
+    by the caller, and at most two batches are held in memory. Order is
+    preserved, so the result is the same as parsing serially.
+    """
+    if pool is None:
+        for batch in _batches(messages, batch_size):
+            yield [_parse_pair(pair) for pair in batch]
+        return
+
+    pending = None
+    for batch in _batches(messages, batch_size):
+        result = pool.map_async(_parse_pair, batch)
+        if pending is not None:
+            yield pending.get()
+        pending = result
+    if pending is not None:
+        yield pending.get()
+
+
+def ingest(messages, batch_size, seen=None):
+    """Parses and stores (key, text) pairs, one batch at a time.
+
+    If given, seen(keys) is called after each batch has been stored.
+    """
+    workers = getattr(config, 'GETTER_WORKERS', 0)
+    if workers > 1:
+        logger.info("Parsing messages with %d worker processes" % workers)
+        pool = multiprocessing.Pool(workers)
+    else:
+        pool = None
+    index = ThreadIndex()
+    stages = metrics.getter_stages
+    stages.reset()
+    start = default_timer()
+    count = 0
+    try:
+        messages = stages.wrap('fetch', messages)
+        for parsed in stages.wrap('parse',
+                                  parse_batches(messages, batch_size, pool)):
+            with stages.stage('db'):
+                insert_batch([record for uid, record in parsed
+                              if record is not None],
+                             index)
+                if seen is not None:
+                    seen([uid for uid, record in parsed])
+            count += len(parsed)
+    except:
+        if pool is not None:
+            pool.terminate()
+        raise
+    else:
+        if pool is not None:
+            pool.close()
+    finally:
+        if pool is not None:
+            pool.join()
+    if metrics.enabled:
+        _record_stages(stages, count, default_timer() - start)
+
+
+def _record_stages(stages, count, duration):
+    """Logs the time spent in each stage of a run, and records it.
+
+    When parsing with worker processes, the html2text time is part of parse.
+    """
+    rate = count / duration if duration else 0
+    logger.info("Processed %d messages in %.2fs (%.1f/s): %s" % (
+                count, duration, rate,
+                ', '.join('%s %.2fs' % (stage, seconds)
+                          for stage, seconds
+                          in sorted(stages.seconds.iteritems()))))
+    for stage, seconds in stages.seconds.iteritems():
+        metrics.inc('internetpoints_getter_seconds_total',
+                    "Time spent by the getter, per stage",
+                    seconds, stage=stage)
+    metrics.inc('internetpoints_getter_messages_total',
+                "Messages processed by the getter", count)
+    metrics.set_gauge('internetpoints_getter_messages_per_second',
+                      "Messages processed per second during the last run",
+                      rate)
+    path = getattr(config, 'GETTER_METRICS_FILE', None)
+    if path:
+        metrics.write_textfile(path)
+
+
+def fetch(args):
+    """Downloads the new messages from the mailboxes and stores them.
+    """
+    mailboxes = get_mailboxes()
+    ingest(fetch_all(mailboxes),
+           getattr(config, 'GETTER_BATCH_SIZE', 500),
+           lambda keys: mark_all_seen(mailboxes, keys))
+
+
+def run_daemon(args):
+    """Keeps running, storing new messages as they arrive.
+    """
+    daemon.run()
+
+
+def health(args):
+    """Checks that the daemon is running and can reach its mailboxes.
+    """
+    path = getattr(config, 'DAEMON_HEARTBEAT_FILE', None)
+    if not path:
+        logger.critical("DAEMON_HEARTBEAT_FILE is not set")
+        sys.exit(2)
+    problems = daemon.check_health(path)
+    for problem in problems:
+        logger.error(problem)
+    if problems:
+        sys.exit(1)
+    logger.info("Daemon is healthy")
+
+
+def import_archives(args):
+    """Imports messages from mbox files, Maildirs or pipermail archives.
+    """
+    if not args.paths:
+        logger.critical("No archive to import")
+        sys.exit(2)
+    for path in args.paths:
+        ingest(((None, msg) for msg in read_archive(path)),
+               getattr(config, 'IMPORT_BATCH_SIZE', 5000))
+
+
+def rebuild_summaries(args):
+    """Recomputes the thread summaries, for existing databases.
+    """
+    sqlsession = Session()
+    try:
+        count = rebuild_thread_summaries(sqlsession)
+        cache.invalidate(sqlsession)
+        sqlsession.commit()
+    finally:
+        sqlsession.close()
+    logger.info("Rebuilt summaries of %d threads" % count)
+
+
+def rebuild_scores(args):
+    """Recomputes the scores from the task assignations.
+    """
+    sqlsession = Session()
+    try:
+        count = scoring.rebuild_scores(sqlsession)
+        cache.invalidate(sqlsession)
+        sqlsession.commit()
+    finally:
+        sqlsession.close()
+    logger.info("Rebuilt scores of %d posters" % count)
+
+
+def check_scores(args):
+    """Checks that the stored scores match the task assignations.
+    """
+    sqlsession = Session()
+    try:
+        errors = scoring.check_scores(sqlsession)
+    finally:
+        sqlsession.close()
+    for poster_id, month, stored, expected in errors:
+        if month is None:
+            logger.error("Poster %d has score %d, expected %d" % (
+                         poster_id, stored, expected))
         else:
-            if thread_created:
-                logger.debug("Created new thread %d" % (thread.id,))
+            logger.error("Poster %d has %d points for %s, expected %d" % (
+                         poster_id, stored, month.strftime('%Y-%m'),
+                         expected))
+    if errors:
+        logger.error("Scores don't match the task assignations, run "
+                     "rebuild-scores to fix them")
+        sys.exit(1)
+    logger.info("Scores match the task assignations")
+
+
+def rebuild_stats(args):
+    """Recomputes the poster statistics from the messages.
+    """
+    sqlsession = Session()
+    try:
+        count = stats.rebuild_stats(sqlsession)
+        cache.invalidate(sqlsession)
+        sqlsession.commit()
+    finally:
+        sqlsession.close()
+    logger.info("Rebuilt statistics from %d messages" % count)
+
+
+def rebuild_addresses(args):
+    """Records the addresses of all messages and posters again.
+
+    The forms of the posters' addresses found in the messages are linked to
+    them.
+    """
+    sqlsession = Session()
+    try:
+        count, linked = addresses.rebuild_addresses(sqlsession)
+        if linked:
+            cache.invalidate(sqlsession)
+            sqlsession.commit()
+    finally:
+        sqlsession.close()
+    logger.info("Recorded %d addresses, linked %d to posters" % (count,
+                                                                linked))
+
+
+def rebuild_search(args):
+    """Indexes all the messages again, for full-text search.
+    """
+    sqlsession = Session()
+    try:
+        count = search.rebuild_index(sqlsession)
+    finally:
+        sqlsession.close()
+    logger.info("Indexed %d messages" % count)
+
+
+def convert_messages(args):
+    """Moves the message bodies to or from compressed storage.
+
+    The direction is given by COMPRESS_MESSAGES.
+    """
+    compress = getattr(config, 'COMPRESS_MESSAGES', False)
+    sqlsession = Session()
+    try:
+        count = bodies.convert(sqlsession, compress)
+        if count:
+            cache.invalidate(sqlsession)
+            sqlsession.commit()
+        messages, length, size = bodies.storage_stats(sqlsession)
+    finally:
+        sqlsession.close()
+    logger.info("%s %d messages" % (
+                "Compressed" if compress else "Decompressed", count))
+    if messages:
+        logger.info("%d messages are stored compressed, %d characters in "
+                    "%d bytes" % (messages, length, size))
+
+
+def export_pages(args):
+    """Writes the public pages to a directory, for a static web server.
+
+    The directory is given on the command line, or by EXPORT_DIR.
+    """
+    if args.paths:
+        directory = args.paths[0]
+    else:
+        directory = getattr(config, 'EXPORT_DIR', None)
+    if not directory:
+        logger.critical("No export directory given, and EXPORT_DIR is not "
+                        "set")
+        sys.exit(2)
+    # Imported here, so that the getter doesn't need Flask otherwise
+    from internetpoints.export import export
+    export(directory)
+
+
+COMMANDS = {
+    'check-scores': check_scores,
+    'convert-messages': convert_messages,
+    'daemon': run_daemon,
+    'export': export_pages,
+    'fetch': fetch,
+    'health': health,
+    'import': import_archives,
+    'rebuild-addresses': rebuild_addresses,
+    'rebuild-scores': rebuild_scores,
+    'rebuild-search': rebuild_search,
+    'rebuild-stats': rebuild_stats,
+    'rebuild-summaries': rebuild_summaries,
+}
+
+
+def main(args=None):
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(prog='internetpoints.getter')
+    parser.add_argument('command', nargs='?', default='fetch',
+                        choices=sorted(COMMANDS),
+                        help="what to do (default: fetch)")
+    parser.add_argument('paths', nargs='*',
+                        help="archives to import (mbox, Maildir, or "
+                             "pipermail .txt.gz), or directory to export "
+                             "to")
+    args = parser.parse_args(args)
+
+    COMMANDS[args.command](args)
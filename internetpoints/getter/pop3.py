@@ -0,0 +1,153 @@
+from email.parser import Parser
+import logging
+from poplib import POP3, POP3_SSL, error_proto
+from sqlalchemy.exc import IntegrityError
+
+from internetpoints import models
+from internetpoints.storage import Session, chunks
+
+
+logger = logging.getLogger(__name__)
+
+
+def mailbox_name(host, port, user):
+    """Returns the name used to identify a mailbox in the database.
+    """
+    return '%s@%s:%d' % (user, host, port)
+
+
+def get_messages(host, use_ssl, port, user, password, skip=()):
+    """Downloads the messages that haven't been seen yet.
+
+    Yields (uid, text) pairs. The caller is responsible for calling
+    mark_seen() once the messages have been stored. Messages whose UID is in
+    skip are not downloaded even if they haven't been marked yet.
+    """
+    logger.info("Connecting to POP3 server %s:%d, using SSL: %s" % (
+                 host, port, "yes" if use_ssl else "no"))
+
+    if use_ssl:
+        server = POP3_SSL(host, port)
+    else:
+        server = POP3(host, port)
+
+    server.user(user)
+    server.pass_(password)
+
+    messages, total = server.stat()
+    logger.info("Server has %d messages (total %d bytes)" % (
+                messages, total))
+
+    mailbox = mailbox_name(host, port, user)
+    try:
+        listing = server.uidl()[1]
+    except error_proto:
+        logger.warning("Server doesn't support UIDL, downloading all "
+                       "messages")
+        unseen = [(i + 1, None) for i in xrange(messages)]
+    else:
+        uids = []
+        for line in listing:
+            num, uid = line.split(None, 1)
+            uids.append((int(num), uid))
+        unseen = _filter_seen(server, mailbox, uids, skip)
+        logger.info("%d messages haven't been seen yet" % len(unseen))
+
+    for num, uid in unseen:
+        yield uid, '\n'.join(server.retr(num)[1])
+
+    server.quit()
+
+
+def _filter_seen(server, mailbox, uids, skip=()):
+    """Returns the (num, uid) pairs that we haven't retrieved before, and
+    that are not in skip.
+
+    Also forgets about the seen messages that have since been removed from
+    the mailbox.
+    """
+    sqlsession = Session()
+    try:
+        seen = set(uid
+                   for uid, in (sqlsession.query(models.SeenMessage.uid)
+                                          .filter(models.SeenMessage.mailbox ==
+                                                  mailbox)))
+        current = set(uid for num, uid in uids)
+        gone = list(seen - current)
+        for chunk in chunks(gone):
+            (sqlsession.query(models.SeenMessage)
+                       .filter(models.SeenMessage.mailbox == mailbox)
+                       .filter(models.SeenMessage.uid.in_(chunk))
+                       .delete(synchronize_session=False))
+        sqlsession.commit()
+        have_messages = sqlsession.query(models.Message.id).first() is not None
+    finally:
+        sqlsession.close()
+
+    unseen = [(num, uid) for num, uid in uids
+              if uid not in seen and uid not in skip]
+    if not seen and unseen and have_messages:
+        # We never recorded anything for this mailbox; it is probably the
+        # first run since we started tracking UIDs, so check the headers
+        # against the messages we already have rather than downloading
+        # everything again
+        unseen = _filter_stored(server, mailbox, unseen)
+    return unseen
+
+
+def _filter_stored(server, mailbox, uids):
+    """Returns the (num, uid) pairs whose message isn't in the database.
+
+    Only downloads the headers of each message. Messages that we already have
+    are marked as seen.
+    """
+    parser = Parser()
+    unseen = []
+    for chunk in chunks(uids):
+        msgids = {}
+        for num, uid in chunk:
+            headers = parser.parsestr('\n'.join(server.top(num, 0)[1]),
+                                      headersonly=True)
+            msgids[uid] = headers['Message-ID']
+        sqlsession = Session()
+        try:
+            stored = set(
+                    msgid
+                    for msgid, in (sqlsession.query(models.Message.id)
+                                             .filter(models.Message.id.in_(
+                                                 [m for m in msgids.values()
+                                                  if m]))))
+        finally:
+            sqlsession.close()
+        mark_seen(mailbox, [uid for uid, msgid in msgids.iteritems()
+                            if msgid in stored])
+        unseen.extend((num, uid) for num, uid in chunk
+                      if msgids[uid] not in stored)
+    logger.info("%d messages were already in the database" % (
+                len(uids) - len(unseen)))
+    return unseen
+
+
+def mark_seen(mailbox, uids):
+    """Records that these messages don't need to be downloaded again.
+    """
+    uids = [uid for uid in uids if uid is not None]
+    if not uids:
+        return
+    sqlsession = Session()
+    try:
+        sqlsession.execute(models.SeenMessage.__table__.insert(),
+                           [dict(mailbox=mailbox, uid=uid) for uid in uids])
+        sqlsession.commit()
+    except IntegrityError:
+        sqlsession.rollback()
+        logger.warning("Got IntegrityError marking messages as seen, "
+                       "marking them one by one")
+        for uid in uids:
+            sqlsession.add(models.SeenMessage(mailbox=mailbox, uid=uid))
+            try:
+                sqlsession.commit()
+            except IntegrityError:
+                sqlsession.rollback()
+    finally:
+        sqlsession.close()
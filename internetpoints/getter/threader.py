@@ -0,0 +1,212 @@
+import logging
+import re
+from sqlalchemy.orm import aliased
+
+from internetpoints import models, scoring, stats
+from internetpoints.storage import chunks
+
+
+logger = logging.getLogger(__name__)
+
+
+_MESSAGE_ID = re.compile(r'<[^>]+>')
+
+
+def parse_references(references, in_reply_to):
+    """Gets the list of message ids a message refers to, oldest first.
+
+    This is the References header, followed by the In-Reply-To header if
+    it's not already included, as described by JWZ.
+    """
+    refs = []
+    if references:
+        refs.extend(_MESSAGE_ID.findall(references))
+    if in_reply_to:
+        parent = _MESSAGE_ID.findall(in_reply_to)
+        if parent:
+            parent = parent[0]
+        else:
+            parent = in_reply_to.strip()
+        if parent not in refs:
+            refs.append(parent)
+    return refs
+
+
+def _rank(key):
+    # Existing threads win over new ones, older threads over newer ones
+    if key > 0:
+        return 0, key
+    else:
+        return 1, -key
+
+
+class ThreadIndex(object):
+    """Maps message ids to threads, for the duration of a getter run.
+
+    Threads are identified by keys: either the id of a Thread in the
+    database, or a negative number for a thread that hasn't been inserted
+    yet. When messages show that two threads are actually one, they are
+    merged with union-find; merges of existing threads are recorded so that
+    they can be applied to the database.
+
+    The index is filled with bulk queries, once per batch, by warm().
+    """
+    def __init__(self):
+        # Message id -> thread key
+        self.messages = {}
+        # Message id we don't have yet -> keys of threads referencing it
+        self.dangling = {}
+        # Merged thread key -> thread key it was merged into
+        self._parent = {}
+        # (thread key, thread key it was merged into) for existing threads
+        self.merges = []
+        self._next_new = -1
+
+    def reset(self):
+        """Forgets everything, after the database changes were rolled back.
+        """
+        self.__init__()
+
+    def warm(self, sqlsession, records):
+        """Loads what we need to know from the database to thread records.
+        """
+        wanted = set()
+        for record in records:
+            wanted.add(record['id'])
+            wanted.update(record['references'])
+        wanted = [msgid for msgid in wanted
+                  if msgid is not None and msgid not in self.messages]
+        for chunk in chunks(wanted):
+            self.messages.update(
+                    sqlsession.query(models.Message.id,
+                                     models.Message.thread_id)
+                              .filter(models.Message.id.in_(chunk)))
+
+        # Messages from previous batches or runs that referenced these
+        # messages before they arrived
+        self.dangling = {}
+        msgids = [record['id'] for record in records
+                  if record['id'] is not None]
+        referencing = aliased(models.Message)
+        for chunk in chunks(msgids):
+            query = (sqlsession.query(models.MessageReference.referenced_id,
+                                      referencing.thread_id)
+                               .join(referencing,
+                                     referencing.id ==
+                                     models.MessageReference.message_id)
+                               .filter(models.MessageReference.referenced_id
+                                       .in_(chunk))
+                               .distinct())
+            for msgid, thread_id in query:
+                self.dangling.setdefault(msgid, set()).add(thread_id)
+
+    def find(self, key):
+        """Returns the key of the thread a thread has been merged into.
+        """
+        root = key
+        while root in self._parent:
+            root = self._parent[root]
+        while key != root:
+            parent = self._parent[key]
+            self._parent[key] = root
+            key = parent
+        return root
+
+    def union(self, key1, key2):
+        """Merges two threads, returning the key of the resulting thread.
+        """
+        key1, key2 = self.find(key1), self.find(key2)
+        if key1 == key2:
+            return key1
+        if _rank(key2) < _rank(key1):
+            key1, key2 = key2, key1
+        self._parent[key2] = key1
+        if key2 > 0:
+            self.merges.append((key2, key1))
+        return key1
+
+    def resolve(self, key, thread_id):
+        """Records the id a new thread got when it was inserted.
+        """
+        self._parent[key] = thread_id
+
+    def add(self, record):
+        """Finds the thread for a new message, and records it.
+
+        Returns the thread key, which might be a new thread.
+        """
+        key = None
+        linked = [self.messages[ref] for ref in record['references']
+                  if ref in self.messages]
+        linked.extend(self.dangling.pop(record['id'], ()))
+        for other in linked:
+            if key is None:
+                key = self.find(other)
+            else:
+                key = self.union(key, other)
+        if key is None:
+            key = self._next_new
+            self._next_new -= 1
+        for ref in record['references']:
+            if ref not in self.messages:
+                self.dangling.setdefault(ref, set()).add(key)
+        self.messages[record['id']] = key
+        return key
+
+    def pop_merges(self):
+        """Returns the merges of existing threads since the last call.
+
+        Returns a dict mapping each resulting thread to the threads that were
+        merged into it.
+        """
+        merged = {}
+        for key, into in self.merges:
+            merged.setdefault(self.find(into), set()).add(key)
+        self.merges = []
+        return merged
+
+
+def merge_threads(sqlsession, thread_id, merged_ids):
+    """Moves the messages and tasks of some threads into another one.
+
+    The merged threads are deleted. If the same task was assigned on several
+    of them, only one assignation is kept. The merged threads are taken out
+    of the statistics. This doesn't commit, and doesn't update the summaries
+    or the statistics of the thread they are merged into.
+    """
+    merged_ids = list(merged_ids)
+    logger.info("Merging threads %s into thread %d" % (
+                ', '.join('%d' % i for i in merged_ids), thread_id))
+    TaskAssignation = models.TaskAssignation
+
+    (sqlsession.query(models.Message)
+               .filter(models.Message.thread_id.in_(merged_ids))
+               .update({models.Message.thread_id: thread_id},
+                       synchronize_session=False))
+
+    tasks = set(task_id
+                for task_id, in (sqlsession.query(TaskAssignation.task_id)
+                                           .filter(TaskAssignation.thread_id ==
+                                                   thread_id)))
+    assignations = (sqlsession.query(TaskAssignation.thread_id,
+                                     TaskAssignation.task_id)
+                              .filter(TaskAssignation.thread_id.in_(
+                                  merged_ids))).all()
+    for merged_id, task_id in assignations:
+        if task_id in tasks:
+            scoring.unassign_task(sqlsession, merged_id, task_id)
+        else:
+            tasks.add(task_id)
+            (sqlsession.query(TaskAssignation)
+                       .filter(TaskAssignation.thread_id == merged_id)
+                       .filter(TaskAssignation.task_id == task_id)
+                       .update({TaskAssignation.thread_id: thread_id},
+                               synchronize_session=False))
+
+    (sqlsession.query(models.ThreadSummary)
+               .filter(models.ThreadSummary.thread_id.in_(merged_ids))
+               .delete(synchronize_session=False))
+    stats.remove_threads(sqlsession, merged_ids)
+    (sqlsession.query(models.Thread)
+               .filter(models.Thread.id.in_(merged_ids))
+               .delete(synchronize_session=False))
@@ -0,0 +1,258 @@
+from contextlib import contextmanager
+import logging
+import os
+import tempfile
+import threading
+from timeit import default_timer
+
+from internetpoints import config
+
+
+logger = logging.getLogger(__name__)
+
+
+# Instrumentation, exposed in the Prometheus text format.
+#
+# Metrics are kept in each process, like the page cache. Nothing is hooked
+# unless METRICS is set (or SLOW_REQUEST_THRESHOLD, for the per-request SQL
+# counts), so that when it's disabled the cost is a single test.
+
+enabled = bool(getattr(config, 'METRICS', False))
+slow_request_threshold = getattr(config, 'SLOW_REQUEST_THRESHOLD', None)
+track_queries = enabled or slow_request_threshold is not None
+
+_lock = threading.Lock()
+# Metric name -> (type, help, {labels: value}); the value of a summary is a
+# [count, sum] list
+_metrics = {}
+
+
+def _values(kind, name, help):
+    metric = _metrics.get(name)
+    if metric is None:
+        metric = _metrics[name] = kind, help, {}
+    return metric[2]
+
+
+def _labels(labels):
+    return tuple(sorted(labels.iteritems()))
+
+
+def inc(name, help, value=1, **labels):
+    """Increments a counter.
+    """
+    if enabled:
+        key = _labels(labels)
+        with _lock:
+            values = _values('counter', name, help)
+            values[key] = values.get(key, 0) + value
+
+
+def set_gauge(name, help, value, **labels):
+    """Sets a gauge.
+    """
+    if enabled:
+        key = _labels(labels)
+        with _lock:
+            _values('gauge', name, help)[key] = value
+
+
+def observe(name, help, value, **labels):
+    """Records a duration or size in a summary.
+    """
+    if enabled:
+        key = _labels(labels)
+        with _lock:
+            values = _values('summary', name, help)
+            summary = values.get(key)
+            if summary is None:
+                summary = values[key] = [0, 0]
+            summary[0] += 1
+            summary[1] += value
+
+
+class _NullContext(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc_value, tb):
+        pass
+
+
+_NULL_CONTEXT = _NullContext()
+
+
+@contextmanager
+def _timer(name, help, labels):
+    start = default_timer()
+    try:
+        yield
+    finally:
+        observe(name, help, default_timer() - start, **labels)
+
+
+def timer(name, help, **labels):
+    """Context manager recording the seconds spent in it in a summary.
+    """
+    if enabled:
+        return _timer(name, help, labels)
+    else:
+        return _NULL_CONTEXT
+
+
+def _format(name, key, value):
+    if key:
+        name += '{%s}' % ','.join(
+                '%s="%s"' % (label, unicode(v).replace('\\', '\\\\')
+                                              .replace('"', '\\"')
+                                              .replace('\n', '\\n'))
+                for label, v in key)
+    return '%s %r' % (name, value)
+
+
+def render():
+    """Returns all the metrics in the Prometheus text format.
+    """
+    lines = []
+    with _lock:
+        for name in sorted(_metrics):
+            kind, help, values = _metrics[name]
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for key in sorted(values):
+                if kind == 'summary':
+                    count, total = values[key]
+                    lines.append(_format(name + '_count', key, count))
+                    lines.append(_format(name + '_sum', key, total))
+                else:
+                    lines.append(_format(name, key, values[key]))
+    return ''.join(line + '\n' for line in lines)
+
+
+def write_textfile(path):
+    """Writes the metrics to a file, atomically.
+
+    This is for processes that don't serve /metrics, like the getter; point
+    the node exporter's textfile collector at the file.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp = tempfile.mkstemp(dir=directory, prefix='.metrics-')
+    try:
+        with os.fdopen(fd, 'w') as fp:
+            fp.write(render())
+        os.chmod(temp, 0644)
+        os.rename(temp, path)
+    except:
+        os.remove(temp)
+        raise
+
+
+# SQL statements, counted per thread between start_tracking() and
+# stop_tracking()
+
+_tracking = threading.local()
+
+
+def _before_execute(conn, cursor, statement, parameters, context,
+                    executemany):
+    if getattr(_tracking, 'queries', None) is not None:
+        _tracking.started = default_timer()
+
+
+def _after_execute(conn, cursor, statement, parameters, context,
+                   executemany):
+    if getattr(_tracking, 'queries', None) is not None:
+        _tracking.queries += 1
+        _tracking.sql_time += default_timer() - _tracking.started
+
+
+def instrument_engine(engine):
+    """Hooks the engine to count statements, if tracking is enabled.
+    """
+    if track_queries:
+        from sqlalchemy import event
+
+        event.listen(engine, 'before_cursor_execute', _before_execute)
+        event.listen(engine, 'after_cursor_execute', _after_execute)
+
+
+def start_tracking():
+    """Starts counting the SQL statements run by this thread.
+    """
+    _tracking.queries = 0
+    _tracking.sql_time = 0.0
+    _tracking.start = default_timer()
+
+
+def stop_tracking():
+    """Stops counting, and returns (duration, statements, SQL time).
+    """
+    if getattr(_tracking, 'queries', None) is None:
+        return None
+    result = (default_timer() - _tracking.start,
+              _tracking.queries, _tracking.sql_time)
+    _tracking.queries = None
+    return result
+
+
+class Stages(object):
+    """Accumulates the time spent in each stage of a pipeline.
+
+    Stages can be nested, e.g. the getter fetches messages while it waits
+    for them to be parsed; the time is only counted in the innermost stage.
+    This does nothing unless metrics are enabled.
+    """
+    def __init__(self):
+        self.seconds = {}
+        self._stack = []
+        self._since = None
+
+    def _charge(self, now):
+        if self._stack:
+            name = self._stack[-1]
+            self.seconds[name] = (self.seconds.get(name, 0) +
+                                  now - self._since)
+        self._since = now
+
+    @contextmanager
+    def _stage(self, name):
+        self._charge(default_timer())
+        self._stack.append(name)
+        try:
+            yield
+        finally:
+            self._charge(default_timer())
+            self._stack.pop()
+
+    def stage(self, name):
+        """Context manager counting the time spent in it.
+        """
+        if enabled:
+            return self._stage(name)
+        else:
+            return _NULL_CONTEXT
+
+    def _wrap(self, name, iterable):
+        iterator = iter(iterable)
+        while True:
+            with self._stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def wrap(self, name, iterable):
+        """Counts the time spent getting items from an iterable.
+        """
+        if enabled:
+            return self._wrap(name, iterable)
+        else:
+            return iterable
+
+    def reset(self):
+        self.seconds = {}
+
+
+# Stages of the getter
+getter_stages = Stages()
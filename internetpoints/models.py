@@ -1,9 +1,10 @@
 from datetime import datetime
 from sqlalchemy import Column
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship
-from sqlalchemy.schema import ForeignKey
-from sqlalchemy.types import Integer, String, Text, DateTime
+from sqlalchemy.orm import deferred, relationship
+from sqlalchemy.schema import ForeignKey, Index
+from sqlalchemy.types import Boolean, Integer, LargeBinary, String, Text, \
+    DateTime
 
 
 Base = declarative_base()
@@ -18,6 +19,9 @@ class Poster(Base):
 
     emails = relationship('PosterEmail')
 
+    __table_args__ = (Index('ix_posters_score_id', 'score', 'id'),
+                      Index('ix_posters_name', 'name'))
+
 
 class PosterEmail(Base):
     __tablename__ = 'poster_emails'
@@ -28,6 +32,17 @@ class PosterEmail(Base):
     poster = relationship('Poster', back_populates='emails')
 
 
+class Address(Base):
+    __tablename__ = 'addresses'
+
+    # Every address seen, as a sender or registered to a poster, with the
+    # form used to match its variants, see internetpoints.addresses
+    address = Column(String, primary_key=True)
+    normalized = Column(String, nullable=False)
+
+    __table_args__ = (Index('ix_addresses_normalized', 'normalized'),)
+
+
 class Thread(Base):
     __tablename__ = 'threads'
 
@@ -43,6 +58,37 @@ class Thread(Base):
     def assigned(self):
         return bool(self.task_assignations)
 
+    __table_args__ = (Index('ix_threads_last_msg_id', 'last_msg', 'id'),)
+
+
+class ThreadSummary(Base):
+    __tablename__ = 'thread_summaries'
+
+    # Denormalized view of a thread, for listings; see
+    # internetpoints.summaries
+    thread_id = Column(Integer, ForeignKey('threads.id'), primary_key=True)
+    thread = relationship('Thread')
+    # Date is UTC!
+    last_msg = Column(DateTime, nullable=False)
+    subject = Column(Text, nullable=False)
+    message_count = Column(Integer, nullable=False)
+    participant_count = Column(Integer, nullable=False)
+    assigned = Column(Boolean, nullable=False)
+    # Names of the tasks assigned to this thread, one per line
+    task_names = Column(Text, nullable=False)
+
+    @property
+    def tasks(self):
+        if not self.task_names:
+            return []
+        return self.task_names.split('\n')
+
+    __table_args__ = (
+        Index('ix_thread_summaries_last_msg', 'last_msg', 'thread_id'),
+        Index('ix_thread_summaries_assigned_last_msg',
+              'assigned', 'last_msg', 'thread_id'),
+    )
+
 
 class Message(Base):
     __tablename__ = 'messages'
@@ -50,7 +96,9 @@ class Message(Base):
     id = Column(String, primary_key=True)
     from_ = Column(String, nullable=False)
     subject = Column(Text, nullable=False)
-    text = Column(Text, nullable=False)
+    # Deferred, so that the bodies are only loaded when asked for; empty if
+    # the body is stored compressed, see internetpoints.bodies
+    text = deferred(Column(Text, nullable=False))
     # Date is UTC!
     date = Column(DateTime, nullable=False)
 
@@ -61,6 +109,66 @@ class Message(Base):
                                 foreign_keys=from_,
                                 remote_side=PosterEmail.address)
 
+    __table_args__ = (Index('ix_messages_from_', 'from_'),
+                      Index('ix_messages_date_id', 'date', 'id'))
+
+
+class MessageBlob(Base):
+    __tablename__ = 'message_blobs'
+
+    # Compressed bodies, content-addressed so that identical bodies are only
+    # stored once, see internetpoints.bodies
+    hash = Column(String, primary_key=True)
+    data = Column(LargeBinary, nullable=False)
+
+
+class MessageBody(Base):
+    __tablename__ = 'message_bodies'
+
+    # Body of a message stored compressed instead of in Message.text
+    message_id = Column(String, ForeignKey('messages.id'), primary_key=True)
+    blob_hash = Column(String, ForeignKey('message_blobs.hash'),
+                       nullable=False)
+    # Length of the full text, in characters
+    length = Column(Integer, nullable=False)
+
+    __table_args__ = (Index('ix_message_bodies_blob_hash', 'blob_hash'),)
+
+
+class MessageReference(Base):
+    __tablename__ = 'message_references'
+
+    # Message ids from the References and In-Reply-To headers, used to merge
+    # threads when a parent arrives after its replies
+    message_id = Column(String, ForeignKey('messages.id'), primary_key=True)
+    referenced_id = Column(String, primary_key=True)
+
+    __table_args__ = (Index('ix_message_references_referenced_id',
+                            'referenced_id'),)
+
+
+class SearchTerm(Base):
+    __tablename__ = 'search_terms'
+
+    # Inverted index for databases without full-text search, see
+    # internetpoints.search
+    term = Column(String, primary_key=True)
+    message_id = Column(String, ForeignKey('messages.id'), primary_key=True)
+    weight = Column(Integer, nullable=False)
+
+
+class SearchRow(Base):
+    __tablename__ = 'search_rows'
+
+    # Rowid of each message in the FTS5 index, see internetpoints.search; the
+    # rowids of the messages table can change on VACUUM, since its primary
+    # key isn't an integer
+    id = Column(Integer, primary_key=True)
+    message_id = Column(String, ForeignKey('messages.id'), nullable=False)
+
+    __table_args__ = (Index('ix_search_rows_message_id', 'message_id',
+                            unique=True),)
+
 
 class Task(Base):
     __tablename__ = 'tasks'
@@ -84,3 +192,91 @@ class TaskAssignation(Base):
     task = relationship('Task', back_populates='assignations')
     poster_id = Column(Integer, ForeignKey('posters.id'), nullable=False)
     poster = relationship('Poster')
+
+    __table_args__ = (Index('ix_thread_tasks_date', 'date'),)
+
+
+class PosterMonthlyScore(Base):
+    __tablename__ = 'poster_monthly_scores'
+
+    # Points earned by a poster during a month, see internetpoints.scoring
+    poster_id = Column(Integer, ForeignKey('posters.id'), primary_key=True)
+    poster = relationship('Poster')
+    # Beginning of the month, UTC
+    month = Column(DateTime, primary_key=True)
+    points = Column(Integer, nullable=False)
+
+    __table_args__ = (Index('ix_poster_monthly_scores_month', 'month'),)
+
+
+class ThreadParticipant(Base):
+    __tablename__ = 'thread_participants'
+
+    # First message of each sender in a thread, from which the daily
+    # statistics are updated, see internetpoints.stats
+    thread_id = Column(Integer, ForeignKey('threads.id'), primary_key=True)
+    address = Column(String, primary_key=True)
+    # Date is UTC!
+    first_msg = Column(DateTime, nullable=False)
+    # Sent the first message of the thread
+    starter = Column(Boolean, nullable=False)
+    # First sender after the starter
+    first_responder = Column(Boolean, nullable=False)
+
+
+class AddressDailyStats(Base):
+    __tablename__ = 'address_daily_stats'
+
+    # Activity of a sender address during a day, see internetpoints.stats
+    address = Column(String, primary_key=True)
+    # Beginning of the day, UTC
+    day = Column(DateTime, primary_key=True)
+    messages = Column(Integer, nullable=False)
+    threads_started = Column(Integer, nullable=False)
+    threads_joined = Column(Integer, nullable=False)
+    first_responses = Column(Integer, nullable=False)
+
+    __table_args__ = (Index('ix_address_daily_stats_day', 'day'),)
+
+
+class AddressReplyLatency(Base):
+    __tablename__ = 'address_reply_latencies'
+
+    # Histogram of the time taken to reply, per sender address and day; see
+    # internetpoints.stats for the buckets
+    address = Column(String, primary_key=True)
+    # Beginning of the day, UTC
+    day = Column(DateTime, primary_key=True)
+    bucket = Column(Integer, primary_key=True)
+    replies = Column(Integer, nullable=False)
+
+    __table_args__ = (Index('ix_address_reply_latencies_day', 'day'),)
+
+
+class SeenMessage(Base):
+    __tablename__ = 'seen_messages'
+
+    # Identifies the POP3 mailbox, see getter.pop3.mailbox_name()
+    mailbox = Column(String, primary_key=True)
+    # Unique id of the message in that mailbox, as given by UIDL
+    uid = Column(String, primary_key=True)
+
+
+class ImapState(Base):
+    __tablename__ = 'imap_states'
+
+    # Identifies the IMAP folder, see getter.imap.mailbox_name()
+    mailbox = Column(String, primary_key=True)
+    uidvalidity = Column(String, nullable=False)
+    # Highest UID that has been stored
+    last_uid = Column(Integer, nullable=False)
+
+
+class CacheGeneration(Base):
+    __tablename__ = 'cache_generation'
+
+    # Single row, see internetpoints.cache
+    id = Column(Integer, primary_key=True)
+    generation = Column(Integer, nullable=False)
+    # Date is UTC!
+    changed = Column(DateTime, nullable=False)
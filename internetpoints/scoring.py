@@ -0,0 +1,369 @@
+from datetime import datetime
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.sql import and_, bindparam, func, literal, select
+
+from internetpoints import models
+from internetpoints.storage import TransactionConflict, chunks
+
+
+# Scores are derived from the TaskAssignation ledger: Poster.score is the
+# total of the rewards of the tasks assigned to a poster, and
+# PosterMonthlyScore holds the same total per calendar month. Both are
+# updated incrementally by the functions in this module, and can be
+# recomputed with rebuild_scores().
+
+
+def month_start(date):
+    """Returns the beginning of the month a date is in.
+    """
+    return datetime(date.year, date.month, 1)
+
+
+def next_month(date):
+    """Returns the beginning of the month following a date.
+    """
+    if date.month == 12:
+        return datetime(date.year + 1, 1, 1)
+    else:
+        return datetime(date.year, date.month + 1, 1)
+
+
+def _add_points(sqlsession, poster_id, month, points):
+    """Adds points to a poster's total and to their monthly bucket.
+    """
+    if not points:
+        return
+    (sqlsession.query(models.Poster)
+               .filter(models.Poster.id == poster_id)
+               .update({models.Poster.score: models.Poster.score + points},
+                       synchronize_session=False))
+    bucket = models.PosterMonthlyScore
+    updated = (sqlsession.query(bucket)
+                         .filter(bucket.poster_id == poster_id)
+                         .filter(bucket.month == month)
+                         .update({bucket.points: bucket.points + points},
+                                 synchronize_session=False))
+    if not updated:
+        try:
+            sqlsession.execute(bucket.__table__.insert(),
+                               dict(poster_id=poster_id, month=month,
+                                    points=points))
+        except IntegrityError:
+            # Another transaction created the bucket since our update
+            raise TransactionConflict("Monthly score created concurrently")
+
+
+def assign_task(sqlsession, thread_id, task_id, poster_id, date=None):
+    """Assigns a task to a thread and gives the reward to the poster.
+
+    This doesn't commit. Returns False if the thread, task or poster doesn't
+    exist, and raises IntegrityError if the task was already assigned on this
+    thread.
+    """
+    if date is None:
+        date = datetime.utcnow()
+    # The existence checks and the insert are a single statement, so that the
+    # thread can't disappear in between (e.g. merged by the getter)
+    threads = models.Thread.__table__
+    tasks = models.Task.__table__
+    posters = models.Poster.__table__
+    assignations = models.TaskAssignation.__table__
+    inserted = sqlsession.execute(
+            assignations.insert().from_select(
+                ['thread_id', 'task_id', 'poster_id', 'date'],
+                select([threads.c.id, tasks.c.id, posters.c.id,
+                        literal(date, models.TaskAssignation.date.type)])
+                .where(and_(threads.c.id == bindparam('thread_id'),
+                            tasks.c.id == bindparam('task_id'),
+                            posters.c.id == bindparam('poster_id')))),
+            dict(thread_id=thread_id, task_id=task_id,
+                 poster_id=poster_id)).rowcount
+    if not inserted:
+        return False
+    # Read in the same transaction, after the insert took the write lock
+    reward, = (sqlsession.query(models.Task.reward)
+                         .filter(models.Task.id == task_id)).one()
+    _add_points(sqlsession, poster_id, month_start(date), reward)
+    return True
+
+
+def unassign_task(sqlsession, thread_id, task_id):
+    """Removes a task from a thread, and takes back the reward.
+
+    This doesn't commit. Returns False if the task wasn't assigned.
+    """
+    assignation = (sqlsession.query(models.TaskAssignation.poster_id,
+                                    models.TaskAssignation.date)
+                             .filter(models.TaskAssignation.thread_id ==
+                                     thread_id)
+                             .filter(models.TaskAssignation.task_id ==
+                                     task_id)).first()
+    if assignation is None:
+        return False
+    poster_id, date = assignation
+    # The read above might not be in the write transaction: only delete the
+    # row we read, and start again if it has changed since (e.g. the task
+    # was given to someone else)
+    deleted = (sqlsession.query(models.TaskAssignation)
+                         .filter(models.TaskAssignation.thread_id ==
+                                 thread_id)
+                         .filter(models.TaskAssignation.task_id == task_id)
+                         .filter(models.TaskAssignation.poster_id ==
+                                 poster_id)
+                         .filter(models.TaskAssignation.date == date)
+                         .delete(synchronize_session=False))
+    if not deleted:
+        raise TransactionConflict("Assignation changed concurrently")
+    # Read after the delete took the write lock, like assign_task(): the
+    # reward might have been changed since the first read
+    reward, = (sqlsession.query(models.Task.reward)
+                         .filter(models.Task.id == task_id)).one()
+    _add_points(sqlsession, poster_id, month_start(date), -reward)
+    return True
+
+
+def _existing(sqlsession, column, ids):
+    found = set()
+    for chunk in chunks(list(ids)):
+        found.update(row_id
+                     for row_id, in (sqlsession.query(column)
+                                               .filter(column.in_(chunk))))
+    return found
+
+
+def assign_tasks(sqlsession, assignments, date=None):
+    """Assigns many tasks at once, giving the rewards to the posters.
+
+    assignments is a list of (thread id, task id, poster id). Returns a list
+    with the outcome of each one: 'assigned', 'no_thread', 'no_task',
+    'no_poster', or 'already_assigned' (also for repeats in the list). This
+    doesn't commit.
+    """
+    if date is None:
+        date = datetime.utcnow()
+    Assignation = models.TaskAssignation
+    threads = _existing(sqlsession, models.Thread.id,
+                        set(a[0] for a in assignments))
+    tasks = _existing(sqlsession, models.Task.id,
+                      set(a[1] for a in assignments))
+    posters = _existing(sqlsession, models.Poster.id,
+                        set(a[2] for a in assignments))
+    assigned = set()
+    for chunk in chunks(list(threads)):
+        assigned.update(sqlsession.query(Assignation.thread_id,
+                                         Assignation.task_id)
+                                  .filter(Assignation.thread_id.in_(chunk)))
+
+    results = []
+    rows = []
+    for thread_id, task_id, poster_id in assignments:
+        if thread_id not in threads:
+            results.append('no_thread')
+        elif task_id not in tasks:
+            results.append('no_task')
+        elif poster_id not in posters:
+            results.append('no_poster')
+        elif (thread_id, task_id) in assigned:
+            results.append('already_assigned')
+        else:
+            assigned.add((thread_id, task_id))
+            rows.append(dict(thread_id=thread_id, task_id=task_id,
+                             poster_id=poster_id, date=date))
+            results.append('assigned')
+    if not rows:
+        return results
+
+    try:
+        sqlsession.execute(Assignation.__table__.insert(), rows)
+    except IntegrityError:
+        raise TransactionConflict("Task assigned concurrently")
+    # A thread might have been merged away since we checked, in which case
+    # everything is checked again
+    thread_ids = set(row['thread_id'] for row in rows)
+    if len(_existing(sqlsession, models.Thread.id, thread_ids)) != len(
+            thread_ids):
+        raise TransactionConflict("Thread removed concurrently")
+
+    # Read after the insert took the write lock, like assign_task()
+    rewards = dict(sqlsession.query(models.Task.id, models.Task.reward)
+                             .filter(models.Task.id.in_(
+                                 list(set(row['task_id'] for row in rows)))))
+    points = {}
+    for row in rows:
+        points[row['poster_id']] = (points.get(row['poster_id'], 0) +
+                                    rewards[row['task_id']])
+    month = month_start(date)
+    for poster_id, total in points.iteritems():
+        _add_points(sqlsession, poster_id, month, total)
+    return results
+
+
+def set_reward(sqlsession, task_id, reward):
+    """Changes the reward of a task, updating the scores of everyone who got
+    it.
+
+    This doesn't commit.
+    """
+    old_reward, = (sqlsession.query(models.Task.reward)
+                             .filter(models.Task.id == task_id)).one()
+    updated = (sqlsession.query(models.Task)
+                         .filter(models.Task.id == task_id)
+                         .filter(models.Task.reward == old_reward)
+                         .update({models.Task.reward: reward},
+                                 synchronize_session=False))
+    if not updated:
+        raise TransactionConflict("Reward changed concurrently")
+    delta = reward - old_reward
+    if not delta:
+        return
+    counts = {}
+    for poster_id, date in (sqlsession.query(models.TaskAssignation.poster_id,
+                                             models.TaskAssignation.date)
+                                      .filter(models.TaskAssignation.task_id ==
+                                              task_id)):
+        key = poster_id, month_start(date)
+        counts[key] = counts.get(key, 0) + 1
+    for (poster_id, month), count in counts.iteritems():
+        _add_points(sqlsession, poster_id, month, delta * count)
+
+
+def _ledger_scores(sqlsession):
+    """Computes the scores from the ledger.
+
+    Returns the total per poster, and the points per (poster, month).
+    """
+    ledger = (sqlsession.query(models.TaskAssignation.poster_id,
+                               models.TaskAssignation.date,
+                               models.Task.reward)
+                        .join(models.TaskAssignation.task))
+    totals = {}
+    buckets = {}
+    for poster_id, date, reward in ledger.yield_per(1000):
+        totals[poster_id] = totals.get(poster_id, 0) + reward
+        key = poster_id, month_start(date)
+        buckets[key] = buckets.get(key, 0) + reward
+    return totals, buckets
+
+
+def check_scores(sqlsession):
+    """Compares the stored scores with the ledger.
+
+    Returns a list of (poster id, month or None, stored, expected) for the
+    totals and monthly buckets that don't match.
+    """
+    totals, buckets = _ledger_scores(sqlsession)
+    errors = []
+    for poster_id, score in sqlsession.query(models.Poster.id,
+                                             models.Poster.score):
+        expected = totals.get(poster_id, 0)
+        if score != expected:
+            errors.append((poster_id, None, score, expected))
+    bucket = models.PosterMonthlyScore
+    stored = dict(((poster_id, month), points)
+                  for poster_id, month, points
+                  in sqlsession.query(bucket.poster_id, bucket.month,
+                                      bucket.points))
+    for key in sorted(set(stored).union(buckets)):
+        if stored.get(key, 0) != buckets.get(key, 0):
+            errors.append(key + (stored.get(key, 0), buckets.get(key, 0)))
+    return errors
+
+
+def rebuild_scores(sqlsession):
+    """Recomputes all the scores from the ledger, and commits.
+    """
+    totals, buckets = _ledger_scores(sqlsession)
+
+    (sqlsession.query(models.Poster)
+               .update({models.Poster.score: 0},
+                       synchronize_session=False))
+    posters = models.Poster.__table__
+    for poster_id, score in totals.iteritems():
+        sqlsession.execute(posters.update()
+                                  .where(posters.c.id == poster_id)
+                                  .values(score=score))
+    (sqlsession.query(models.PosterMonthlyScore)
+               .delete(synchronize_session=False))
+    if buckets:
+        sqlsession.execute(models.PosterMonthlyScore.__table__.insert(),
+                           [dict(poster_id=poster_id, month=month,
+                                 points=points)
+                            for (poster_id, month), points
+                            in buckets.iteritems()])
+    sqlsession.commit()
+    return len(totals)
+
+
+def _ledger_points(sqlsession, since, until):
+    """Sums the points in the ledger between two dates, per poster.
+    """
+    query = (sqlsession.query(models.TaskAssignation.poster_id,
+                              func.sum(models.Task.reward))
+                       .join(models.TaskAssignation.task)
+                       .filter(models.TaskAssignation.date >= since)
+                       .filter(models.TaskAssignation.date < until)
+                       .group_by(models.TaskAssignation.poster_id))
+    return dict(query)
+
+
+def _bucket_points(sqlsession, since, until):
+    """Sums the monthly buckets between two month starts, per poster.
+    """
+    bucket = models.PosterMonthlyScore
+    query = sqlsession.query(bucket.poster_id, func.sum(bucket.points))
+    if since is not None:
+        query = query.filter(bucket.month >= since)
+    query = (query.filter(bucket.month < until)
+                  .group_by(bucket.poster_id))
+    return dict(query)
+
+
+def leaderboard(sqlsession, since=None, until=None):
+    """Gets the points earned between two dates (UTC), per poster.
+
+    Either date can be None for an open interval. Whole months are read from
+    the monthly buckets; only the assignations from the partial months at
+    the ends of the interval are read from the ledger.
+
+    Returns a list of (poster, points) pairs, best first.
+    """
+    if since is None and until is None:
+        posters = (sqlsession.query(models.Poster)
+                             .filter(models.Poster.score != 0)
+                             .order_by(models.Poster.score.desc(),
+                                       models.Poster.id.desc())).all()
+        return [(poster, poster.score) for poster in posters]
+
+    if until is None:
+        until = datetime.utcnow()
+    # Whole months are [first_month, last_month)
+    if since is None:
+        first_month = None
+    elif since == month_start(since):
+        first_month = since
+    else:
+        first_month = next_month(since)
+    last_month = month_start(until)
+
+    points = {}
+
+    def add(partial):
+        for poster_id, p in partial.iteritems():
+            points[poster_id] = points.get(poster_id, 0) + p
+
+    if first_month is not None and first_month >= last_month:
+        add(_ledger_points(sqlsession, since, until))
+    else:
+        add(_bucket_points(sqlsession, first_month, last_month))
+        if first_month is not None and since < first_month:
+            add(_ledger_points(sqlsession, since, first_month))
+        if last_month < until:
+            add(_ledger_points(sqlsession, last_month, until))
+
+    poster_ids = [poster_id for poster_id, p in points.iteritems() if p]
+    posters = []
+    for chunk in chunks(poster_ids):
+        posters.extend(sqlsession.query(models.Poster)
+                                 .filter(models.Poster.id.in_(chunk)))
+    return sorted(((poster, points[poster.id]) for poster in posters),
+                  key=lambda (poster, p): (-p, -poster.id))
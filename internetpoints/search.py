@@ -0,0 +1,182 @@
+import logging
+import re
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.sql import distinct, func, text
+
+from internetpoints import bodies, models
+from internetpoints.storage import chunks, engine
+
+
+logger = logging.getLogger(__name__)
+
+
+# Full-text search over the subject, text and sender of the messages.
+#
+# On SQLite, if it was built with FTS5, this uses a contentless FTS5 table
+# whose rowids are given to the messages by the search_rows table. Otherwise,
+# this uses a simple inverted index in the search_terms table.
+
+_WORD = re.compile(r'\w+', re.UNICODE)
+_MAX_TERM_LENGTH = 40
+# Terms found in the subject count more than those in the body
+_SUBJECT_WEIGHT = 3
+
+_FTS_TABLE = ('CREATE VIRTUAL TABLE IF NOT EXISTS message_fts '
+              'USING fts5(subject, text, from_, content=\'\')')
+# Previous FTS5 table, keyed on the rowids of the messages
+_OLD_FTS_TABLE = 'message_search'
+
+_backend = None
+
+
+def backend():
+    """Returns the backend in use: 'fts5' or 'terms'.
+    """
+    global _backend
+
+    if _backend is None:
+        _backend = 'terms'
+        if engine.dialect.name == 'sqlite':
+            if engine.has_table(_OLD_FTS_TABLE):
+                logger.warning("The search index is from an older version, "
+                               "run rebuild-search")
+            if engine.has_table('message_fts'):
+                _backend = 'fts5'
+            else:
+                try:
+                    engine.execute(_FTS_TABLE)
+                except OperationalError as e:
+                    if 'no such module' not in str(e):
+                        raise
+                    logger.warning("SQLite doesn't have FTS5, using the "
+                                   "built-in search index")
+                else:
+                    _backend = 'fts5'
+    return _backend
+
+
+# Create the FTS5 table now rather than in the middle of a transaction, where
+# the other connection would wait for the transaction's lock
+backend()
+
+
+def terms(string):
+    """Splits a string into search terms.
+    """
+    return [term
+            for term in _WORD.findall(string.lower())
+            if len(term) <= _MAX_TERM_LENGTH]
+
+
+def index_messages(sqlsession, messages):
+    """Adds new messages to the index.
+
+    messages is a list of dicts with id, subject, text and from_. This doesn't
+    commit; it should be called in the transaction that inserts them.
+    """
+    if not messages:
+        return
+    if backend() == 'fts5':
+        for chunk in chunks(messages):
+            sqlsession.execute(models.SearchRow.__table__.insert(),
+                               [dict(message_id=msg['id']) for msg in chunk])
+            rowids = dict(sqlsession.query(models.SearchRow.message_id,
+                                           models.SearchRow.id)
+                                    .filter(models.SearchRow.message_id.in_(
+                                        [msg['id'] for msg in chunk])))
+            sqlsession.execute(
+                    text('INSERT INTO message_fts(rowid, subject, text, '
+                         'from_) VALUES(:rowid, :subject, :text, :from_)'),
+                    [dict(rowid=rowids[msg['id']], subject=msg['subject'],
+                          text=msg['text'], from_=msg['from_'])
+                     for msg in chunk])
+    else:
+        rows = []
+        for msg in messages:
+            weights = {}
+            for term in terms(msg['text']) + terms(msg['from_']):
+                weights[term] = weights.get(term, 0) + 1
+            for term in terms(msg['subject']):
+                weights[term] = weights.get(term, 0) + _SUBJECT_WEIGHT
+            rows.extend(dict(term=term, message_id=msg['id'], weight=weight)
+                        for term, weight in weights.iteritems())
+        if rows:
+            sqlsession.execute(models.SearchTerm.__table__.insert(), rows)
+
+
+def search(sqlsession, query, limit=50):
+    """Finds the threads matching a query, best first.
+
+    Every word of the query has to appear in the same message. Returns a list
+    of thread ids.
+    """
+    words = terms(query)
+    if not words:
+        return []
+    if backend() == 'fts5':
+        # Quote each word so that the query syntax can't be used
+        match = ' '.join('"%s"' % word for word in words)
+        results = sqlsession.execute(
+                text('SELECT messages.thread_id '
+                     'FROM message_fts '
+                     'JOIN search_rows ON search_rows.id = message_fts.rowid '
+                     'JOIN messages ON messages.id = search_rows.message_id '
+                     'WHERE message_fts MATCH :match '
+                     'ORDER BY bm25(message_fts, %d.0, 1.0, 1.0) '
+                     'LIMIT :limit' % _SUBJECT_WEIGHT),
+                dict(match=match, limit=limit * 10))
+    else:
+        words = list(set(words))
+        SearchTerm = models.SearchTerm
+        results = (sqlsession.query(models.Message.thread_id)
+                             .join(SearchTerm,
+                                   SearchTerm.message_id == models.Message.id)
+                             .filter(SearchTerm.term.in_(words))
+                             .group_by(models.Message.thread_id,
+                                       models.Message.id)
+                             .having(func.count(distinct(SearchTerm.term)) ==
+                                     len(words))
+                             .order_by(func.sum(SearchTerm.weight).desc())
+                             .limit(limit * 10))
+    # Messages come best first, keep the best message of each thread
+    thread_ids = []
+    for thread_id, in results:
+        if thread_id not in thread_ids:
+            thread_ids.append(thread_id)
+    return thread_ids[:limit]
+
+
+def rebuild_index(sqlsession):
+    """Indexes all the messages again, and commits.
+    """
+    if backend() == 'fts5':
+        sqlsession.execute(text('DROP TABLE IF EXISTS %s' % _OLD_FTS_TABLE))
+        sqlsession.execute(text('DROP TABLE message_fts'))
+        sqlsession.execute(text(_FTS_TABLE))
+        sqlsession.query(models.SearchRow).delete(synchronize_session=False)
+    else:
+        sqlsession.query(models.SearchTerm).delete(synchronize_session=False)
+    Message = models.Message
+    count = 0
+    query = (sqlsession.query(Message.id, Message.subject, Message.from_)
+                       .order_by(Message.id))
+    last_id = None
+    while True:
+        # Paginate on the primary key, since we are writing to the database
+        # at the same time
+        page = query
+        if last_id is not None:
+            page = page.filter(Message.id > last_id)
+        batch = page.limit(1000).all()
+        if not batch:
+            break
+        texts = bodies.load_texts(sqlsession,
+                                  [msgid for msgid, subject, from_ in batch])
+        index_messages(sqlsession,
+                       [dict(id=msgid, subject=subject, text=texts[msgid],
+                             from_=from_)
+                        for msgid, subject, from_ in batch])
+        count += len(batch)
+        last_id = batch[-1][0]
+    sqlsession.commit()
+    return count
@@ -0,0 +1,399 @@
+from datetime import datetime
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.sql import and_, bindparam, case, func, literal, or_, select
+
+from internetpoints import models
+from internetpoints.storage import TransactionConflict, chunks
+
+
+# Poster statistics, rolled up per sender address and per day.
+#
+# AddressDailyStats counts the messages each address sent, the threads it
+# started and joined, and the threads where it was the first to answer;
+# AddressReplyLatency is a histogram of the time between a message and the
+# one it answers. The getter updates them incrementally, the thread counts
+# through the ThreadParticipant rows of the threads it changes, and they can
+# be recomputed with rebuild_stats(). They are kept per address rather than
+# per poster, so that linking an address to a poster doesn't change them.
+
+# Upper bounds of the reply latency buckets, in seconds; the last bucket has
+# no bound
+LATENCY_BUCKETS = [5 * 60, 15 * 60, 3600, 3 * 3600, 6 * 3600, 12 * 3600,
+                   86400, 2 * 86400, 7 * 86400, None]
+
+_COUNTERS = ('messages', 'threads_started', 'threads_joined',
+             'first_responses')
+
+
+def day_start(date):
+    """Returns the beginning of the day a date is in.
+    """
+    return datetime(date.year, date.month, date.day)
+
+
+def latency_bucket(seconds):
+    """Returns the index of the latency bucket a duration falls in.
+    """
+    for i, bound in enumerate(LATENCY_BUCKETS):
+        if bound is None or seconds < bound:
+            return i
+
+
+def describe_latency(bucket):
+    """Describes a latency bucket, e.g. 'under 3 hours'.
+    """
+    def duration(seconds):
+        if seconds < 3600:
+            return '%d minutes' % (seconds // 60)
+        elif seconds < 86400:
+            hours = seconds // 3600
+            return '1 hour' if hours == 1 else '%d hours' % hours
+        else:
+            days = seconds // 86400
+            return '1 day' if days == 1 else '%d days' % days
+
+    bound = LATENCY_BUCKETS[bucket]
+    if bound is None:
+        return 'over %s' % duration(LATENCY_BUCKETS[bucket - 1])
+    return 'under %s' % duration(bound)
+
+
+def _count(deltas, address, date, counter, value):
+    key = address, day_start(date)
+    counts = deltas.get(key)
+    if counts is None:
+        counts = deltas[key] = dict.fromkeys(_COUNTERS, 0)
+    counts[counter] += value
+
+
+def _count_participant(deltas, address, first_msg, starter, first_responder,
+                       sign):
+    _count(deltas, address, first_msg, 'threads_joined', sign)
+    if starter:
+        _count(deltas, address, first_msg, 'threads_started', sign)
+    if first_responder:
+        _count(deltas, address, first_msg, 'first_responses', sign)
+
+
+def _reply_latency(date, parent_dates):
+    """Seconds between a message and the latest earlier message it refers to.
+    """
+    parent_dates = [parent_date for parent_date in parent_dates
+                    if parent_date is not None and parent_date <= date]
+    if not parent_dates:
+        return None
+    delta = date - max(parent_dates)
+    return delta.days * 86400 + delta.seconds
+
+
+def _count_messages(sqlsession, records, deltas, latencies):
+    dates = dict((record['id'], record['date']) for record in records)
+    referenced = set(reference
+                     for record in records
+                     for reference in record['references'])
+    referenced.difference_update(dates)
+    for chunk in chunks(list(referenced)):
+        dates.update(sqlsession.query(models.Message.id, models.Message.date)
+                               .filter(models.Message.id.in_(chunk)))
+    for record in records:
+        _count(deltas, record['from_'], record['date'], 'messages', 1)
+        latency = _reply_latency(record['date'],
+                                 [dates.get(reference)
+                                  for reference in record['references']])
+        if latency is not None:
+            key = (record['from_'], day_start(record['date']),
+                   latency_bucket(latency))
+            counts = latencies.setdefault(key, dict(replies=0))
+            counts['replies'] += 1
+
+
+def _participants(sqlsession, thread_ids):
+    """Computes the ThreadParticipant rows of some threads, as dicts.
+    """
+    Message = models.Message
+    firsts = {}
+    for thread_id, address, first_msg in (
+            sqlsession.query(Message.thread_id, Message.from_,
+                             func.min(Message.date))
+                      .filter(Message.thread_id.in_(thread_ids))
+                      .group_by(Message.thread_id, Message.from_)):
+        firsts.setdefault(thread_id, []).append((first_msg, address))
+    rows = []
+    for thread_id, participants in firsts.iteritems():
+        participants.sort()
+        for i, (first_msg, address) in enumerate(participants):
+            rows.append(dict(thread_id=thread_id, address=address,
+                             first_msg=first_msg, starter=i == 0,
+                             first_responder=i == 1))
+    return rows
+
+
+def _remove_threads(sqlsession, thread_ids, deltas):
+    Participant = models.ThreadParticipant
+    for chunk in chunks(thread_ids):
+        for row in (sqlsession.query(Participant.address,
+                                     Participant.first_msg,
+                                     Participant.starter,
+                                     Participant.first_responder)
+                              .filter(Participant.thread_id.in_(chunk))):
+            _count_participant(deltas, *row, sign=-1)
+        (sqlsession.query(Participant)
+                   .filter(Participant.thread_id.in_(chunk))
+                   .delete(synchronize_session=False))
+
+
+def _add_threads(sqlsession, thread_ids, deltas):
+    for chunk in chunks(thread_ids):
+        rows = _participants(sqlsession, chunk)
+        for row in rows:
+            _count_participant(deltas, row['address'], row['first_msg'],
+                               row['starter'], row['first_responder'],
+                               sign=1)
+        if rows:
+            sqlsession.execute(models.ThreadParticipant.__table__.insert(),
+                               rows)
+
+
+def _add_counts(sqlsession, table, key_columns, deltas):
+    """Adds to the counters of rollup rows, creating the missing rows.
+
+    deltas maps tuples of the key columns to dicts of counter increments.
+    """
+    deltas = dict((key, counts) for key, counts in deltas.iteritems()
+                  if any(counts.itervalues()))
+    if not deltas:
+        return
+    counters = sorted(next(deltas.itervalues()))
+
+    # Find the rows that already exist; keys start with address and day
+    existing = set()
+    addresses = list(set(key[0] for key in deltas))
+    first_day = min(key[1] for key in deltas)
+    last_day = max(key[1] for key in deltas)
+    for chunk in chunks(addresses):
+        existing.update(
+                tuple(row)
+                for row in sqlsession.execute(
+                    select([table.c[name] for name in key_columns])
+                    .where(table.c.address.in_(chunk))
+                    .where(table.c.day.between(first_day, last_day))))
+
+    updates = []
+    inserts = []
+    for key, counts in deltas.iteritems():
+        if key in existing:
+            params = dict(('k_' + name, value)
+                          for name, value in zip(key_columns, key))
+            params.update(('d_' + name, counts[name]) for name in counters)
+            updates.append(params)
+        else:
+            row = dict(zip(key_columns, key))
+            row.update(counts)
+            inserts.append(row)
+    if updates:
+        sqlsession.execute(
+                table.update()
+                     .where(and_(*[table.c[name] == bindparam('k_' + name)
+                                   for name in key_columns]))
+                     .values(dict((name,
+                                   table.c[name] + bindparam('d_' + name))
+                                  for name in counters)),
+                updates)
+    if inserts:
+        try:
+            sqlsession.execute(table.insert(), inserts)
+        except IntegrityError:
+            # Another transaction created the row since we looked
+            raise TransactionConflict("Statistics row created concurrently")
+
+
+def _apply(sqlsession, deltas, latencies):
+    _add_counts(sqlsession, models.AddressDailyStats.__table__,
+                ('address', 'day'), deltas)
+    _add_counts(sqlsession, models.AddressReplyLatency.__table__,
+                ('address', 'day', 'bucket'), latencies)
+
+
+def update_stats(sqlsession, records, thread_ids):
+    """Updates the statistics with new messages and the threads they changed.
+
+    records is a list of dicts with id, from_, date and references, for the
+    messages that were just inserted. thread_ids are the threads that got
+    messages or were merged. This doesn't commit.
+    """
+    deltas = {}
+    latencies = {}
+    _count_messages(sqlsession, records, deltas, latencies)
+    thread_ids = list(set(thread_ids))
+    _remove_threads(sqlsession, thread_ids, deltas)
+    _add_threads(sqlsession, thread_ids, deltas)
+    _apply(sqlsession, deltas, latencies)
+
+
+def remove_threads(sqlsession, thread_ids):
+    """Takes threads out of the statistics, before they are deleted.
+
+    This doesn't commit.
+    """
+    deltas = {}
+    _remove_threads(sqlsession, list(thread_ids), deltas)
+    _apply(sqlsession, deltas, {})
+
+
+def rebuild_stats(sqlsession, batch_size=5000):
+    """Recomputes all the statistics from the messages, and commits.
+
+    Returns the number of messages counted.
+    """
+    for model in (models.ThreadParticipant, models.AddressDailyStats,
+                  models.AddressReplyLatency):
+        sqlsession.query(model).delete(synchronize_session=False)
+
+    deltas = {}
+    thread_ids = [thread_id
+                  for thread_id, in sqlsession.query(models.Thread.id)]
+    _add_threads(sqlsession, thread_ids, deltas)
+    _apply(sqlsession, deltas, {})
+
+    Message = models.Message
+    count = 0
+    last_id = None
+    while True:
+        # Paginate on the primary key, the getter might be adding messages
+        query = (sqlsession.query(Message.id, Message.from_, Message.date)
+                           .order_by(Message.id))
+        if last_id is not None:
+            query = query.filter(Message.id > last_id)
+        batch = query.limit(batch_size).all()
+        if not batch:
+            break
+        references = {}
+        for chunk in chunks([msgid for msgid, from_, date in batch]):
+            for msgid, referenced_id in (
+                    sqlsession.query(models.MessageReference.message_id,
+                                     models.MessageReference.referenced_id)
+                              .filter(models.MessageReference.message_id
+                                      .in_(chunk))):
+                references.setdefault(msgid, []).append(referenced_id)
+        deltas = {}
+        latencies = {}
+        _count_messages(sqlsession,
+                        [dict(id=msgid, from_=from_, date=date,
+                              references=references.get(msgid, []))
+                         for msgid, from_, date in batch],
+                        deltas, latencies)
+        _apply(sqlsession, deltas, latencies)
+        count += len(batch)
+        last_id = batch[-1][0]
+    sqlsession.commit()
+    return count
+
+
+def poster_stats(sqlsession, since=None, cursor=None, limit=50):
+    """Gets the statistics since a date (UTC), or of all time, per poster.
+
+    Addresses that aren't linked to a poster are listed on their own. Returns
+    a list of dicts with the poster (or None), the addresses, the counters,
+    the number of replies and the bucket of the median reply latency (or
+    None), most messages first; and the (messages, poster id, address) cursor
+    of the next page, or None if this is the last page.
+    """
+    Daily = models.AddressDailyStats
+    Latency = models.AddressReplyLatency
+    PosterEmail = models.PosterEmail
+
+    # Rows are grouped per poster, or per address for unlinked addresses
+    poster_key = func.coalesce(PosterEmail.poster_id, 0)
+    address_key = case([(PosterEmail.poster_id == None, Daily.address)],
+                       else_=literal(''))
+    messages = func.sum(Daily.messages)
+    query = (sqlsession.query(poster_key, address_key, messages,
+                              *[func.sum(getattr(Daily, name))
+                                for name in _COUNTERS[1:]])
+                       .select_from(Daily)
+                       .outerjoin(PosterEmail,
+                                  PosterEmail.address == Daily.address)
+                       .group_by(poster_key, address_key))
+    if since is not None:
+        query = query.filter(Daily.day >= since)
+    if cursor is not None:
+        count, poster_id, address = cursor
+        query = query.having(or_(
+                messages < count,
+                and_(messages == count,
+                     or_(poster_key > poster_id,
+                         and_(poster_key == poster_id,
+                              address_key > address)))))
+    rows = (query.order_by(messages.desc(), poster_key, address_key)
+                 .limit(limit + 1)).all()
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = last[2], last[0], last[1]
+    else:
+        next_cursor = None
+
+    entries = {}
+    for row in rows:
+        entry = dict(zip(_COUNTERS, [value or 0 for value in row[2:]]))
+        entry.update(poster=None, addresses=[], latencies={})
+        entries[row[0] or row[1]] = entry
+    poster_ids = [row[0] for row in rows if row[0]]
+    unlinked = [row[1] for row in rows if not row[0]]
+
+    if poster_ids:
+        for poster in (sqlsession.query(models.Poster)
+                                 .filter(models.Poster.id.in_(poster_ids))):
+            entries[poster.id]['poster'] = poster
+        linked = (sqlsession.query(PosterEmail.poster_id, Daily.address)
+                            .select_from(Daily)
+                            .join(PosterEmail,
+                                  PosterEmail.address == Daily.address)
+                            .filter(PosterEmail.poster_id.in_(poster_ids))
+                            .distinct())
+        if since is not None:
+            linked = linked.filter(Daily.day >= since)
+        for poster_id, address in linked:
+            entries[poster_id]['addresses'].append(address)
+    for address in unlinked:
+        entries[address]['addresses'].append(address)
+
+    if entries:
+        page = []
+        if poster_ids:
+            page.append(PosterEmail.poster_id.in_(poster_ids))
+        if unlinked:
+            page.append(and_(PosterEmail.poster_id == None,
+                             Latency.address.in_(unlinked)))
+        latencies = (sqlsession.query(PosterEmail.poster_id, Latency.address,
+                                      Latency.bucket,
+                                      func.sum(Latency.replies))
+                               .select_from(Latency)
+                               .outerjoin(PosterEmail,
+                                          PosterEmail.address ==
+                                          Latency.address)
+                               .filter(or_(*page))
+                               .group_by(PosterEmail.poster_id,
+                                         Latency.address, Latency.bucket))
+        if since is not None:
+            latencies = latencies.filter(Latency.day >= since)
+        for poster_id, address, bucket, replies in latencies:
+            histogram = entries[poster_id or address]['latencies']
+            histogram[bucket] = histogram.get(bucket, 0) + replies
+
+    results = []
+    for row in rows:
+        result = entries[row[0] or row[1]]
+        histogram = result.pop('latencies')
+        replies = sum(histogram.itervalues())
+        median = None
+        seen = 0
+        for bucket in sorted(histogram):
+            seen += histogram[bucket]
+            if seen * 2 >= replies:
+                median = bucket
+                break
+        result.update(replies=replies, median_latency=median)
+        result['addresses'].sort()
+        results.append(result)
+    return results, next_cursor
@@ -1,11 +1,156 @@
+import logging
+import random
+from sqlalchemy import event, inspect
 from sqlalchemy.engine import create_engine
+from sqlalchemy.exc import DBAPIError, DisconnectionError
 from sqlalchemy.orm.session import sessionmaker
+import time
 
-from internetpoints import config, models
+from internetpoints import config, metrics, models
+
+
+logger = logging.getLogger(__name__)
+
+
+def _sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL lets readers go on while the getter writes; the busy timeout makes
+    # writers wait for each other instead of failing right away
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA busy_timeout=%d' %
+                       getattr(config, 'SQLITE_BUSY_TIMEOUT', 30000))
+    finally:
+        cursor.close()
+
+
+def _ping(dbapi_connection, connection_record, connection_proxy):
+    # Checks that a pooled connection is still alive before handing it out;
+    # on DisconnectionError, the pool discards it and tries another one
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute('SELECT 1')
+    except Exception:
+        raise DisconnectionError()
+    finally:
+        cursor.close()
+
+
+def _create_engine(uri):
+    """Creates an engine, with the pool settings from the configuration.
+    """
+    if uri.startswith('sqlite'):
+        # SQLAlchemy doesn't pool SQLite file connections, they are cheap
+        engine = create_engine(uri)
+        event.listen(engine, 'connect', _sqlite_pragmas)
+    else:
+        engine = create_engine(
+                uri,
+                pool_size=getattr(config, 'DATABASE_POOL_SIZE', 5),
+                max_overflow=getattr(config, 'DATABASE_MAX_OVERFLOW', 10),
+                pool_recycle=getattr(config, 'DATABASE_POOL_RECYCLE', 3600))
+        if getattr(config, 'DATABASE_PRE_PING', True):
+            event.listen(engine, 'checkout', _ping)
+    metrics.instrument_engine(engine)
+    return engine
 
 
 # Setup SQLAlchemy
-engine = create_engine(config.DATABASE_URI)
+engine = _create_engine(config.DATABASE_URI)
 Session = sessionmaker(bind=engine)
-if not engine.dialect.has_table(engine.connect(), 'threads'):
-    models.Base.metadata.create_all(bind=engine)
+
+# Pages that only read can use a replica, so that they don't compete with the
+# getter's writes
+read_uri = getattr(config, 'DATABASE_READ_URI', None)
+if read_uri:
+    read_engine = _create_engine(read_uri)
+else:
+    read_engine = engine
+ReadSession = sessionmaker(bind=read_engine)
+
+
+def _create_missing_indexes():
+    """Creates the indexes that were added to tables that already existed.
+
+    create_all() only creates the indexes of the tables it creates.
+    """
+    inspector = inspect(engine)
+    for table in models.Base.metadata.sorted_tables:
+        existing = set(index['name']
+                       for index in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(bind=engine)
+
+
+# Only creates the tables that don't exist yet
+models.Base.metadata.create_all(bind=engine)
+_create_missing_indexes()
+
+
+# Maximum number of parameters in a single IN (...) clause; SQLite doesn't
+# allow more than 999 parameters per statement
+IN_CHUNK_SIZE = 500
+
+
+def chunks(seq, size=IN_CHUNK_SIZE):
+    """Splits a list in chunks, to keep IN (...) clauses under the limit.
+    """
+    for i in xrange(0, len(seq), size):
+        yield seq[i:i + size]
+
+
+class TransactionConflict(Exception):
+    """Raised when a concurrent transaction got in the way.
+
+    The transaction should be rolled back and run again, see transaction().
+    """
+
+
+# Errors from the database that mean the transaction can be run again: lock
+# timeouts, deadlocks and serialization failures
+_TRANSIENT_CODES = set(['40001', '40P01'])
+_TRANSIENT_MESSAGES = ('database is locked', 'deadlock',
+                       'could not serialize', 'lock wait timeout')
+
+
+def is_transient(error):
+    """Tells whether a transaction that failed with error can be retried.
+    """
+    if isinstance(error, TransactionConflict):
+        return True
+    if not isinstance(error, DBAPIError) or error.connection_invalidated:
+        return False
+    if getattr(error.orig, 'pgcode', None) in _TRANSIENT_CODES:
+        return True
+    message = str(error.orig).lower()
+    return any(m in message for m in _TRANSIENT_MESSAGES)
+
+
+def transaction(sqlsession, func, on_retry=None):
+    """Calls func(sqlsession) and commits, retrying if the database is busy.
+
+    If the transaction fails with a transient error, it is rolled back and
+    run again, up to DATABASE_RETRIES times, waiting a little longer each
+    time; on_retry is called before each new attempt. Other errors are raised
+    after rolling back. Returns the result of func.
+    """
+    retries = getattr(config, 'DATABASE_RETRIES', 5)
+    attempt = 0
+    while True:
+        try:
+            result = func(sqlsession)
+            sqlsession.commit()
+            return result
+        except Exception as e:
+            sqlsession.rollback()
+            if attempt >= retries or not is_transient(e):
+                raise
+            attempt += 1
+            logger.warning("Transaction failed (%s), retrying (%d/%d)" % (
+                           e, attempt, retries))
+            if on_retry is not None:
+                on_retry()
+            # Random exponential backoff, so that the competing transactions
+            # don't collide again
+            time.sleep(random.uniform(0, 0.05 * 2 ** attempt))
@@ -0,0 +1,82 @@
+from sqlalchemy.sql import and_, distinct, func
+
+from internetpoints import models
+from internetpoints.storage import chunks
+
+
+def update_thread_summaries(sqlsession, thread_ids):
+    """Recomputes the ThreadSummary of the given threads.
+
+    This doesn't commit; it should be called in the same transaction that
+    changed the threads.
+    """
+    thread_ids = list(set(thread_ids))
+    for chunk in chunks(thread_ids):
+        _update_chunk(sqlsession, chunk)
+
+
+def _update_chunk(sqlsession, thread_ids):
+    Message = models.Message
+    summaries = {}
+    for thread_id, last_msg in (sqlsession.query(models.Thread.id,
+                                                 models.Thread.last_msg)
+                                          .filter(models.Thread.id.in_(
+                                              thread_ids))):
+        summaries[thread_id] = dict(thread_id=thread_id, last_msg=last_msg,
+                                    subject='', message_count=0,
+                                    participant_count=0,
+                                    assigned=False, task_names='')
+
+    # Counts
+    counts = (sqlsession.query(Message.thread_id,
+                               func.count(Message.id),
+                               func.count(distinct(Message.from_)))
+                        .filter(Message.thread_id.in_(thread_ids))
+                        .group_by(Message.thread_id))
+    for thread_id, messages, participants in counts:
+        summaries[thread_id].update(message_count=messages,
+                                    participant_count=participants)
+
+    # Subject of the first message
+    first = (sqlsession.query(Message.thread_id,
+                              func.min(Message.date).label('date'))
+                       .filter(Message.thread_id.in_(thread_ids))
+                       .group_by(Message.thread_id)).subquery()
+    subjects = (sqlsession.query(Message.thread_id, Message.subject)
+                          .join(first,
+                                and_(Message.thread_id == first.c.thread_id,
+                                     Message.date == first.c.date)))
+    for thread_id, subject in subjects:
+        summaries[thread_id]['subject'] = subject
+
+    # Assigned tasks
+    tasks = (sqlsession.query(models.TaskAssignation.thread_id,
+                              models.Task.name)
+                       .join(models.TaskAssignation.task)
+                       .filter(models.TaskAssignation.thread_id.in_(
+                           thread_ids))
+                       .order_by(models.TaskAssignation.date))
+    task_names = {}
+    for thread_id, name in tasks:
+        task_names.setdefault(thread_id, []).append(name)
+    for thread_id, names in task_names.iteritems():
+        summaries[thread_id].update(assigned=True,
+                                    task_names='\n'.join(names))
+
+    (sqlsession.query(models.ThreadSummary)
+               .filter(models.ThreadSummary.thread_id.in_(thread_ids))
+               .delete(synchronize_session=False))
+    if summaries:
+        sqlsession.execute(models.ThreadSummary.__table__.insert(),
+                           summaries.values())
+
+
+def rebuild_thread_summaries(sqlsession):
+    """Recomputes the ThreadSummary of every thread, and commits.
+    """
+    sqlsession.query(models.ThreadSummary).delete(synchronize_session=False)
+    thread_ids = [thread_id
+                  for thread_id, in sqlsession.query(models.Thread.id)]
+    update_thread_summaries(sqlsession, thread_ids)
+    sqlsession.commit()
+    return len(thread_ids)
@@ -1,15 +1,27 @@
-from flask import Flask, redirect, render_template, request, Response, url_for
+from datetime import datetime
+from flask import Flask, jsonify, redirect, request, Response, \
+    stream_with_context, url_for
 from flask.globals import session
+from flask.templating import render_template as _render_template
 import functools
+from itertools import islice
+import logging
 import random
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy.orm import joinedload
+from sqlalchemy.sql import and_, func, or_
+from sqlalchemy.orm import joinedload, scoped_session
 from sqlalchemy.orm.exc import NoResultFound
 import string
 from werkzeug import abort
 
-from internetpoints import config, models
-from internetpoints.storage import Session
+from internetpoints import addresses, bodies, cache, config, metrics, \
+    models, scoring, search, stats
+from internetpoints.storage import ReadSession, Session, chunks, \
+    transaction
+from internetpoints.summaries import update_thread_summaries
+
+
+logger = logging.getLogger(__name__)
 
 
 # Setup Flask
@@ -17,6 +29,103 @@ app = Flask('internetpoints')
 app.config.update(config.__dict__)
 
 
+# Database sessions, one per request and thread; pages that don't change
+# anything use read_session, which might be bound to a replica
+write_session = scoped_session(Session)
+read_session = scoped_session(ReadSession)
+
+
+@app.teardown_appcontext
+def remove_sessions(exception=None):
+    write_session.remove()
+    read_session.remove()
+
+
+# Instrumentation, see internetpoints.metrics; the hooks are only installed
+# if it's enabled
+
+if metrics.track_queries:
+    @app.before_request
+    def start_tracking():
+        metrics.start_tracking()
+
+    @app.after_request
+    def record_request(response):
+        tracked = metrics.stop_tracking()
+        if tracked is None:
+            return response
+        duration, queries, sql_time = tracked
+        endpoint = request.endpoint or 'none'
+        metrics.inc('internetpoints_http_requests_total',
+                    "Requests handled",
+                    endpoint=endpoint, status=response.status_code)
+        metrics.observe('internetpoints_http_request_seconds',
+                        "Time spent handling requests",
+                        duration, endpoint=endpoint)
+        metrics.inc('internetpoints_sql_statements_total',
+                    "SQL statements run while handling requests",
+                    queries, endpoint=endpoint)
+        metrics.inc('internetpoints_sql_seconds_total',
+                    "Time spent in SQL statements while handling requests",
+                    sql_time, endpoint=endpoint)
+        threshold = metrics.slow_request_threshold
+        if threshold is not None and duration >= threshold:
+            logger.warning("Slow request: %s %s took %.3fs, %d SQL "
+                           "statements took %.3fs" % (
+                           request.method, request.path, duration,
+                           queries, sql_time))
+        return response
+
+
+def render_template(template_name, **context):
+    with metrics.timer('internetpoints_template_render_seconds',
+                       "Time spent rendering templates",
+                       template=template_name):
+        return _render_template(template_name, **context)
+
+
+# Number of template events rendered before sending a chunk
+_STREAM_BUFFER = 20
+
+
+def _stream(template, context):
+    stream = template.stream(context)
+    stream.enable_buffering(_STREAM_BUFFER)
+    # This includes the time spent sending the page
+    with metrics.timer('internetpoints_template_render_seconds',
+                       "Time spent rendering templates",
+                       template=template.name):
+        for chunk in stream:
+            yield chunk
+
+
+def stream_template(template_name, **context):
+    """Renders a template progressively.
+
+    Returns a generator, so that the page is sent while it is being rendered
+    and the queries it iterates on are consumed as it goes. The output is the
+    same as render_template().
+    """
+    app.update_template_context(context)
+    template = app.jinja_env.get_template(template_name)
+    stream = stream_with_context(_stream(template, context))
+    # The session cookie is sent before the page, so the token has to exist
+    # by then. This has to happen after stream_with_context(), which opens
+    # the session again
+    generate_csrf_token()
+    return stream
+
+
+@app.route('/metrics')
+def metrics_page():
+    """Metrics of this process, for Prometheus.
+    """
+    if not metrics.enabled:
+        abort(404)
+    return Response(metrics.render(),
+                    content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
 # CSRF protection
 
 def random_string(size=20, characters=string.ascii_uppercase +
@@ -29,7 +138,10 @@ def random_string(size=20, characters=string.ascii_uppercase +
 def csrf_protect():
     if request.method == "POST":
         token = session.get('_csrf_token', None)
-        if not token or token != request.form.get('_csrf_token'):
+        # JSON requests send it in a header
+        sent = (request.form.get('_csrf_token') or
+                request.headers.get('X-CSRF-Token'))
+        if not token or token != sent:
             abort(400)
 
 
@@ -65,6 +177,58 @@ def requires_auth(func):
     return decorated
 
 
+# Page cache
+
+def _cache_stream(key, generation, chunks):
+    # Sends a streamed page, and caches it if it was sent completely
+    page = []
+    for chunk in chunks:
+        page.append(chunk)
+        yield chunk
+    cache.set_page(key, generation, u''.join(page))
+
+
+def cached_page(func):
+    """Caches the rendered page, and answers conditional requests.
+
+    The view can return the page or stream it (see stream_template()). Pages
+    are cached until cache.invalidate() is called from any process.
+    The generation number is also used as the ETag, so that clients and
+    proxies get a 304 without the database being queried.
+    """
+    @functools.wraps(func)
+    def decorated(*args, **kwargs):
+        generation, changed = cache.current_generation()
+        etag = 'g%d' % generation
+        if changed is not None:
+            changed = changed.replace(microsecond=0)
+
+        if request.if_none_match:
+            not_modified = etag in request.if_none_match
+        else:
+            not_modified = (changed is not None and
+                            request.if_modified_since is not None and
+                            request.if_modified_since >= changed)
+        if not_modified:
+            response = Response(status=304)
+        else:
+            key = request.full_path
+            page = cache.get_page(key, generation)
+            if page is None:
+                page = func(*args, **kwargs)
+                if isinstance(page, basestring):
+                    cache.set_page(key, generation, page)
+                else:
+                    page = _cache_stream(key, generation, page)
+            response = Response(page)
+        response.set_etag(etag)
+        if changed is not None:
+            response.last_modified = changed
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+    return decorated
+
+
 @app.route('/')
 def index():
     """Landing page.
@@ -74,59 +238,344 @@ def index():
     return redirect('/scores', 301)
 
 
+# Keyset pagination
+#
+# Listings are ordered on a (key, id) pair, and the next page is requested
+# with the pair of the last row, which the indexes can seek to directly.
+
+_DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def get_cursor(name, convert):
+    """Reads a 'key,id' cursor from the query string.
+    """
+    value = request.args.get(name)
+    if not value:
+        return None
+    try:
+        key, id_ = value.rsplit(',', 1)
+        return convert(key), int(id_)
+    except ValueError:
+        abort(400)
+
+
+def paginate(query, key_column, id_column, cursor):
+    """Returns a page of a query, ordered by (key, id) descending.
+
+    Returns the rows and the (key, id) pair to request the next page with, or
+    None if this is the last page.
+    """
+    if cursor is not None:
+        key, id_ = cursor
+        query = query.filter(or_(key_column < key,
+                                 and_(key_column == key, id_column < id_)))
+    page_size = getattr(config, 'PAGE_SIZE', 50)
+    rows = (query.order_by(key_column.desc(), id_column.desc())
+                 .limit(page_size + 1)).all()
+    if len(rows) > page_size:
+        return rows[:page_size], rows[page_size - 1]
+    return rows, None
+
+
 @app.route('/scores')
+@cached_page
 def scores():
     """Scores.
 
-    Display a list of contributors with their current number of points.
+    Display a list of contributors with their current number of points, or
+    with the points earned this month or this year.
+    """
+    sqlsession = read_session()
+    period = request.args.get('period')
+    if period in ('month', 'year'):
+        now = datetime.utcnow()
+        if period == 'month':
+            since = datetime(now.year, now.month, 1)
+        else:
+            since = datetime(now.year, 1, 1)
+        scores = scoring.leaderboard(sqlsession, since=since)
+        return render_template('scores.html', scores=scores, period=period,
+                               next_page=None)
+
+    posters, last = paginate(sqlsession.query(models.Poster),
+                             models.Poster.score, models.Poster.id,
+                             get_cursor('after', int))
+    if last is not None:
+        next_page = '%d,%d' % (last.score, last.id)
+    else:
+        next_page = None
+    return render_template('scores.html',
+                           scores=[(poster, poster.score)
+                                   for poster in posters],
+                           period=None, next_page=next_page)
+
+
+@app.route('/stats')
+@cached_page
+def statistics():
+    """Activity statistics per poster.
+
+    Everything is read from the daily rollups, see internetpoints.stats.
+    """
+    sqlsession = read_session()
+    period = request.args.get('period')
+    since = None
+    if period in ('month', 'year'):
+        now = datetime.utcnow()
+        if period == 'month':
+            since = datetime(now.year, now.month, 1)
+        else:
+            since = datetime(now.year, 1, 1)
+    else:
+        period = None
+    cursor = None
+    after = request.args.get('after')
+    if after:
+        # A count, a poster id (0 for an unlinked address), and an address
+        # (empty for a poster)
+        try:
+            count, poster_id, address = after.split(',', 2)
+            cursor = int(count), int(poster_id), address
+        except ValueError:
+            abort(400)
+    posters, last = stats.poster_stats(sqlsession, since, cursor,
+                                       getattr(config, 'PAGE_SIZE', 50))
+    if last is not None:
+        next_page = '%d,%d,%s' % last
+    else:
+        next_page = None
+    return render_template('stats.html', period=period, posters=posters,
+                           next_page=next_page,
+                           describe_latency=stats.describe_latency)
+
+
+def _thread_list(sqlsession, unassigned):
+    """Gets a page of the list of threads, and the cursor of the next one.
     """
-    sqlsession = Session()
-    posters = (sqlsession.query(models.Poster)
-                         .order_by(models.Poster.score.desc())).all()
-    return render_template('scores.html', posters=posters)
+    query = sqlsession.query(models.ThreadSummary)
+    if unassigned:
+        query = query.filter(models.ThreadSummary.assigned == False)
+    threads, last = paginate(
+            query,
+            models.ThreadSummary.last_msg, models.ThreadSummary.thread_id,
+            get_cursor('after',
+                       lambda d: datetime.strptime(d, _DATE_FORMAT)))
+    if last is not None:
+        next_page = '%s,%d' % (last.last_msg.strftime(_DATE_FORMAT),
+                               last.thread_id)
+    else:
+        next_page = None
+    return threads, next_page
+
 
 @app.route('/vote')
 @requires_auth
+@cached_page
 def vote():
     """Main view.
 
     Shows the list of threads that require resolution.
     """
-    sqlsession = Session()
-    threads = (sqlsession.query(models.Thread)
-                         .options(
-                             joinedload(models.Thread.task_assignations)
-                                 .joinedload(models.TaskAssignation.task),
-                             joinedload(models.Thread.messages))
-                         .order_by(models.Thread.last_msg.desc())).all()
-    return render_template('vote.html', threads=threads)
+    sqlsession = read_session()
+    unassigned = request.args.get('unassigned') == '1'
+    threads, next_page = _thread_list(sqlsession, unassigned)
+    return stream_template('vote.html', threads=threads,
+                           unassigned=unassigned, next_page=next_page)
 
 
-@app.route('/thread/<int:thread_id>')
+@app.route('/triage')
 @requires_auth
-def thread(thread_id):
-    """Shows a thread and allows to vote on it.
+def triage():
+    """The list of threads, to assign tasks from the keyboard.
+
+    The assignments are sent in batches to assign_tasks(). Not cached, since
+    the page has the CSRF token.
+    """
+    sqlsession = read_session()
+    unassigned = request.args.get('unassigned') == '1'
+    threads, next_page = _thread_list(sqlsession, unassigned)
+    tasks = sqlsession.query(models.Task).order_by(models.Task.id).all()
+    # The posters who took part in each thread, in a single query
+    thread_posters = {}
+    if threads:
+        for thread_id, poster_id, name in (
+                sqlsession.query(models.Message.thread_id, models.Poster.id,
+                                 models.Poster.name)
+                          .join(models.PosterEmail,
+                                models.PosterEmail.address ==
+                                models.Message.from_)
+                          .join(models.Poster,
+                                models.Poster.id ==
+                                models.PosterEmail.poster_id)
+                          .filter(models.Message.thread_id.in_(
+                              [thread.thread_id for thread in threads]))
+                          .distinct()
+                          .order_by(models.Poster.name)):
+            thread_posters.setdefault(thread_id, []).append(
+                    dict(id=poster_id, name=name))
+    return render_template('vote.html', threads=threads,
+                           unassigned=unassigned, next_page=next_page,
+                           triage=True, tasks=tasks,
+                           thread_posters=thread_posters)
+
+
+@app.route('/search')
+@requires_auth
+def search_threads():
+    """Full-text search over the messages.
+
+    Shows the matching threads, best first.
+    """
+    sqlsession = read_session()
+    query = request.args.get('q', '')
+    thread_ids = search.search(sqlsession, query)
+    summaries = {}
+    for chunk in chunks(thread_ids):
+        summaries.update(
+                (summary.thread_id, summary)
+                for summary in (sqlsession.query(models.ThreadSummary)
+                                          .filter(models.ThreadSummary
+                                                  .thread_id.in_(chunk))))
+    threads = [summaries[thread_id] for thread_id in thread_ids
+               if thread_id in summaries]
+    return render_template('search.html', query=query, threads=threads)
+
+
+def _previews(sqlsession, rows, preview_size):
+    """Yields (message, preview, length) for the messages of a thread.
+
+    The bodies stored compressed are rebuilt 100 messages at a time, only as
+    far as the previews need. The texts are dropped after each batch, so that
+    memory doesn't grow with the thread.
+    """
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, 100))
+        if not batch:
+            return
+        compressed = [msg.id for msg, preview, length, stored in batch
+                      if stored is not None]
+        if not compressed:
+            texts = {}
+        elif preview_size is None:
+            texts = bodies.load_texts(sqlsession, compressed)
+        else:
+            texts = bodies.load_previews(sqlsession, compressed,
+                                         preview_size)
+        for msg, preview, length, stored in batch:
+            if stored is not None:
+                yield msg, texts[msg.id], stored
+            else:
+                yield msg, preview, length
+
+
+def thread_context(sqlsession, thread_id, preview_size):
+    """Gets what the thread page shows, as template variables.
+
+    Only the first preview_size characters of each message are included, or
+    all the text if it's None. The messages are read as the page iterates on
+    them.
     """
-    sqlsession = Session()
     thread = (sqlsession.query(models.Thread)
                         .options(
-                            joinedload(models.Thread.messages)
-                                .joinedload(models.Message.poster_email)
-                                .joinedload(models.PosterEmail.poster),
                             joinedload(models.Thread.task_assignations))
                         .filter(models.Thread.id == thread_id)).one()
+    if preview_size is None:
+        text = models.Message.text
+    else:
+        text = func.substr(models.Message.text, 1, preview_size)
+    messages = (sqlsession.query(models.Message,
+                                 text,
+                                 func.length(models.Message.text),
+                                 models.MessageBody.length)
+                          .outerjoin(models.MessageBody,
+                                     models.MessageBody.message_id ==
+                                     models.Message.id)
+                          .options(
+                              joinedload(models.Message.poster_email)
+                                  .joinedload(models.PosterEmail.poster))
+                          .filter(models.Message.thread_id == thread_id)
+                          .order_by(models.Message.date)
+                          .yield_per(100))
     tasks = (sqlsession.query(models.Task)).all()
-    posters = set(msg.poster_email.poster
-                  for msg in thread.messages
-                  if msg.poster_email is not None)
+    posters = set(sqlsession.query(models.Poster)
+                            .join(models.Poster.emails)
+                            .join(models.Message,
+                                  models.Message.from_ ==
+                                  models.PosterEmail.address)
+                            .filter(models.Message.thread_id == thread_id))
     # The email addresses participating in this thread but not yet associated
     # to a Poster
-    registerable_senders = [msg.from_
-                            for msg in thread.messages
-                            if not msg.poster_email]
-    return render_template('thread.html',
-                           thread=thread, tasks=tasks, posters=posters,
-                           registerable_senders=registerable_senders)
+    registerable_senders = [
+            from_
+            for from_, in (sqlsession.query(models.Message.from_)
+                                     .outerjoin(models.Message.poster_email)
+                                     .filter(models.PosterEmail.address ==
+                                             None)
+                                     .filter(models.Message.thread_id ==
+                                             thread_id)
+                                     .order_by(models.Message.date))]
+    return dict(thread=thread,
+                messages=_previews(sqlsession, messages, preview_size),
+                preview_size=preview_size,
+                tasks=tasks, posters=posters,
+                registerable_senders=registerable_senders)
+
+
+@app.route('/thread/<int:thread_id>')
+@requires_auth
+def thread(thread_id):
+    """Shows a thread and allows to vote on it.
+
+    Only the beginning of long messages is included; the rest is loaded on
+    demand from message_text().
+    """
+    preview_size = getattr(config, 'MESSAGE_PREVIEW_SIZE', 4096)
+    # The messages are streamed to the page as they are read
+    return Response(stream_template(
+            'thread.html',
+            **thread_context(read_session(), thread_id, preview_size)))
+
+
+@app.route('/thread/<int:thread_id>/text')
+@requires_auth
+def message_text(thread_id):
+    """Returns a chunk of the text of a message, as text/plain.
+
+    The message is given by the 'msg' parameter, and the chunk starts at the
+    character given by 'offset'. If there is more text, the offset of the
+    next chunk is given in the X-Next-Offset header.
+    """
+    sqlsession = read_session()
+    try:
+        offset = int(request.args.get('offset', 0))
+    except ValueError:
+        abort(400)
+    if offset < 0:
+        abort(400)
+    chunk_size = getattr(config, 'MESSAGE_CHUNK_SIZE', 65536)
+    msgid = request.args.get('msg')
+    query = (sqlsession.query(func.substr(models.Message.text,
+                                          offset + 1, chunk_size),
+                              func.length(models.Message.text),
+                              models.MessageBody.length)
+                       .outerjoin(models.MessageBody,
+                                  models.MessageBody.message_id ==
+                                  models.Message.id)
+                       .filter(models.Message.thread_id == thread_id)
+                       .filter(models.Message.id == msgid))
+    try:
+        text, length, stored = query.one()
+    except NoResultFound:
+        abort(404)
+    if stored is not None:
+        text = bodies.load_texts(sqlsession, [msgid])[msgid]
+        text = text[offset:offset + chunk_size]
+        length = stored
+    headers = {}
+    if offset + chunk_size < length:
+        headers['X-Next-Offset'] = str(offset + chunk_size)
+    return Response(text, 200, headers, mimetype='text/plain')
 
 
 @app.route('/assign_task/<int:thread_id>', methods=['POST'])
@@ -134,39 +583,100 @@ def thread(thread_id):
 def assign_task(thread_id):
     """Assign a new task to a thread.
     """
-    sqlsession = Session()
-    thread = (sqlsession.query(models.Thread)
-                        .filter(models.Thread.id == thread_id)).one()
-    task = (sqlsession.query(models.Task)
-                      .filter(models.Task.id == request.form['task'])).one()
-    poster_req = (sqlsession.query(models.Poster)
-                            .filter(models.Poster.id == request.form['poster']))
-    poster = poster_req.one()
-    # Note that, although the Poster definitely exists, here we don't check
-    # that he took part in the thread
+    task_id = request.form.get('task', type=int)
+    poster_id = request.form.get('poster', type=int)
+    if task_id is None or poster_id is None:
+        abort(400)
+    # Note that here we don't check that the poster took part in the thread
+
+    def assign(sqlsession):
+        # Assign task and update Poster's score
+        if not scoring.assign_task(sqlsession, thread_id, task_id,
+                                   poster_id):
+            abort(404)
+        update_thread_summaries(sqlsession, [thread_id])
+        cache.invalidate(sqlsession)
 
     try:
-        # Assign task
-        task_assignation = models.TaskAssignation(
-                thread=thread,
-                task=task,
-                poster=poster)
-        sqlsession.add(task_assignation)
-        # Update Poster's score
-        poster_req.update({
-                models.Poster.score: models.Poster.score + task.reward})
-        sqlsession.commit()
+        transaction(write_session(), assign)
     except IntegrityError:
+        # Already assigned
         pass
     return redirect(url_for('thread', thread_id=thread_id), 303)
 
 
+@app.route('/assign_tasks', methods=['POST'])
+@requires_auth
+def assign_tasks():
+    """Assigns many tasks at once, in a single transaction.
+
+    Takes a JSON object whose "assignments" are a list of {"thread", "task",
+    "poster"} objects, and returns that list with the outcome of each one
+    added as "result", see scoring.assign_tasks(). The CSRF token is sent in
+    the X-CSRF-Token header.
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get('assignments'),
+                                                    list):
+        abort(400)
+    if len(data['assignments']) > getattr(config, 'MAX_BATCH_ASSIGNMENTS',
+                                          1000):
+        abort(413)
+    results = [None] * len(data['assignments'])
+    valid = []
+    for i, assignment in enumerate(data['assignments']):
+        try:
+            valid.append((i, (int(assignment['thread']),
+                              int(assignment['task']),
+                              int(assignment['poster']))))
+        except (TypeError, KeyError, ValueError):
+            results[i] = 'invalid'
+
+    def assign(sqlsession):
+        outcomes = scoring.assign_tasks(sqlsession,
+                                        [values for i, values in valid])
+        threads = set(values[0]
+                      for (i, values), outcome in zip(valid, outcomes)
+                      if outcome == 'assigned')
+        if threads:
+            update_thread_summaries(sqlsession, threads)
+            cache.invalidate(sqlsession)
+        return outcomes
+
+    outcomes = transaction(write_session(), assign)
+    for (i, values), outcome in zip(valid, outcomes):
+        results[i] = outcome
+    return jsonify(assignments=[
+            dict(assignment, result=result)
+            if isinstance(assignment, dict)
+            else dict(result=result)
+            for assignment, result in zip(data['assignments'], results)])
+
+
+@app.route('/unassign_task/<int:thread_id>', methods=['POST'])
+@requires_auth
+def unassign_task(thread_id):
+    """Remove a task from a thread.
+    """
+    task_id = request.form.get('task', type=int)
+    if task_id is None:
+        abort(400)
+
+    def unassign(sqlsession):
+        if scoring.unassign_task(sqlsession, thread_id, task_id):
+            update_thread_summaries(sqlsession, [thread_id])
+            cache.invalidate(sqlsession)
+
+    transaction(write_session(), unassign)
+    return redirect(url_for('thread', thread_id=thread_id), 303)
+
+
 @app.route('/add_email', methods=['POST'])
 @requires_auth
 def add_email():
     """Create a new Poster or add an address to an existing Poster.
     """
-    sqlsession = Session()
+    sqlsession = write_session()
     email = request.form['email']
     # Look up a Poster with that email
     poster_email = (sqlsession.query(models.PosterEmail)
@@ -186,33 +696,116 @@ def add_email():
     if 'name' in request.form and 'poster_id' not in request.form:
         new_poster = models.Poster(name=request.form['name'])
         sqlsession.add(new_poster)
-        new_email = models.PosterEmail(address=email, poster=new_poster)
-        sqlsession.add(new_email)
+        sqlsession.flush()
+        addresses.link_addresses(sqlsession, [email], new_poster.id)
+        cache.invalidate(sqlsession)
         sqlsession.commit()
         return redirect(url_for('edit_poster', poster_id=new_poster.id,
                                 msg='Poster created'), 303)
     elif 'name' not in request.form and 'poster_id' in request.form:
-        poster_id = int(request.form['poster_id'])
+        poster_id = request.form.get('poster_id', type=int)
+        if poster_id is None:
+            abort(400)
         poster = (sqlsession.query(models.Poster)
                             .filter(models.Poster.id == poster_id)).one()
-        new_email = models.PosterEmail(address=email, poster=poster)
-        sqlsession.add(new_email)
+        addresses.link_addresses(sqlsession, [email], poster.id)
+        cache.invalidate(sqlsession)
         sqlsession.commit()
         return redirect(url_for('edit_poster', poster_id=poster.id), 303)
     # If both are set, something is going on, just display the forms again
 
     # Renders the form that will allow to choose an existing Poster or to
     # create a new one
-    # In both cases, redirect here
-    all_posters = sqlsession.query(models.Poster).all()
-    return render_template('add_email.html', email=email,
-                           posters=all_posters)
+    # In both cases, redirect here; posters are looked up with
+    # search_posters() as the name is typed
+    return render_template('add_email.html', email=email)
+
+
+@app.route('/posters/search')
+@requires_auth
+def search_posters():
+    """Finds posters by the beginning of their name or of an address.
+
+    Returns JSON, for the poster choosers.
+    """
+    sqlsession = read_session()
+    found = addresses.search_posters(sqlsession,
+                                     request.args.get('prefix', u'').strip())
+    return jsonify(posters=[dict(id=poster.id, name=poster.name)
+                            for poster in found])
+
+
+@app.route('/senders')
+@requires_auth
+def unknown_senders():
+    """Senders that are not linked to a poster, most messages first.
+
+    Several of them can be linked to a poster at once, see link_senders().
+    Not cached, since the page has the CSRF token.
+    """
+    sqlsession = read_session()
+    cursor = None
+    after = request.args.get('after')
+    if after:
+        # The key is a count, the id an address
+        try:
+            count, normalized = after.split(',', 1)
+            cursor = int(count), normalized
+        except ValueError:
+            abort(400)
+    senders, last = addresses.unknown_senders(
+            sqlsession, cursor, getattr(config, 'PAGE_SIZE', 50))
+    if last is not None:
+        next_page = '%d,%s' % last
+    else:
+        next_page = None
+    return render_template('senders.html', senders=senders,
+                           next_page=next_page, msg=request.args.get('msg'))
+
+
+@app.route('/link_senders', methods=['POST'])
+@requires_auth
+def link_senders():
+    """Links addresses, and their other forms, to a new or existing poster.
+    """
+    emails = request.form.getlist('email')
+    if not emails:
+        abort(400)
+    if request.form.get('action') == 'create':
+        name = request.form.get('name', u'').strip()
+        if not name:
+            abort(400)
+        poster_id = None
+    else:
+        poster_id = request.form.get('poster_id', type=int)
+        if poster_id is None:
+            abort(400)
+
+    def link(sqlsession):
+        if poster_id is None:
+            poster = models.Poster(name=name)
+            sqlsession.add(poster)
+            sqlsession.flush()
+        else:
+            poster = sqlsession.query(models.Poster).get(poster_id)
+            if poster is None:
+                abort(404)
+        # The page lists the normalized forms
+        linked = addresses.link_forms(sqlsession, emails, poster.id)
+        if linked:
+            cache.invalidate(sqlsession)
+        return poster.name, len(linked)
+
+    name, count = transaction(write_session(), link)
+    return redirect(url_for('unknown_senders',
+                            msg="Linked %d addresses to %s" % (count, name)),
+                    303)
 
 
 @app.route('/edit_poster/<int:poster_id>', methods=['GET', 'POST'])
 @requires_auth
 def edit_poster(poster_id):
-    sqlsession = Session()
+    sqlsession = write_session()
     # Look up Poster
     poster = (sqlsession.query(models.Poster)
                         .options(
@@ -229,8 +822,7 @@ def edit_poster(poster_id):
             changed = True
         if 'add_email' in request.form:
             email = request.form['add_email']
-            new_email = models.PosterEmail(address=email, poster=poster)
-            sqlsession.add(new_email)
+            addresses.link_addresses(sqlsession, [email], poster_id)
             changed = True
         if 'name' in request.form:
             poster.name = request.form['name']
@@ -238,6 +830,7 @@ def edit_poster(poster_id):
             changed = True
 
         if changed:
+            cache.invalidate(sqlsession)
             sqlsession.commit()
         return redirect(url_for('edit_poster', poster_id=poster_id), 303)
 
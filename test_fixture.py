@@ -8,7 +8,12 @@ except OSError:
 
 from internetpoints.models import Poster, PosterEmail, Thread, Message, Task,\
     TaskAssignation
+from internetpoints.addresses import rebuild_addresses
+from internetpoints.scoring import rebuild_scores
+from internetpoints.search import rebuild_index
+from internetpoints.stats import rebuild_stats
 from internetpoints.storage import Session
+from internetpoints.summaries import rebuild_thread_summaries
 
 
 if __name__ == '__main__':
@@ -76,6 +81,10 @@ if __name__ == '__main__':
     sqlsession.add(t1_task1)
     t1_task2 = TaskAssignation(thread=t1, task=task2, poster=remram)
     sqlsession.add(t1_task2)
-    remram.score = task1.reward + task2.reward
-    sqlsession.add(remram)
     sqlsession.commit()
+
+    rebuild_scores(sqlsession)
+    rebuild_thread_summaries(sqlsession)
+    rebuild_index(sqlsession)
+    rebuild_stats(sqlsession)
+    rebuild_addresses(sqlsession)
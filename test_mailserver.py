@@ -0,0 +1,251 @@
+"""Stand-in POP3 and IMAP server, to try the getter without a real mailbox.
+
+Serves the messages of an mbox file or Maildir, without authentication:
+
+    python test_mailserver.py archive.mbox
+
+With --drip N, messages are added one every N seconds instead, to try the
+getter daemon (the IMAP server supports IDLE).
+
+Then point INBOX or INBOXES at localhost, without SSL:
+
+    INBOXES = [('pop3', 'localhost', False, 1110, 'user', 'password'),
+               ('imap', 'localhost', False, 1143, 'user', 'password')]
+"""
+
+import re
+import select
+import SocketServer
+import sys
+import threading
+import time
+
+from internetpoints.getter.archive import read_archive
+
+
+UIDVALIDITY = 1
+
+
+class Mailbox(object):
+    """The messages being served, with UIDs starting at 1.
+    """
+    def __init__(self, messages=()):
+        self.lock = threading.Lock()
+        self.messages = []
+        for msg in messages:
+            self.add(msg)
+
+    def add(self, msg):
+        with self.lock:
+            self.messages.append(msg.replace('\r\n', '\n'))
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.messages)
+
+
+class Handler(SocketServer.StreamRequestHandler):
+    def send(self, line):
+        self.wfile.write(line + '\r\n')
+
+    def send_text(self, text):
+        for line in text.split('\n'):
+            self.send(line)
+
+    def handle(self):
+        self.greet()
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            if not self.command(line.rstrip('\r\n')):
+                return
+
+
+class Pop3Handler(Handler):
+    def greet(self):
+        self.messages = self.server.mailbox.snapshot()
+        self.send('+OK stand-in POP3 server ready')
+
+    def command(self, line):
+        args = line.split()
+        command = args[0].upper() if args else ''
+        if command in ('USER', 'PASS', 'NOOP', 'RSET'):
+            self.send('+OK')
+        elif command == 'STAT':
+            self.send('+OK %d %d' % (len(self.messages),
+                                     sum(len(m) for m in self.messages)))
+        elif command == 'UIDL':
+            self.send('+OK')
+            for num, msg in enumerate(self.messages):
+                self.send('%d uid-%d' % (num + 1, num + 1))
+            self.send('.')
+        elif command in ('RETR', 'TOP'):
+            try:
+                msg = self.messages[int(args[1]) - 1]
+            except (IndexError, ValueError):
+                self.send('-ERR no such message')
+                return True
+            if command == 'TOP':
+                msg = msg.split('\n\n', 1)[0]
+            self.send('+OK')
+            for line in msg.split('\n'):
+                if line.startswith('.'):
+                    line = '.' + line
+                self.send(line)
+            self.send('.')
+        elif command == 'QUIT':
+            self.send('+OK bye')
+            return False
+        else:
+            self.send('-ERR unknown command')
+        return True
+
+
+_UID_RANGE = re.compile(r'^(\d+)(?::(\d+|\*))?$')
+
+
+class ImapHandler(Handler):
+    def greet(self):
+        self.send('* OK stand-in IMAP server ready')
+
+    def uid_set(self, spec, messages):
+        """Parses a UID set such as '1,3:5,7:*'.
+        """
+        uids = set()
+        for part in spec.split(','):
+            match = _UID_RANGE.match(part)
+            if match is None:
+                continue
+            start = int(match.group(1))
+            end = match.group(2)
+            if end is None:
+                end = start
+            elif end == '*':
+                end = len(messages)
+            else:
+                end = int(end)
+            if end < start:
+                start, end = end, start
+            uids.update(xrange(start, end + 1))
+            if match.group(2) == '*' and messages:
+                # n:* always includes the last message
+                uids.add(len(messages))
+        return sorted(uid for uid in uids if 1 <= uid <= len(messages))
+
+    def command(self, line):
+        args = line.split()
+        if len(args) < 2:
+            self.send('* BAD invalid command')
+            return True
+        tag, command = args[0], args[1].upper()
+        args = args[2:]
+        messages = self.server.mailbox.snapshot()
+        if command in ('CAPABILITY',):
+            self.send('* CAPABILITY IMAP4rev1 IDLE')
+            self.send('%s OK CAPABILITY completed' % tag)
+        elif command in ('LOGIN', 'NOOP', 'CLOSE'):
+            self.send('%s OK %s completed' % (tag, command))
+        elif command in ('SELECT', 'EXAMINE'):
+            self.send('* %d EXISTS' % len(messages))
+            self.send('* 0 RECENT')
+            self.send('* OK [UIDVALIDITY %d] UIDs valid' % UIDVALIDITY)
+            self.send('%s OK [READ-ONLY] %s completed' % (tag, command))
+        elif command == 'UID' and args and args[0].upper() == 'SEARCH':
+            # Only supports UID n:m
+            spec = args[-1]
+            uids = self.uid_set(spec, messages)
+            self.send('* SEARCH%s' % ''.join(' %d' % uid for uid in uids))
+            self.send('%s OK SEARCH completed' % tag)
+        elif command == 'UID' and len(args) >= 2 and \
+                args[0].upper() == 'FETCH':
+            # Always sends the full message
+            for uid in self.uid_set(args[1], messages):
+                msg = messages[uid - 1].replace('\n', '\r\n')
+                self.wfile.write('* %d FETCH (UID %d BODY[] {%d}\r\n' % (
+                                 uid, uid, len(msg)))
+                self.wfile.write(msg)
+                self.send(')')
+            self.send('%s OK FETCH completed' % tag)
+        elif command == 'IDLE':
+            return self.idle(tag, len(messages))
+        elif command == 'LOGOUT':
+            self.send('* BYE')
+            self.send('%s OK LOGOUT completed' % tag)
+            return False
+        else:
+            self.send('%s BAD unknown command' % tag)
+        return True
+
+    def idle(self, tag, count):
+        """Reports new messages until the client sends DONE.
+        """
+        self.send('+ idling')
+        while True:
+            ready, _, _ = select.select([self.connection], [], [], 0.2)
+            if ready:
+                line = self.rfile.readline()
+                if not line:
+                    return False
+                if line.strip().upper() == 'DONE':
+                    self.send('%s OK IDLE terminated' % tag)
+                    return True
+                self.send('%s BAD expected DONE' % tag)
+                return True
+            new_count = len(self.server.mailbox.snapshot())
+            if new_count != count:
+                count = new_count
+                self.send('* %d EXISTS' % count)
+
+
+class Server(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, handler, mailbox):
+        SocketServer.TCPServer.__init__(self, address, handler)
+        self.mailbox = mailbox
+
+
+def serve(mailbox, pop3_port=1110, imap_port=1143, host='localhost'):
+    """Starts the servers in background threads, and returns them.
+    """
+    servers = [Server((host, pop3_port), Pop3Handler, mailbox),
+               Server((host, imap_port), ImapHandler, mailbox)]
+    for server in servers:
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+    return servers
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    drip = None
+    if len(args) == 3 and args[0] == '--drip':
+        drip = float(args[1])
+        args = args[2:]
+    if len(args) != 1:
+        sys.stderr.write("Usage: %s [--drip <seconds>] <mbox or Maildir>\n" %
+                         sys.argv[0])
+        sys.exit(2)
+    if drip is None:
+        mailbox = Mailbox(read_archive(args[0]))
+        print "Serving %d messages, POP3 on port 1110, IMAP on port 1143" % (
+            len(mailbox.messages),)
+    else:
+        mailbox = Mailbox()
+        print "Serving messages as they arrive, POP3 on port 1110, IMAP " \
+              "on port 1143"
+    servers = serve(mailbox)
+    try:
+        if drip is not None:
+            for msg in read_archive(args[0]):
+                time.sleep(drip)
+                mailbox.add(msg)
+                print "Added message %d" % len(mailbox.messages)
+        while True:
+            threading.Event().wait(3600)
+    except KeyboardInterrupt:
+        for server in servers:
+            server.shutdown()
@@ -0,0 +1,80 @@
+import unittest
+
+from internetpoints import bodies
+
+
+class TestResolve(unittest.TestCase):
+    def _segments(self, texts, references):
+        # Encodes each text against the texts it quotes, like the getter
+        segments = {}
+        for message_id, text in texts:
+            parents = dict((parent_id, dict(texts)[parent_id])
+                           for parent_id in references.get(message_id, []))
+            segments[message_id] = bodies.encode(text, parents)
+            self.assertEqual(bodies.join(segments[message_id], parents),
+                             text)
+        return segments
+
+    def test_parent_and_grandparent(self):
+        """A reply quoting both its parent and its grandparent.
+        """
+        grandparent = u'first line\nsecond line\nthird line'
+        parent = (u'> first line\n> second line\n> third line\n\n'
+                  u'an answer\non two lines')
+        reply = (u'> > first line\n> > second line\n'
+                 u'> an answer\n> on two lines\n\n'
+                 u'> first line\n> second line\n\nagreed')
+        texts = [(u'<g@x>', grandparent), (u'<p@x>', parent),
+                 (u'<a@x>', reply)]
+        references = {u'<p@x>': [u'<g@x>'],
+                      u'<a@x>': [u'<g@x>', u'<p@x>']}
+        segments = self._segments(texts, references)
+        self.assertEqual(bodies._parents(segments[u'<a@x>']),
+                         set([u'<g@x>', u'<p@x>']))
+        # Whatever order the parents are visited in
+        for first in (u'<g@x>', u'<p@x>'):
+            resolved = {}
+            if first == u'<p@x>':
+                bodies._resolve(u'<p@x>', segments, resolved)
+            bodies._resolve(u'<a@x>', segments, resolved)
+            self.assertEqual(resolved, dict(texts))
+
+    def test_cycle(self):
+        segments = {u'<a@x>': [[u'<b@x>', 0, 2, u'> ', u'>']],
+                    u'<b@x>': [[u'<a@x>', 0, 2, u'> ', u'>']]}
+        self.assertRaises(ValueError,
+                          bodies._resolve, u'<a@x>', segments, {})
+
+    def test_missing(self):
+        segments = {u'<a@x>': [u'text', [u'<b@x>', 0, 2, u'> ', u'>']]}
+        self.assertRaises(ValueError,
+                          bodies._resolve, u'<a@x>', segments, {})
+
+
+class TestBeginnings(unittest.TestCase):
+    def test_prefixes(self):
+        """The beginnings are the same as the full texts, cut.
+        """
+        root = u'\n'.join(u'line %d' % i for i in xrange(20))
+        parent = u'> ' + root.replace(u'\n', u'\n> ') + u'\n\nanswer'
+        reply = (u'first\n\n> > line 0\n> > line 1\n> > line 2\n\n' +
+                 u'> ' + root.replace(u'\n', u'\n> ') + u'\n\nthanks')
+        texts = {u'<r@x>': root, u'<p@x>': parent, u'<a@x>': reply}
+        segments = {
+                u'<p@x>': bodies.encode(parent, {u'<r@x>': root}),
+                u'<a@x>': bodies.encode(reply, {u'<r@x>': root,
+                                                u'<p@x>': parent})}
+        self.assertEqual(bodies._parents(segments[u'<a@x>']),
+                         set([u'<r@x>', u'<p@x>']))
+        self.assertEqual(bodies._depth(segments[u'<a@x>'],
+                                       {u'<r@x>': 0, u'<p@x>': 1}), 2)
+        for size in (0, 1, 5, 6, 30, 100, 1000):
+            beginnings = bodies._beginnings(
+                    [u'<a@x>', u'<p@x>'], segments, {u'<r@x>': root}, size)
+            self.assertEqual(beginnings,
+                             {u'<a@x>': texts[u'<a@x>'][:size],
+                              u'<p@x>': texts[u'<p@x>'][:size]})
+
+
+if __name__ == '__main__':
+    unittest.main()